@@ -1,27 +1,16 @@
 from mesa import Agent
+from roadgraph import DIRECTIONS, DIRECTION_CODES
+from routes import MOVE_OFFSETS, pack_moves, unpack_moves
 import random, math
 
-class Car(Agent):
+class BaseCar:
     """
-    Agent that moves randomly.
-    Attributes:
-        unique_id: Agent's ID 
-        direction: Randomly chosen direction chosen from one of eight directions
+    Movement of a car along the route to its objective, shared by Car and CompactCar. Holds no state of its own:
+    the hooks (follow, next_move, advance, ...) read the list of positions in `path`, CompactCar overrides them
+    to read its packed moves.
     """
-    def __init__(self, unique_id, model, direction = "Left", objective = None):
-        """
-        Creates a new random agent.
-        Args:
-            unique_id: The agent's ID
-            model: Model reference for the agent
-        """
-        super().__init__(unique_id, model)
-        self.direction = direction
-        self.objective = objective
-        self.path_Found = False
-        self.moveIndex = 0
-        self.path = []
-        
+    __slots__ = ()
+
     def calculate_distances(self, pos_1, pos_2):
         x1, y1 = pos_1
         x2, y2 = pos_2
@@ -30,183 +19,146 @@ class Car(Agent):
     def possible_moves_f(self, position, direction):
         """
         Returns a list of possible moves based on the current direction, grid bounds and buildings.
+        The moves come from the road graph the model compiles once from the static map.
         """
-        possible_moves = []
-        valid_directions = []
-        valid_moves = []
-        
-        # Get the neighborhood of the current position (around the current cell)
-        around = self.model.grid.get_neighborhood(position, moore=True, include_center=False)
-        x, y = position
-
-        # Define potential moves based on the current direction
-        if direction == "Left":
-            potential_moves = [
-                (x - 1, y),
-                (x - 1, y + 1),
-                (x - 1, y - 1),
-            ]
-            valid_directions = [
-                ["Left", "Up", "Down"],
-                ["Left", "Up"],
-                ["Left", "Down"],
-            ]
-        elif direction == "Right":
-            potential_moves = [
-                (x + 1, y),
-                (x + 1, y + 1),
-                (x + 1, y - 1),
-            ]
-            valid_directions = [
-                ["Right", "Up", "Down"],
-                ["Right", "Up"],
-                ["Right", "Down"],
-            ]
-        elif direction == "Up":
-            potential_moves = [
-                (x, y + 1),
-                (x + 1, y + 1),
-                (x - 1, y + 1),
-            ]
-            valid_directions = [
-                ["Up", "Left", "Right"],
-                ["Up", "Right"],
-                ["Up", "Left"],
-            ]
-        elif direction == "Down":
-            potential_moves = [
-                (x, y - 1),
-                (x + 1, y - 1),
-                (x - 1, y - 1),
-            ]
-            valid_directions = [
-                ["Down", "Left", "Right"],
-                ["Down", "Right"],
-                ["Down", "Left"],
-            ]
-
-        # Iterate over each potential move and check conditions
-        for idx, move in enumerate(potential_moves):
-            # Ensure the move is within the grid bounds
-            if not self.model.grid.out_of_bounds(move):
-                # Get all agents in the cell where the move is going
-                cell_agents = self.model.grid.get_cell_list_contents(move)
-                
-                # Check if the move is within bounds and no obstacles are in the way
-                if move in around and not any(isinstance(agent, Obstacle) for agent in cell_agents):
-                    # Now check for valid moves based on agents in the destination cell
-                    for agent in cell_agents:
-                        if isinstance(agent, Road) and agent.direction in valid_directions[idx]:
-                            valid_moves.append(move)
-                            break
-                        elif isinstance(agent, Destination) and agent.pos == self.objective.pos:
-                            # Allow any direction to a Destination
-                            valid_moves.append(move)
-                            break
-                        elif isinstance(agent, Traffic_Light) and idx == 0:
-                            # Allow movement if the Traffic_Light is green and directly in front of the car
-                            valid_moves.append(move)
-                            break
-
-        return valid_moves
+        return self.model.road_graph.moves(position, direction, self.objective.pos)
     
     def A_star(self):
         """
         A* algorithm to find the shortest path to the destination.
+        Runs on the model's precompiled road graph, so no grid queries happen during the search.
         """
-        start = self.pos
-        end = self.objective.pos
-        starting_direction = self.direction
-        open_list = [start]
-        closed_list = []
-        g_cost = {start: 0}
-        f_cost = {start: self.calculate_distances(start, end)}
-        came_from = {}
-
-        while open_list:
-            # Get the node with the lowest f_cost
-            current_node = min(open_list, key=lambda node: f_cost[node])
-            # If we reached the destination, reconstruct the path
-            if current_node == end:
-                path = []
-                while current_node in came_from:
-                    path.append(current_node)
-                    current_node = came_from[current_node]
-                path.reverse()  # Reverse path to start from the origin
-                #Reset direction to starting
-                self.direction = starting_direction
-                return path
-
-            open_list.remove(current_node)
-            closed_list.append(current_node)
-
-            # Update the car's direction based on the type of agent it's standing on
-            current_cell_agents = self.model.grid.get_cell_list_contents(current_node)
-            for agent in current_cell_agents:
-                if isinstance(agent, Road):
-                    self.direction = agent.direction  # Update direction to match the road's direction
-                    break  # Stop once we update the direction from a road
-
-            # Explore neighbors (possible moves) with the updated direction
-            for neighbor in self.possible_moves_f(current_node, self.direction):
-                if neighbor in closed_list:
-                    continue
-
-                tentative_g_cost = g_cost[current_node] + self.calculate_distances(current_node, neighbor)
-
-                if neighbor not in open_list:
-                    open_list.append(neighbor)
-                elif tentative_g_cost >= g_cost.get(neighbor, float('inf')):
-                    continue
-
-                # This path is the best one to this neighbor so far
-                came_from[neighbor] = current_node
-                g_cost[neighbor] = tentative_g_cost
-                f_cost[neighbor] = g_cost[neighbor] + self.calculate_distances(neighbor, end)
-        return []  # Return an empty list if no path is found
-        
+        profiler = self.model.profiler
+        with profiler.phase("astar"):
+            path = self.model.road_graph.a_star(self.pos, self.direction, self.objective.pos)
+        if profiler.enabled:
+            profiler.count("route_searches_total", kind="astar")
+            profiler.observe("search_expansions", self.model.road_graph.last_expansions, kind="astar")
+            profiler.observe("path_length", len(path))
+        return path
+
+    def route_to_objective(self):
+        """Takes the route of the objective's route tree from the current position."""
+        self.follow(self.model.routes.path(self.pos, self.direction, self.objective.pos))
+
+    def follow(self, path):
+        """Starts following a list of positions."""
+        self.path = path
+        self.moveIndex = 0
+
+    def next_move(self):
+        """Next position of the path, or None at the end of the path."""
+        if self.moveIndex >= len(self.path):
+            return None
+        return self.path[self.moveIndex]
+
+    def advance(self):
+        """Moves the path cursor after the car moved."""
+        self.moveIndex += 1
+
+    def remaining_path(self):
+        """Positions still to visit."""
+        return self.path[self.moveIndex:]
+
+    def remaining_moves(self):
+        return len(self.path) - self.moveIndex
+
+    def reroute(self):
+        """
+        Repairs the path around the congestion ahead, with extra costs for occupied cells and red lights near the car.
+        Returns whether the next move changed.
+        """
+        model = self.model
+        profiler = model.profiler
+        with profiler.phase("repair"):
+            path = model.routes.repair(self.pos, self.direction, self.objective.pos, model.route_penalty, model.reroute_radius)
+        if profiler.enabled:
+            profiler.count("route_searches_total", kind="repair")
+            profiler.observe("search_expansions", model.routes.last_expansions, kind="repair")
+        if not path or path[0] == self.next_move():
+            return False
+        self.follow(path)
+        return True
+
+    def retarget(self):
+        """
+        Picks a new objective reachable from the current position, since the current one cannot be reached.
+        Returns False, after removing the car from the city, when no destination can be reached anymore.
+        """
+        destinations = self.model.reachable_destinations(self.pos, self.direction)
+        if not destinations:
+            self.model.remove_car(self)
+            return False
+        self.objective = self.model.random.choice(destinations)
+        self.route_to_objective()
+        return True
+
     def move(self):
         """
         Determines if the agent can move in the direction that was chosen.
         Enforces valid traffic flow based on direction and position relative to the car.
         """
         if self.path_Found == False:
-            self.path = self.A_star()  # Get the path from A*
+            # A route that needs a search is planned off the step, the car waits on its spawn cell meanwhile
+            planner = self.model.planner
+            if planner is not None:
+                key = planner.request(self.pos, self.direction, self.objective.pos)
+                if key is not None:
+                    self.model.schedule.sleep(self, key)
+                    return
+            profiler = self.model.profiler
+            with profiler.phase("route"):
+                self.route_to_objective()  # Follow the destination's route tree
             self.path_Found = True
-        
-        move = self.path[self.moveIndex]  # Get the current target position from the path
-        cell_agents = self.model.grid.get_cell_list_contents(move)  # Get the agents in the target cell
+            if profiler.enabled:
+                profiler.count("route_searches_total", kind="tree")
+                profiler.observe("path_length", self.remaining_moves())
 
-        # Check if the car is currently on a Traffic_Light
-        current_cell_agents = self.model.grid.get_cell_list_contents(self.pos)
-        is_on_traffic_light = any(isinstance(agent, Traffic_Light) for agent in current_cell_agents)
+        # An empty path means the objective cannot be reached from here
+        move = self.next_move()  # Get the current target position from the path
+        if move is None:
+            if not self.retarget():
+                return
+            move = self.next_move()
+
+        # Handle traffic light rules (if on a traffic light)
+        if self.model.city.is_red(self.pos):
+            if self.red_since is None:
+                self.red_since = self.model.schedule.steps
+            self.model.schedule.sleep(self, ("green", self.pos))  # Wait until the light turns green
+            return  # Don't move
+        if self.red_since is not None:
+            self.light_wait += self.model.schedule.steps - self.red_since
+            self.red_since = None
 
         # Ensure no other Car is already in the target cell
-        if any(isinstance(agent, Car) for agent in cell_agents):
-            return  # Don't move if another car is in the target cell
+        if self.model.is_occupied(move):
+            # After waiting reroute_patience steps, look for a way around the car in front
+            steps = self.model.schedule.steps
+            patience = self.model.reroute_patience
+            if self.blocked_since is None:
+                self.blocked_since = steps
+            elif patience is not None and steps - self.blocked_since >= patience:
+                self.blocked_since = steps
+                if self.reroute():
+                    move = self.next_move()
 
-        # Handle traffic light rules (if on a traffic light)
-        if is_on_traffic_light:
-            traffic_light = next((agent for agent in current_cell_agents if isinstance(agent, Traffic_Light)), None)
-            if traffic_light and not traffic_light.state:  # If the light is red
-                return  # Don't move
+            if self.model.is_occupied(move):
+                self.model.schedule.sleep(self, ("free", move), timeout=patience)  # Wait until the car in front leaves the cell
+                return  # Don't move if another car is in the target cell
+        self.blocked_since = None
             
-        self.model.grid.move_agent(self, self.path[self.moveIndex])
-        self.moveIndex += 1  # Increment the move index
+        self.model.move_car(self, move)
+        self.advance()  # Increment the move index
         
-        for agent in cell_agents:
-            if isinstance(agent, Road):  # Check if it's a Road agent
-                self.direction = agent.direction  # Copy the direction from the Road agent
-                break  # Update direction only once
+        city = self.model.city
+        if city.is_road(move):
+            self.direction = DIRECTIONS[city.direction_at(move)]  # Copy the direction of the road
             
-            elif isinstance(agent, Destination):  # Check if it's a Destination agent
-                self.model.cars_reached_destination += 1  # Increment the counter
-                self.model.grid.remove_agent(self)  # Remove the car from the grid
-                self.model.schedule.remove(self)  # Remove the car from the schedule
-                break  # If destination is reached, end the movement
-                    
-                
-
+        elif city.is_destination(move):
+            self.model.cars_reached_destination += 1  # Increment the counter
+            self.model.trips.add(self.model.schedule.steps - self.spawn_step + 1, self.light_wait)
+            self.model.remove_car(self)  # Remove the car from the grid and the schedule
 
     def step(self):
         """ 
@@ -214,11 +166,97 @@ class Car(Agent):
         """
         self.move()
 
+class Car(BaseCar, Agent):
+    """
+    Agent that moves randomly.
+    Attributes:
+        unique_id: Agent's ID 
+        direction: Randomly chosen direction chosen from one of eight directions
+    """
+    def __init__(self, unique_id, model, direction = "Left", objective = None, car_id = None):
+        """
+        Creates a new random agent.
+        Args:
+            unique_id: The agent's ID
+            model: Model reference for the agent
+            car_id: Integer id of the car, used by the compact car frames
+        """
+        super().__init__(unique_id, model)
+        self.car_id = car_id
+        self.spawn_step = model.schedule.steps
+        self.light_wait = 0  # Steps spent stopped at red lights
+        self.red_since = None
+        self.blocked_since = None  # Step since which the next cell has been occupied
+        self.direction = direction
+        self.objective = objective
+        self.path_Found = False
+        self.moveIndex = 0
+        self.path = []
+
+class CompactCar(BaseCar):
+    """
+    Car that takes little memory, for large fleets moved by the agents engine.
+    Its unique_id is its integer car id, its direction is stored as a heading code and its path as
+    one byte per move (see routes.pack_moves). The packed route of a spawn cell to a destination is
+    shared by every car that gets it, so only the cars that rerouted hold moves of their own.
+    It is not a mesa Agent: every attribute is a slot, without an instance __dict__, and it is not
+    registered with the mesa model, which would keep every car ever spawned. The model tracks its cars itself.
+    """
+    __slots__ = ("unique_id", "model", "pos", "car_id", "heading", "objective", "path_Found", "moves", "moveIndex",
+                 "spawn_step", "light_wait", "red_since", "blocked_since", "__weakref__")
+
+    def __init__(self, unique_id, model, direction="Left", objective=None, car_id=None):
+        self.unique_id = unique_id
+        self.model = model
+        self.pos = None
+        self.car_id = car_id
+        self.spawn_step = model.schedule.steps
+        self.light_wait = 0
+        self.red_since = None
+        self.blocked_since = None
+        self.direction = direction
+        self.objective = objective
+        self.path_Found = False
+        self.moves = b""
+        self.moveIndex = 0
+
+    def remove(self):
+        """Nothing to deregister, see the class docstring."""
+
+    @property
+    def direction(self):
+        return DIRECTIONS[self.heading]
+
+    @direction.setter
+    def direction(self, value):
+        self.heading = DIRECTION_CODES[value]
+
+    def route_to_objective(self):
+        self.moves = self.model.routes.packed_path(self.pos, self.direction, self.objective.pos)
+        self.moveIndex = 0
+
+    def follow(self, path):
+        self.moves = pack_moves(self.pos, path)
+        self.moveIndex = 0
+
+    def next_move(self):
+        if self.moveIndex >= len(self.moves):
+            return None
+        dx, dy = MOVE_OFFSETS[self.moves[self.moveIndex]]
+        x, y = self.pos
+        return (x + dx, y + dy)
+
+    def remaining_path(self):
+        return unpack_moves(self.pos, self.moves[self.moveIndex:])
+
+    def remaining_moves(self):
+        return len(self.moves) - self.moveIndex
+
 class Traffic_Light(Agent):
     """
     Traffic light. Where the traffic lights are in the grid.
     """
-    def __init__(self, unique_id, model, state = False, timeToChange = 10):
+    def __init__(self, unique_id, model, state = False, timeToChange = 10, index = None, offset = 0):
         super().__init__(unique_id, model)
         """
         Creates a new Traffic light.
@@ -227,16 +265,36 @@ class Traffic_Light(Agent):
             model: Model reference for the agent
             state: Whether the traffic light is green or red
             timeToChange: After how many step should the traffic light change color 
+            index: Position of the light in the model's city layer, which then stores its state
+            offset: Step of the first change, the light changes on the steps equal to it modulo timeToChange
         """
+        self.index = index
+        self.offset = offset
         self.state = state
         self.timeToChange = timeToChange
 
+    @property
+    def state(self):
+        if self.index is None:
+            return self._state
+        return bool(self.model.city.light_state[self.index])
+
+    @state.setter
+    def state(self, value):
+        if self.index is None:
+            self._state = value
+        else:
+            self.model.city.light_state[self.index] = value
+
     def step(self):
         """ 
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
+        The schedule only steps the light on the steps it changes, and the cars stopped on it are woken when it turns green.
         """
-        if self.model.schedule.steps % self.timeToChange == 0:
+        if (self.model.schedule.steps - self.offset) % self.timeToChange == 0:
             self.state = not self.state
+            if self.state:
+                self.model.schedule.notify(("green", self.pos))
 
 class Destination(Agent):
     """
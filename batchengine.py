@@ -0,0 +1,385 @@
+from collections import OrderedDict
+import numpy as np
+from roadgraph import DIRECTIONS, DESTINATION
+
+class RouteRows:
+    """
+    Next state of every state (and for rerouting the cost to go of every state) for the destinations the cars
+    are going to, one row per destination in use. A row is copied from the model's route trees when the first
+    car for its destination spawns, instead of stacking a row for every destination up front, which grows as
+    destinations x states. Rows are kept while cars go to their destination, and rows without cars are reused
+    once max_rows rows were filled, the least recently released first. The table only grows when every row
+    has cars.
+    Args:
+        routes: RouteTrees the rows are copied from
+        goals: Destination positions, indexed by the destination index of the cars
+        max_rows: Rows filled before the rows without cars are reused, None for one row per destination
+        costs: Also keep the cost to go rows, for rerouting
+        allocate: Callable (name, shape, dtype) returning the uninitialized array of a table, np.empty by default
+    """
+    def __init__(self, routes, goals, max_rows, costs, allocate=None):
+        self.routes = routes
+        self.goals = goals
+        self.num_states = routes.road_graph.num_states
+        self.costs = costs
+        self.allocate = allocate or (lambda name, shape, dtype: np.empty(shape, dtype=dtype))
+        self.max_rows = len(goals) if max_rows is None else min(max_rows, len(goals))
+        # Row of every destination index, -1 when it has none
+        self.row_of = self.allocate("row_of", (len(goals),), np.int32)
+        self.row_of[:] = -1
+        self.next_hop = self.cost_to_go = None
+        self.capacity = 0
+        # Incremented every time the tables are replaced by bigger ones
+        self.generation = 0
+        self._grow(max(self.max_rows, 1))
+
+    def _grow(self, capacity):
+        """Replaces the tables by tables of `capacity` rows, keeping the rows filled so far."""
+        filled = self.capacity
+        next_hop = self.allocate("next_hop", (capacity, self.num_states), np.int32)
+        next_hop[:filled] = self.next_hop[:filled] if filled else 0
+        self.next_hop = next_hop
+        if self.costs:
+            cost_to_go = self.allocate("cost_to_go", (capacity, self.num_states), np.float32)
+            cost_to_go[:filled] = self.cost_to_go[:filled] if filled else 0
+            self.cost_to_go = cost_to_go
+        if filled:
+            self.cars = np.concatenate([self.cars, np.zeros(capacity - filled, dtype=np.int64)])
+            self.goal_of = np.concatenate([self.goal_of, np.full(capacity - filled, -1, dtype=np.int32)])
+            self.unused.extend(range(capacity - 1, filled - 1, -1))
+        else:
+            # Cars going to the destination of every row, and destination index of every row (-1 for none)
+            self.cars = np.zeros(capacity, dtype=np.int64)
+            self.goal_of = np.full(capacity, -1, dtype=np.int32)
+            # Rows never filled, and rows without cars in the order they were released
+            self.unused = list(range(capacity - 1, -1, -1))
+            self.idle = OrderedDict()
+        self.capacity = capacity
+        self.generation += 1
+
+    @property
+    def nbytes(self):
+        total = self.row_of.nbytes + self.next_hop.nbytes
+        if self.costs:
+            total += self.cost_to_go.nbytes
+        return total
+
+    def _take_row(self):
+        """Returns a row to fill: a row never filled until max_rows were, then the least recently released one."""
+        if self.idle and (self.capacity - len(self.unused) >= self.max_rows or not self.unused):
+            row, _ = self.idle.popitem(last=False)
+            self.row_of[self.goal_of[row]] = -1
+            return row
+        if not self.unused:
+            self._grow(2 * self.capacity)
+        return self.unused.pop()
+
+    def acquire(self, goal_index, count=1):
+        """Counts `count` more cars going to a destination (by index), filling its row if it has none."""
+        row = int(self.row_of[goal_index])
+        if row < 0:
+            row = self._take_row()
+            goal = self.goals[goal_index]
+            # The cost to go first: building it also keeps the tree, which is then not built again
+            if self.costs:
+                self.cost_to_go[row] = self.routes.cost_to_go(goal)
+            self.next_hop[row] = self.routes.tree(goal)
+            self.row_of[goal_index] = row
+            self.goal_of[row] = goal_index
+        elif self.cars[row] == 0:
+            del self.idle[row]
+        self.cars[row] += count
+
+    def acquire_many(self, goal_indices):
+        """Counts the cars going to the destinations of an array of destination indexes."""
+        goal_indices, counts = np.unique(goal_indices, return_counts=True)
+        for goal_index, count in zip(goal_indices.tolist(), counts.tolist()):
+            self.acquire(goal_index, count)
+
+    def release(self, goal_indices):
+        """Counts out the cars of an array of destination indexes, which arrived."""
+        if goal_indices.size == 0:
+            return
+        rows = self.row_of[goal_indices]
+        released = np.bincount(rows, minlength=self.capacity)
+        self.cars -= released
+        for row in np.flatnonzero(released).tolist():
+            if self.cars[row] == 0:
+                self.idle[row] = None
+
+    def reset(self):
+        """Forgets the cars of every row, keeping the filled rows to be reused."""
+        for row in np.flatnonzero(self.cars).tolist():
+            self.idle[row] = None
+        self.cars[:] = 0
+
+class BatchEngine:
+    """
+    Moves every car of a CityModel in one NumPy pass per step.
+    Cars are stored as a structure of arrays instead of Car agents: road graph
+    state (cell * 4 + heading), destination index, id, spawn step and steps
+    waited at red lights. Routes come from the model's per-destination
+    next-hop trees, whose rows are copied into RouteRows for the destinations
+    in use, so a car's path cursor is simply its current state.
+    A car blocked behind another one for model.reroute_patience steps picks
+    the move with the lowest cost to go plus congestion and red light costs,
+    which repairs its route around the cars ahead.
+    Args:
+        model: The CityModel whose cars are simulated
+        capacity: Initial number of car slots, grown when needed
+    """
+    # Arrays with one entry per car slot
+    CAR_ARRAYS = ("state", "destination", "ids", "spawn_step", "light_wait", "blocked_for", "alive")
+
+    def __init__(self, model, capacity=1024):
+        self.model = model
+        self.city = model.city
+        self.height = model.road_graph.height
+
+        # Next state of every state for the destinations in use, one row per destination, and for rerouting
+        # the cost to go of every state for them and the dense successor table
+        self.goals = [destination.pos for destination in model.destinations]
+        self.goal_index = {goal: index for index, goal in enumerate(self.goals)}
+        self.patience = model.reroute_patience
+        self.congestion_cost = model.congestion_cost
+        self.rows = RouteRows(model.routes, self.goals, model.settings["max_route_trees"], self.patience is not None)
+        self._bind_rows()
+        if self.patience is not None:
+            self.successor_states, self.successor_costs = model.road_graph.successor_table()
+
+        self.cell_type = self.city.cell_type.ravel()
+        self.light_index = self.city.light_index.ravel()
+
+        # Slot of the car on every cell, -1 when the cell is free
+        self.occupied = np.full(self.cell_type.size, -1, dtype=np.int32)
+
+        self.state = np.zeros(capacity, dtype=np.int32)
+        self.destination = np.zeros(capacity, dtype=np.int16)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.spawn_step = np.zeros(capacity, dtype=np.int32)
+        self.light_wait = np.zeros(capacity, dtype=np.int32)
+        self.blocked_for = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.slot_of = {}
+        self.next_id = 0
+        self.count = 0
+
+        # Priorities used to settle contested cells, drawn from the model's seeded RNG
+        self.rng = np.random.default_rng(model.random.getrandbits(32))
+
+    def _grow(self):
+        capacity = self.state.size
+        for name in self.CAR_ARRAYS:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def _bind_rows(self):
+        """Reads the route tables from the RouteRows again, after they may have grown."""
+        self.row_of, self.next_hop, self.cost_to_go = self.rows.row_of, self.rows.next_hop, self.rows.cost_to_go
+
+    @property
+    def nbytes(self):
+        """Memory used by the car arrays, the occupancy array and the routing tables."""
+        total = (self.state.nbytes + self.destination.nbytes + self.ids.nbytes + self.spawn_step.nbytes
+                 + self.light_wait.nbytes + self.blocked_for.nbytes + self.alive.nbytes + self.occupied.nbytes
+                 + self.rows.nbytes)
+        if self.patience is not None:
+            total += self.successor_states.nbytes + self.successor_costs.nbytes
+        return total
+
+    def get_state(self):
+        """Returns (counters and RNG state as plain data, arrays) of the cars, for snapshots."""
+        arrays = {name: getattr(self, name) for name in self.CAR_ARRAYS}
+        arrays["occupied"] = self.occupied
+        arrays["free_slots"] = np.array(self.free_slots, dtype=np.int64)
+        return {"next_id": self.next_id, "count": self.count, "rng": self.rng.bit_generator.state}, arrays
+
+    def set_state(self, state, arrays):
+        """Restores the cars saved by get_state."""
+        for name in self.CAR_ARRAYS + ("occupied",):
+            setattr(self, name, np.array(arrays[name], dtype=getattr(self, name).dtype))
+        self.free_slots = arrays["free_slots"].tolist()
+        self.slot_of = {int(self.ids[slot]): int(slot) for slot in np.flatnonzero(self.alive)}
+        self.next_id = state["next_id"]
+        self.count = state["count"]
+        self.rng.bit_generator.state = state["rng"]
+        self.rows.reset()
+        self.rows.acquire_many(self.destination[self.alive])
+        self._bind_rows()
+
+    def reseed(self, seed):
+        """Draws the priorities of the next steps from a new seed."""
+        self.rng = np.random.default_rng(seed)
+
+    def close(self):
+        """Nothing to release, the cars live in the model's process."""
+
+    def is_occupied(self, pos):
+        x, y = pos
+        return self.occupied[x * self.height + y] >= 0
+
+    def spawn(self, pos, direction, goal):
+        """Adds a car on a free position, heading in a direction and going to a goal position. Returns its id."""
+        if not self.free_slots:
+            self._grow()
+        slot = self.free_slots.pop()
+        x, y = pos
+        cell = x * self.height + y
+        self.state[slot] = cell * 4 + DIRECTIONS.index(direction)
+        goal_index = self.goal_index[goal]
+        self.destination[slot] = goal_index
+        self.rows.acquire(goal_index)
+        self._bind_rows()
+        self.ids[slot] = self.next_id
+        self.spawn_step[slot] = self.model.schedule.steps
+        self.light_wait[slot] = 0
+        self.blocked_for[slot] = 0
+        self.alive[slot] = True
+        self.occupied[cell] = slot
+        self.slot_of[self.next_id] = slot
+        self.model.car_changes.changed(self.model.schedule.steps, [self.next_id])
+        self.next_id += 1
+        self.count += 1
+        return int(self.ids[slot])
+
+    def cars(self):
+        """Returns (id, (x, y), direction) for every car."""
+        slots = np.flatnonzero(self.alive)
+        cells, headings = np.divmod(self.state[slots], 4)
+        xs, ys = np.divmod(cells, self.height)
+        return [
+            (car_id, (x, y), DIRECTIONS[heading])
+            for car_id, x, y, heading in zip(self.ids[slots].tolist(), xs.tolist(), ys.tolist(), headings.tolist())
+        ]
+
+    def car_arrays(self, car_ids=None):
+        """Returns the ids, x, y and direction codes of every car, or of the given car ids that still exist."""
+        if car_ids is None:
+            slots = np.flatnonzero(self.alive)
+        else:
+            slots = np.array([self.slot_of[car_id] for car_id in car_ids if car_id in self.slot_of], dtype=np.int64)
+        cells, headings = np.divmod(self.state[slots], 4)
+        xs, ys = np.divmod(cells, self.height)
+        return (
+            self.ids[slots].astype(np.uint32),
+            xs.astype(np.uint16),
+            ys.astype(np.uint16),
+            headings.astype(np.uint8),
+        )
+
+    def _reroute(self, slots, target_state, steps):
+        """
+        Returns the next states of cars that want to move, with the cars blocked for `patience` steps
+        switched to their cheapest move: edge cost + cost to go + congestion and red light costs of the next cell.
+        """
+        target_cell = target_state >> 2
+        blocked = (self.occupied[target_cell] >= 0) & (self.blocked_for[slots] >= self.patience)
+        if not blocked.any():
+            return target_state
+
+        rerouting = slots[blocked]
+        state = self.state[rerouting]
+        options = self.successor_states[state]
+        valid = options >= 0
+        option_state = np.where(valid, options, 0)
+        option_cell = option_state >> 2
+        cost = self.successor_costs[state] + self.cost_to_go[self.row_of[self.destination[rerouting]][:, None], option_state]
+        cost += np.where(self.occupied[option_cell] >= 0, self.congestion_cost, 0.0)
+
+        # Waiting time of the red lights among the next cells
+        light = self.light_index[option_cell]
+        if self.city.light_state.size:
+            index = np.maximum(light, 0)
+            red = (light >= 0) & ~self.city.light_state[index]
+            period = self.city.light_time[index]
+            cost += np.where(red, period - (steps - self.city.light_offset[index]) % period, 0)
+        cost[~valid] = np.inf
+
+        best = np.argmin(cost, axis=1)
+        best_state = options[np.arange(best.size), best]
+        routed = np.isfinite(cost[np.arange(best.size), best])
+        target_state = target_state.copy()
+        target_state[np.flatnonzero(blocked)[routed]] = best_state[routed]
+        self.blocked_for[rerouting] = 0
+        return target_state
+
+    def step(self):
+        """
+        Advances every car by at most one cell. Returns the number of cars that reached their destination.
+        A car moves when its light is green and its next cell is free or is being left by a car that moves too.
+        When several cars want the same cell, the one with the lowest random priority of the step gets it.
+        """
+        slots = np.flatnonzero(self.alive)
+        if slots.size == 0:
+            return 0
+
+        state = self.state[slots]
+        cell = state >> 2
+        target_state = self.next_hop[self.row_of[self.destination[slots]], state]
+
+        # Cars on a red light or without a route stay where they are
+        light = self.light_index[cell]
+        if self.city.light_state.size:
+            red = (light >= 0) & ~self.city.light_state[np.maximum(light, 0)]
+        else:
+            red = np.zeros(slots.size, dtype=bool)
+        self.light_wait[slots[red]] += 1
+        wants = (target_state >= 0) & ~red
+        candidates = wanting = slots[wants]
+        if candidates.size == 0:
+            return 0
+        target_state = target_state[wants]
+        if self.patience is not None:
+            target_state = self._reroute(candidates, target_state, self.model.schedule.steps)
+        target_cell = target_state >> 2
+
+        # Settle contested cells: one winner per target cell
+        priority = self.rng.random(candidates.size)
+        order = np.lexsort((priority, target_cell))
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = target_cell[order][1:] != target_cell[order][:-1]
+        winners = order[first]
+        candidates = candidates[winners]
+        target_state = target_state[winners]
+        target_cell = target_cell[winners]
+
+        # Winners move into free cells, then into cells left by cars that move
+        moving = np.zeros(self.alive.size, dtype=bool)
+        blocker = self.occupied[target_cell]
+        free = blocker < 0
+        moving[candidates[free]] = True
+        pending = np.flatnonzero(~free)
+        while pending.size:
+            unblocked = moving[blocker[pending]]
+            if not unblocked.any():
+                break
+            moving[candidates[pending[unblocked]]] = True
+            pending = pending[~unblocked]
+
+        moved = moving[candidates]
+        movers = candidates[moved]
+        self.blocked_for[wanting] += 1
+        self.blocked_for[movers] = 0
+        self.occupied[self.state[movers] >> 2] = -1
+        self.state[movers] = target_state[moved]
+        new_cell = target_cell[moved]
+
+        # Cars that entered their destination leave the city
+        arrived = self.cell_type[new_cell] == DESTINATION
+        self.occupied[new_cell[~arrived]] = movers[~arrived]
+        finished = movers[arrived]
+        self.alive[finished] = False
+        self.free_slots.extend(finished.tolist())
+        self.count -= finished.size
+        self.rows.release(self.destination[finished])
+
+        step = self.model.schedule.steps
+        self.model.trips.add_many(step - self.spawn_step[finished] + 1, self.light_wait[finished])
+        finished_ids = self.ids[finished].tolist()
+        for car_id in finished_ids:
+            del self.slot_of[car_id]
+        self.model.car_changes.changed(step, self.ids[movers[~arrived]].tolist())
+        self.model.car_changes.removed(step, finished_ids)
+        return int(finished.size)
@@ -0,0 +1,152 @@
+"""
+Headless parameter sweeps of CityModel.
+
+Runs every combination of map, initial car count, spawn interval and traffic
+light timings a number of times on a process pool, and writes the aggregate
+results to a single JSON file. Example:
+
+    python batchrun.py --maps 2021 2024 --cars 4 --spawn-every 2 4 --light-timings 15:7 10:5 --replicates 10
+"""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import argparse
+import json
+import os
+import statistics
+import time
+from mapcache import map_path
+
+def parse_light_timing(text):
+    """Parses "15:7" into the overrides of the "S" and "s" entries of mapDictionary.json."""
+    long_cycle, short_cycle = text.split(":")
+    return {"S": int(long_cycle), "s": int(short_cycle)}
+
+def mean_or_none(values):
+    """Mean of the values that are not None, or None if there are none."""
+    values = [value for value in values if value is not None]
+    return statistics.mean(values) if values else None
+
+def run_single(params):
+    """
+    Runs one simulation and returns its results. Top-level so the process pool can pickle it.
+    Args:
+        params: Dictionary with map, N, spawn_every, light_timings, steps, engine, replicate and seed
+    """
+    from model import CityModel
+
+    start = time.perf_counter()
+    model = CityModel(
+        params["N"],
+        compact=True,
+        engine=params["engine"],
+        map_file=map_path(params["map"]),
+        spawn_every=params["spawn_every"],
+        light_timings=params["light_timings"],
+        seed=params["seed"],
+    )
+    for _ in range(params["steps"]):
+        model.step()
+
+    trips = model.get_trip_stats()
+    return dict(
+        params,
+        cars_reached=model.get_cars_reached_destination(),
+        cars_in_city=model.get_car_count(),
+        throughput=model.get_cars_reached_destination() / params["steps"],
+        # None when no car arrived, a gridlocked run must not look like one with instant trips
+        travel_time_mean=trips["travel_time"]["mean"] if trips["travel_time"]["count"] else None,
+        light_wait_mean=trips["light_wait"]["mean"] if trips["light_wait"]["count"] else None,
+        seconds=time.perf_counter() - start,
+    )
+
+def build_runs(maps, cars, spawn_intervals, light_timings, replicates, steps, engine, base_seed):
+    """Returns the parameters of every run of the sweep, each with its own seed."""
+    runs = []
+    for map_name, N, spawn_every, timing in product(maps, cars, spawn_intervals, light_timings):
+        for replicate in range(replicates):
+            runs.append({
+                "map": map_name,
+                "N": N,
+                "spawn_every": spawn_every,
+                "light_timings": timing,
+                "steps": steps,
+                "engine": engine,
+                "replicate": replicate,
+                "seed": base_seed + len(runs),
+            })
+    return runs
+
+def summarize(results):
+    """Aggregates the runs that share the same parameters. Trip means only average the runs where cars arrived."""
+    groups = {}
+    for result in results:
+        key = (result["map"], result["N"], result["spawn_every"], json.dumps(result["light_timings"], sort_keys=True))
+        groups.setdefault(key, []).append(result)
+
+    summary = []
+    for (map_name, N, spawn_every, timing), runs in groups.items():
+        reached = [run["cars_reached"] for run in runs]
+        throughput = [run["throughput"] for run in runs]
+        summary.append({
+            "map": map_name,
+            "N": N,
+            "spawn_every": spawn_every,
+            "light_timings": json.loads(timing),
+            "replicates": len(runs),
+            "cars_reached_mean": statistics.mean(reached),
+            "cars_reached_stdev": statistics.stdev(reached) if len(reached) > 1 else 0.0,
+            "throughput_mean": statistics.mean(throughput),
+            "throughput_stdev": statistics.stdev(throughput) if len(throughput) > 1 else 0.0,
+            "travel_time_mean": mean_or_none(run["travel_time_mean"] for run in runs),
+            "light_wait_mean": mean_or_none(run["light_wait_mean"] for run in runs),
+        })
+    return summary
+
+def run_sweep(maps=("2024",), cars=(4,), spawn_intervals=(4,), light_timings=({"S": 15, "s": 7},), replicates=1,
+              steps=500, engine="agents", base_seed=0, workers=None, output=None):
+    """
+    Runs a sweep on a process pool and returns {"runs": [...], "summary": [...]}.
+    Args:
+        maps: Map years or map file paths
+        cars: Initial numbers of cars (N)
+        spawn_intervals: Steps between two waves of spawned cars
+        light_timings: Overrides of the "S"/"s" entries of mapDictionary.json
+        replicates: Runs per parameter combination
+        steps: Steps per run
+        engine: "agents" or "batch"
+        base_seed: Seed of the first run, the following runs use the next seeds
+        workers: Number of processes (defaults to every core)
+        output: Path of the JSON results file to write, if any
+    """
+    runs = build_runs(maps, cars, spawn_intervals, light_timings, replicates, steps, engine, base_seed)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run_single, runs, chunksize=max(1, len(runs) // (4 * (workers or os.cpu_count() or 1)))))
+
+    sweep = {"runs": results, "summary": summarize(results)}
+    if output is not None:
+        with open(output, "w") as resultsFile:
+            json.dump(sweep, resultsFile, indent=2)
+    return sweep
+
+def main():
+    parser = argparse.ArgumentParser(description="Run headless parameter sweeps of the city model.")
+    parser.add_argument("--maps", nargs="+", default=["2021", "2022", "2023", "2024"], help="Map years or map file paths")
+    parser.add_argument("--cars", nargs="+", type=int, default=[4], help="Initial numbers of cars")
+    parser.add_argument("--spawn-every", nargs="+", type=int, default=[4], help="Steps between spawn waves")
+    parser.add_argument("--light-timings", nargs="+", type=parse_light_timing, default=[{"S": 15, "s": 7}],
+                        help="Traffic light cycles as S:s, e.g. 15:7")
+    parser.add_argument("--replicates", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--engine", choices=["agents", "batch"], default="agents")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first run")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: all cores)")
+    parser.add_argument("--output", default="results.json")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    sweep = run_sweep(args.maps, args.cars, args.spawn_every, args.light_timings, args.replicates, args.steps,
+                      args.engine, args.seed, args.workers, args.output)
+    print(f"{len(sweep['runs'])} runs in {time.perf_counter() - start:.1f}s, results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Scaling benchmarks of CityModel.
+
+Generates tiled maps of growing size with mapgen, fills them with a number of
+cars and measures, for every map size, car count and engine:
+
+- compile_seconds: parsing the map and compiling its graph and route trees (cold cache)
+- construct_seconds: building a CityModel from the compiled map cache
+- astar_ms_per_car: A* search time per car, over a sample of start/destination pairs
+- route_ms_per_car: reading the same routes from the route trees
+- contracted_ms_per_car: querying the same routes on the contracted graph (see contraction.py)
+- steps_per_second: model steps per second with the cars on the map
+- peak_rss_mb: peak resident memory of the process that ran the case (without the workers of the partitioned engine)
+- speedup: for the partitioned engine, its steps per second over the ones of the batch engine on the same map,
+  cars and seed (batch_steps_per_second)
+
+Every case runs in a fresh process so the peak memory belongs to that case
+alone. Results are written as JSON; pass a previous results file with
+--compare to list the cases that got slower. Example:
+
+    python benchmark.py --base city_files/2024_base.txt --tiles 1 2 4 --cars 100 1000 --output bench.json
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from mapgen import generate
+
+# Measurements where a larger value is worse, and where a smaller value is worse
+LOWER_IS_BETTER = ("compile_seconds", "construct_seconds", "astar_ms_per_car", "route_ms_per_car", "contracted_ms_per_car",
+                   "peak_rss_mb")
+HIGHER_IS_BETTER = ("steps_per_second", "speedup")
+
+def fill_cars(model, cars):
+    """Adds cars on random free roads of a model, each going to a random destination it can reach."""
+    from roadgraph import ROAD
+    roads = model.city.cells_of(ROAD)
+    model.random.shuffle(roads)
+    for pos in roads:
+        if model.get_car_count() >= cars:
+            break
+        if not model.is_occupied(pos):
+            model.add_car(f"car_bench_{pos[0]}_{pos[1]}", pos)
+
+def time_routes(model, samples):
+    """
+    Returns the milliseconds per route of A*, of the route trees and of the contracted graph, over random reachable
+    start/destination pairs.
+    """
+    from roadgraph import DIRECTIONS, ROAD
+    from contraction import load_contracted
+    roads = model.city.cells_of(ROAD)
+    pairs = []
+    for _ in range(samples * 4):
+        if len(pairs) == samples:
+            break
+        start = model.random.choice(roads)
+        direction = DIRECTIONS[model.city.direction_at(start)]
+        destinations = model.reachable_destinations(start, direction)
+        if destinations:
+            pairs.append((start, direction, model.random.choice(destinations).pos))
+    if not pairs:
+        return None, None, None
+
+    start_time = time.perf_counter()
+    for start, direction, goal in pairs:
+        model.road_graph.a_star(start, direction, goal)
+    astar = (time.perf_counter() - start_time) * 1000 / len(pairs)
+
+    start_time = time.perf_counter()
+    for start, direction, goal in pairs:
+        model.routes.path(start, direction, goal)
+    route = (time.perf_counter() - start_time) * 1000 / len(pairs)
+
+    # Built once per map and then read from the map cache, like the compiled map
+    contracted = load_contracted(model.map_file, model.road_graph)
+    start_time = time.perf_counter()
+    for start, direction, goal in pairs:
+        contracted.path(start, direction, goal)
+    contracted_route = (time.perf_counter() - start_time) * 1000 / len(pairs)
+    return astar, route, contracted_route
+
+def batch_steps_per_second(case):
+    """Steps per second of the batch engine on the map, cars and seed of a case, to compare other engines with."""
+    from model import CityModel
+
+    model = CityModel(0, max_route_trees=case["max_route_trees"], compact=True, engine="batch", map_file=case["map"],
+                      spawn_every=case["steps"] + 1, seed=case["seed"])
+    fill_cars(model, case["cars"])
+    start = time.perf_counter()
+    for _ in range(case["steps"]):
+        model.step()
+    return case["steps"] / (time.perf_counter() - start)
+
+def run_case(case):
+    """
+    Runs one benchmark case in the current process and returns its measurements.
+    Top-level so the process pool can pickle it.
+    Args:
+        case: Dictionary with map, cars, engine, workers, steps, samples, max_route_trees and seed
+    """
+    from mapcache import load_map, cache_path
+    from model import CityModel
+
+    start = time.perf_counter()
+    load_map(case["map"], cache_dir=None)
+    compile_seconds = time.perf_counter() - start
+    if not os.path.exists(cache_path(case["map"], max_routes=case["max_route_trees"])):
+        load_map(case["map"], max_routes=case["max_route_trees"])
+
+    start = time.perf_counter()
+    # No corner spawns, so the number of cars is the one the case asks for
+    # The "compact" engine is the agents engine with CompactCar agents
+    compact_cars = case["engine"] == "compact"
+    model = CityModel(0, max_route_trees=case["max_route_trees"], compact=True,
+                      engine="agents" if compact_cars else case["engine"], compact_cars=compact_cars,
+                      map_file=case["map"], spawn_every=case["steps"] + 1, seed=case["seed"], workers=case["workers"])
+    construct_seconds = time.perf_counter() - start
+
+    fill_cars(model, case["cars"])
+    cars = model.get_car_count()
+    astar, route, contracted_route = time_routes(model, case["samples"])
+
+    start = time.perf_counter()
+    for _ in range(case["steps"]):
+        model.step()
+    step_seconds = time.perf_counter() - start
+    model.close()
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # The partitioned engine is measured against one process moving the same cars
+    baseline = batch_steps_per_second(case) if case["engine"] == "partitioned" else None
+
+    return dict(
+        case,
+        width=model.width,
+        height=model.height,
+        destinations=len(model.destinations),
+        cars_placed=cars,
+        compile_seconds=compile_seconds,
+        construct_seconds=construct_seconds,
+        astar_ms_per_car=astar,
+        route_ms_per_car=route,
+        contracted_ms_per_car=contracted_route,
+        steps_per_second=case["steps"] / step_seconds,
+        peak_rss_mb=peak_rss_mb,
+        batch_steps_per_second=baseline,
+        speedup=case["steps"] / step_seconds / baseline if baseline else None,
+    )
+
+def build_cases(base, tiles, cars, engines, workers, steps, samples, max_route_trees, seed):
+    """Generates the maps and returns the parameters of every case."""
+    cases = []
+    for size in tiles:
+        map_file = generate(base, size, size)
+        for car_count in cars:
+            for engine in engines:
+                cases.append({
+                    "map": map_file,
+                    "tiles": size,
+                    "cars": car_count,
+                    "engine": engine,
+                    "workers": workers,
+                    "steps": steps,
+                    "samples": samples,
+                    "max_route_trees": max_route_trees,
+                    "seed": seed,
+                })
+    return cases
+
+def case_key(result):
+    return (os.path.basename(result["map"]), result["cars"], result["engine"])
+
+def compare(previous, current, tolerance=0.2):
+    """
+    Returns the (case, metric, previous value, current value) of every measurement that got worse
+    by more than `tolerance` (a fraction) between two results files.
+    """
+    before = {case_key(result): result for result in previous["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = before.get(case_key(result))
+        if old is None:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if old.get(metric) is None or result.get(metric) is None:
+                continue
+            if metric in LOWER_IS_BETTER:
+                worse = result[metric] > old[metric] * (1 + tolerance)
+            else:
+                worse = result[metric] < old[metric] * (1 - tolerance)
+            if worse:
+                regressions.append((case_key(result), metric, old[metric], result[metric]))
+    return regressions
+
+def run_benchmarks(base="city_files/2024_base.txt", tiles=(1, 2, 4), cars=(100, 1000), engines=("agents", "batch"),
+                   steps=200, samples=50, max_route_trees=64, seed=0, output=None, workers=None):
+    """
+    Runs every case, each in a fresh process, and returns {"environment": {...}, "results": [...]}.
+    Args:
+        base: Base map tiled into the benchmark maps
+        tiles: Tiles per side of every map size
+        cars: Numbers of cars placed on the maps
+        engines: Engines to run ("agents", "compact" for the agents engine with compact cars, "batch", "partitioned")
+        steps: Steps timed per case
+        samples: Start/destination pairs timed for the route searches
+        max_route_trees: Route trees kept in memory by every model
+        seed: Seed of the models
+        output: Path of the JSON results file to write, if any
+        workers: Worker processes of the partitioned engine, the number of CPUs by default
+    """
+    import mesa
+    import numpy as np
+
+    results = []
+    for case in build_cases(base, tiles, cars, engines, workers, steps, samples, max_route_trees, seed):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_case, case).result()
+        speedup = f", {result['speedup']:.2f}x the batch engine" if result["speedup"] is not None else ""
+        print(f"{os.path.basename(result['map'])} {result['width']}x{result['height']} cars={result['cars_placed']} "
+              f"{result['engine']}: {result['steps_per_second']:.1f} steps/s, {result['peak_rss_mb']:.0f} MB{speedup}")
+        results.append(result)
+
+    benchmark = {
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "mesa": mesa.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if output is not None:
+        with open(output, "w") as resultsFile:
+            json.dump(benchmark, resultsFile, indent=2)
+    return benchmark
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CityModel on generated maps of growing size.")
+    parser.add_argument("--base", default="city_files/2024_base.txt", help="Base map to tile")
+    parser.add_argument("--tiles", nargs="+", type=int, default=[1, 2, 4], help="Tiles per side of every map size")
+    parser.add_argument("--cars", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--engines", nargs="+", choices=["agents", "compact", "batch", "partitioned"], default=["agents", "batch"])
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes of the partitioned engine")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--samples", type=int, default=50, help="Routes timed per case")
+    parser.add_argument("--max-route-trees", type=int, default=64, help="Route trees kept in memory by every model")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="Previous results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    benchmark = run_benchmarks(args.base, args.tiles, args.cars, args.engines, args.steps, args.samples,
+                               args.max_route_trees, args.seed, args.output, args.workers)
+    print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as previousFile:
+            regressions = compare(json.load(previousFile), benchmark, args.tolerance)
+        for (map_name, cars, engine), metric, old, new in regressions:
+            print(f"Regression {map_name} cars={cars} {engine}: {metric} {old:.4g} -> {new:.4g}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
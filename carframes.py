@@ -0,0 +1,126 @@
+"""
+Compact car snapshots for clients.
+
+A frame is a struct of arrays: integer car ids, x, z and direction codes (the
+index of the direction in roadgraph.DIRECTIONS: Up 0, Down 1, Left 2, Right 3),
+plus the ids of the cars that left the city. A frame is either full (every car)
+or a delta with only the cars that spawned, moved or despawned since a step.
+
+Binary layout, all little-endian:
+    header  "CARS", step uint32, flags uint32 (bit 0: full frame), count uint32, removed uint32
+    ids     uint32[count]
+    x       uint16[count]
+    z       uint16[count]
+    dir     uint8[count]
+    removed uint32[removed]
+"""
+from collections import deque
+import struct
+import numpy as np
+
+HEADER = struct.Struct("<4sIIII")
+MAGIC = b"CARS"
+FULL_FRAME = 1
+
+class CarChangeLog:
+    """
+    Ids of the cars that spawned or moved and of the cars that were removed, per step.
+    Only the last `history` steps with changes are kept; older requests get a full frame.
+    Args:
+        history: Number of steps with changes to keep
+    """
+    def __init__(self, history=256):
+        self.entries = deque(maxlen=history)
+        # First step whose changes are all still in the log
+        self.covered_from = 0
+
+    def _entry(self, step):
+        if not self.entries or self.entries[-1][0] != step:
+            if len(self.entries) == self.entries.maxlen:
+                self.covered_from = self.entries[0][0] + 1
+            self.entries.append((step, [], []))
+        return self.entries[-1]
+
+    def changed(self, step, car_ids):
+        """Records cars that spawned or moved during a step."""
+        self._entry(step)[1].extend(car_ids)
+
+    def removed(self, step, car_ids):
+        """Records cars that left the city during a step."""
+        self._entry(step)[2].extend(car_ids)
+
+    def since(self, step):
+        """
+        Returns (changed ids, removed ids) for every change made from the given step on,
+        or None when the log no longer goes back that far.
+        """
+        if step < self.covered_from:
+            return None
+        changed = set()
+        removed = set()
+        for entry_step, entry_changed, entry_removed in reversed(self.entries):
+            if entry_step < step:
+                break
+            changed.update(entry_changed)
+            removed.update(entry_removed)
+        return changed - removed, removed
+
+    def clear(self, step):
+        """Forgets every change, e.g. after the model state was replaced."""
+        self.entries.clear()
+        self.covered_from = step
+
+def car_frame(model, since=None):
+    """
+    Builds the frame of a model: every car, or only what changed since a step when the log allows it.
+    Returns a dict with step, full, ids, x, z, dir and removed arrays.
+    """
+    changes = model.car_changes.since(since) if since is not None else None
+    if changes is None:
+        ids, x, z, directions = model.get_car_arrays()
+        removed = np.empty(0, dtype=np.uint32)
+    else:
+        changed, removed = changes
+        ids, x, z, directions = model.get_car_arrays(sorted(changed))
+        removed = np.array(sorted(removed), dtype=np.uint32)
+    return {
+        "step": model.schedule.steps,
+        "full": changes is None,
+        "ids": ids,
+        "x": x,
+        "z": z,
+        "dir": directions,
+        "removed": removed,
+    }
+
+def encode_binary(frame):
+    """Packs a frame into the little-endian binary layout described above."""
+    flags = FULL_FRAME if frame["full"] else 0
+    return b"".join([
+        HEADER.pack(MAGIC, frame["step"], flags, frame["ids"].size, frame["removed"].size),
+        frame["ids"].astype("<u4").tobytes(),
+        frame["x"].astype("<u2").tobytes(),
+        frame["z"].astype("<u2").tobytes(),
+        frame["dir"].astype("u1").tobytes(),
+        frame["removed"].astype("<u4").tobytes(),
+    ])
+
+def decode_binary(data):
+    """Unpacks a binary frame, the inverse of encode_binary."""
+    magic, step, flags, count, removed = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a car frame")
+    offset = HEADER.size
+    arrays = {}
+    for name, dtype, size in (("ids", "<u4", count), ("x", "<u2", count), ("z", "<u2", count),
+                              ("dir", "u1", count), ("removed", "<u4", removed)):
+        arrays[name] = np.frombuffer(data, dtype=dtype, count=size, offset=offset)
+        offset += arrays[name].nbytes
+    return dict(arrays, step=step, full=bool(flags & FULL_FRAME))
+
+def frame_lists(frame):
+    """The frame with plain lists instead of arrays, for JSON or msgpack."""
+    return {
+        key: value.tolist() if isinstance(value, np.ndarray) else value
+        for key, value in frame.items()
+    }
@@ -0,0 +1,156 @@
+import numpy as np
+from roadgraph import DIRECTION_CODES, EMPTY, ROAD, TRAFFIC_LIGHT, DESTINATION, OBSTACLE
+
+# Map characters that describe roads
+ROAD_CHARACTERS = ["v", "^", ">", "<"]
+TRAFFIC_LIGHT_CHARACTERS = ["S", "s"]
+
+def index_dtype(count):
+    """Returns the smallest signed integer type able to hold indices up to count (and -1)."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if count <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+class CityLayer:
+    """
+    Static layer of the city stored as NumPy arrays indexed [x, y], like the MultiGrid.
+    Attributes:
+        cell_type: Kind of every cell (EMPTY, ROAD, TRAFFIC_LIGHT, DESTINATION, OBSTACLE)
+        road_direction: Heading code of every road cell, -1 elsewhere
+        light_index: Index of the traffic light on every cell, -1 elsewhere
+        light_state: Whether each traffic light is green
+        light_time: After how many steps each traffic light changes color
+        light_offset: Step of the first change of each traffic light, it changes on the steps equal to it modulo light_time
+        light_positions: (x, y) of each traffic light
+        destinations: (x, y) of each destination, in map order
+    """
+    def __init__(self, cell_type, road_direction, light_index, light_state, light_time, light_positions, destinations,
+                 light_offset=None):
+        self.cell_type = cell_type
+        self.road_direction = road_direction
+        self.light_index = light_index
+        self.light_state = light_state
+        self.light_time = light_time
+        self.light_offset = np.zeros_like(light_time) if light_offset is None else light_offset
+        self.light_positions = light_positions
+        self.destinations = destinations
+        self.width, self.height = cell_type.shape
+
+    @classmethod
+    def from_lines(cls, lines, dataDictionary):
+        """
+        Parses the lines of a map file.
+        Args:
+            lines: Rows of the map, top row first
+            dataDictionary: Contents of mapDictionary.json
+        """
+        width = len(lines[0].rstrip("\n"))
+        height = len(lines)
+        cell_type = np.full((width, height), EMPTY, dtype=np.uint8)
+        road_direction = np.full((width, height), -1, dtype=np.int8)
+        light_positions = []
+        light_state = []
+        light_time = []
+        destinations = []
+
+        for r, row in enumerate(lines):
+            y = height - r - 1
+            for c, col in enumerate(row.rstrip("\n")):
+                if col in ROAD_CHARACTERS:
+                    cell_type[c, y] = ROAD
+                    road_direction[c, y] = DIRECTION_CODES[dataDictionary[col]]
+                elif col in TRAFFIC_LIGHT_CHARACTERS:
+                    cell_type[c, y] = TRAFFIC_LIGHT
+                    light_positions.append((c, y))
+                    light_state.append(col != "S")
+                    light_time.append(int(dataDictionary[col]))
+                elif col == "#":
+                    cell_type[c, y] = OBSTACLE
+                elif col == "D":
+                    cell_type[c, y] = DESTINATION
+                    destinations.append((c, y))
+
+        light_index = np.full((width, height), -1, dtype=index_dtype(len(light_positions)))
+        for index, (x, y) in enumerate(light_positions):
+            light_index[x, y] = index
+
+        return cls(
+            cell_type,
+            road_direction,
+            light_index,
+            np.array(light_state, dtype=bool),
+            np.array(light_time, dtype=np.int32),
+            light_positions,
+            destinations,
+        )
+
+    def set_light_timings(self, timings):
+        """
+        Overrides the cycle length of the traffic lights, before the simulation starts.
+        Args:
+            timings: {"S": steps, "s": steps}, "S" lights start red and "s" lights start green
+        """
+        if "S" in timings:
+            self.light_time[~self.light_state] = int(timings["S"])
+        if "s" in timings:
+            self.light_time[self.light_state] = int(timings["s"])
+
+    def set_light_plan(self, lights):
+        """
+        Sets the cycle and offset of traffic lights, before the simulation starts. See lightplan.py.
+        Args:
+            lights: [{"position": [x, y], "period": steps, "offset": steps}, ...], the lights left out keep their timing.
+                A light with an offset is in the state the light without one was in `offset` steps earlier, so
+                offsets from period to 2 * period - 1 start it in the other color
+        """
+        for light in lights:
+            x, y = light["position"]
+            index = self.light_index[x, y] if 0 <= x < self.width and 0 <= y < self.height else -1
+            if index < 0:
+                raise ValueError(f"No traffic light at {(x, y)}")
+            period = int(light["period"])
+            if period < 1:
+                raise ValueError(f"Invalid period {period} of the traffic light at {(x, y)}")
+            offset = int(light.get("offset", 0)) % (2 * period)
+            self.light_time[index] = period
+            self.light_offset[index] = offset % period
+            if offset >= period:
+                self.light_state[index] = not self.light_state[index]
+
+    def is_road(self, pos):
+        return self.cell_type[pos] == ROAD
+
+    def is_destination(self, pos):
+        return self.cell_type[pos] == DESTINATION
+
+    def direction_at(self, pos):
+        """Returns the heading code of the road at a position, or -1."""
+        return int(self.road_direction[pos])
+
+    def light_at(self, pos):
+        """Returns the index of the traffic light at a position, or -1."""
+        return int(self.light_index[pos])
+
+    def is_red(self, pos):
+        """Whether there is a traffic light at the position and it is red."""
+        index = self.light_index[pos]
+        return index >= 0 and not self.light_state[index]
+
+    def steps_until_green(self, pos, step):
+        """Steps a car entering the position at a step would wait for the light, 0 when there is no red light."""
+        index = self.light_index[pos]
+        if index < 0 or self.light_state[index]:
+            return 0
+        period = int(self.light_time[index])
+        return period - (step - int(self.light_offset[index])) % period
+
+    def cells_of(self, kind):
+        """Returns the (x, y) positions of every cell of a kind, column by column."""
+        xs, ys = np.nonzero(self.cell_type == kind)
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    @property
+    def nbytes(self):
+        return (self.cell_type.nbytes + self.road_direction.nbytes + self.light_index.nbytes
+                + self.light_state.nbytes + self.light_time.nbytes + self.light_offset.nbytes)
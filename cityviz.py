@@ -0,0 +1,76 @@
+"""
+Mesa visualization element for large cities.
+
+CanvasGrid sends a portrayal dict for every cell of the city on every step,
+although only the cars and the light colors change. CityMapElement sends the
+static layout once per model, as one byte per cell, and then on every step only
+the lights that switched and a delta car frame (see carframes.py). The browser
+side, viz/CityMapModule.js, draws the city once on a background canvas and only
+redraws the cells that changed.
+
+Like the ModularServer it runs in, it assumes one viewer stepping the model: a
+second browser tab would miss the deltas sent to the first one until a reset.
+"""
+import base64
+import os
+import weakref
+import numpy as np
+from mesa.visualization import VisualizationElement
+from carframes import car_frame, frame_lists
+from roadgraph import ROAD, DESTINATION, OBSTACLE
+
+# Colors of the static cells, traffic lights are drawn green or red over them
+CELL_COLORS = {ROAD: "gray", DESTINATION: "lightgreen", OBSTACLE: "cadetblue"}
+
+class CityMapElement(VisualizationElement):
+    """
+    Canvas of the city that sends the static layers once and then only the changes of each step.
+    Args:
+        canvas_width: Width of the canvas in pixels
+        canvas_height: Height of the canvas in pixels
+    """
+    local_includes = ["CityMapModule.js"]
+    local_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "viz")
+
+    def __init__(self, canvas_width=500, canvas_height=500):
+        super().__init__()
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        self.js_code = f"elements.push(new CityMapModule({canvas_width}, {canvas_height}));"
+        # Model, step and light states of the last frame, to send the next one as a delta
+        self._model = None
+        self._step = None
+        self._lights = None
+
+    def render(self, model):
+        step = model.schedule.steps
+        lights = model.city.light_state.copy()
+        previous = self._model() if self._model is not None else None
+        if previous is not model or self._step is None or step <= self._step:
+            frame = self.full_frame(model)
+        else:
+            frame = {
+                "type": "delta",
+                "step": step,
+                "switched": np.flatnonzero(lights != self._lights).tolist(),
+                "cars": frame_lists(car_frame(model, self._step)),
+            }
+        self._model = weakref.ref(model)
+        self._step = step
+        self._lights = lights
+        return frame
+
+    def full_frame(self, model):
+        """The static layout, every light and every car: the first frame of a model, or after a reset."""
+        city = model.city
+        return {
+            "type": "full",
+            "step": model.schedule.steps,
+            "width": city.width,
+            "height": city.height,
+            "cells": base64.b64encode(city.cell_type.astype(np.uint8).tobytes()).decode(),
+            "colors": {str(kind): color for kind, color in CELL_COLORS.items()},
+            "light_positions": [[int(x), int(y)] for x, y in city.light_positions],
+            "lights": city.light_state.astype(int).tolist(),
+            "cars": frame_lists(car_frame(model)),
+        }
@@ -0,0 +1,467 @@
+"""
+Hierarchical routing graph for city-scale maps.
+
+Most states of a large map lie inside straight road runs, where a route can
+only go on along the road or change lane. ContractedGraph keeps the decision
+points, the states where routes can split or end (turns, traffic lights, the
+cells next to a destination and the destinations themselves), and replaces
+every run between two of them by one weighted edge that remembers the states
+it stands for.
+
+On top of that graph it builds a contraction hierarchy: the decision points
+are ranked, from the least to the most important one, and removing them in
+that order adds a shortcut edge wherever a shortest route went through the
+removed point. A query then only searches upwards in the ranking, forward
+from the start and backward from the goal, and meets in the middle: a few
+hundred decision points whatever the size of the map. The backward search of
+a goal does not depend on the start, so it is kept for the next queries to
+that goal. The route is expanded back into shortcuts, run edges and cells.
+
+Building the hierarchy of a large map takes a while, so load_contracted keeps
+it next to the compiled maps. Run this module to build it ahead of time:
+
+    python contraction.py city_files/generated/2024_10x10.txt
+"""
+from collections import OrderedDict
+from heapq import heappush, heappop
+import math
+import os
+import sys
+import numpy as np
+from roadgraph import DESTINATION, TRAFFIC_LIGHT
+from mapcache import CACHE_DIR, DICTIONARY_FILE, load_map, map_hash
+
+# Bump when the layout of the cached arrays changes, so old files are ignored
+FORMAT_VERSION = 1
+
+def run_search(successors, core, source):
+    """
+    Dijkstra from a state that only goes on through the states that are not decision points.
+    Returns {decision point: (cost, states crossed to reach it)} of the decision points it reached.
+    Args:
+        successors: (next state, cost) edges of every state, see RoadGraph.successors
+        core: Whether every state is a decision point
+        source: State to search from
+    """
+    distance = {source: 0.0}
+    came_from = {}
+    reached = {}
+    open_heap = [(0.0, source)]
+    while open_heap:
+        current_distance, current = heappop(open_heap)
+        if current_distance > distance[current]:
+            continue
+        if current != source and core[current]:
+            path = []
+            previous = came_from[current]
+            while previous != source:
+                path.append(previous)
+                previous = came_from[previous]
+            path.reverse()
+            reached[current] = (current_distance, path)
+            continue
+        for neighbor, cost in successors[current]:
+            new_distance = current_distance + cost
+            if new_distance < distance.get(neighbor, math.inf):
+                distance[neighbor] = new_distance
+                came_from[neighbor] = current
+                heappush(open_heap, (new_distance, neighbor))
+    return reached
+
+def contract(count, tails, heads, costs, settle_limit=60):
+    """
+    Ranks the nodes of a graph and adds the shortcuts of a contraction hierarchy.
+    The next node removed is the one adding the fewest shortcuts for the edges it removes, preferring the nodes
+    with fewer removed neighbours (lazy updates). A shortcut is skipped when a bounded search finds a route as
+    short without the removed node.
+    Args:
+        count: Number of nodes
+        tails, heads, costs: Edges of the graph, without parallel edges
+        settle_limit: Nodes settled by each of those searches before giving up and adding the shortcut
+    Returns the rank of every node and the shortcuts as (tail, head, cost, first edge, second edge), the edges being
+    numbered after the original ones.
+    """
+    outgoing = [dict() for _ in range(count)]
+    incoming = [dict() for _ in range(count)]
+    for edge, (tail, head, cost) in enumerate(zip(tails, heads, costs)):
+        outgoing[tail][head] = (cost, edge)
+        incoming[head][tail] = (cost, edge)
+    removed = [False] * count
+    depth = [0] * count
+    removed_neighbors = [0] * count
+    shortcuts = []
+    next_edge = len(tails)
+
+    def witness_distances(source, skipped, limit, targets):
+        """Distances from a node to the targets it reaches within limit without going through skipped."""
+        distance = {source: 0.0}
+        open_heap = [(0.0, source)]
+        remaining = set(targets)
+        settled = 0
+        while open_heap and remaining and settled < settle_limit:
+            current_distance, current = heappop(open_heap)
+            if current_distance > distance[current]:
+                continue
+            if current_distance > limit:
+                break
+            remaining.discard(current)
+            settled += 1
+            for neighbor, (cost, _) in outgoing[current].items():
+                if neighbor == skipped or removed[neighbor]:
+                    continue
+                new_distance = current_distance + cost
+                if new_distance < distance.get(neighbor, math.inf):
+                    distance[neighbor] = new_distance
+                    heappush(open_heap, (new_distance, neighbor))
+        return distance
+
+    def needed_shortcuts(node):
+        entering = [(tail, cost, edge) for tail, (cost, edge) in incoming[node].items() if not removed[tail]]
+        leaving = [(head, cost, edge) for head, (cost, edge) in outgoing[node].items() if not removed[head]]
+        needed = []
+        if not entering or not leaving:
+            return needed, len(entering) + len(leaving)
+        longest = max(cost for _, cost, _ in leaving)
+        for tail, tail_cost, tail_edge in entering:
+            distance = witness_distances(tail, node, tail_cost + longest, [head for head, _, _ in leaving])
+            for head, head_cost, head_edge in leaving:
+                if head != tail and distance.get(head, math.inf) > tail_cost + head_cost + 1e-9:
+                    needed.append((tail, head, tail_cost + head_cost, tail_edge, head_edge))
+        return needed, len(entering) + len(leaving)
+
+    def priority(node):
+        needed, degree = needed_shortcuts(node)
+        return 2 * (len(needed) - degree) + removed_neighbors[node] + depth[node], needed
+
+    queue = [(priority(node)[0], node) for node in range(count)]
+    queue.sort()
+    rank = [0] * count
+    order = 0
+    while queue:
+        _, node = heappop(queue)
+        current, needed = priority(node)
+        if queue and current > queue[0][0]:
+            heappush(queue, (current, node))
+            continue
+        for tail, head, cost, first, second in needed:
+            existing = outgoing[tail].get(head)
+            if existing is None or existing[0] > cost:
+                shortcuts.append((tail, head, cost, first, second))
+                outgoing[tail][head] = (cost, next_edge)
+                incoming[head][tail] = (cost, next_edge)
+                next_edge += 1
+        removed[node] = True
+        rank[node] = order
+        order += 1
+        for neighbor in list(incoming[node]) + list(outgoing[node]):
+            depth[neighbor] = max(depth[neighbor], depth[node] + 1)
+            removed_neighbors[neighbor] += 1
+    return rank, shortcuts
+
+class ContractedGraph:
+    """
+    Decision points of a RoadGraph, the run edges between them and the shortcuts of their contraction hierarchy.
+    Decision points are numbered in state order. The first edges are the run edges, the shortcuts come after them.
+    Args:
+        road_graph: Graph of the static map
+        core: Whether every state of the road graph is a decision point, as a boolean array
+        edge_tail: Decision point every edge leaves
+        edge_head: Decision point every edge leads to
+        edge_cost: Length of every edge
+        edge_children: The two edges every shortcut stands for, -1 for the run edges
+        via_start: Offset in via of the states inside every run edge, plus the total number of them
+        via: States crossed by the run edges, without their ends
+        rank: Rank of every decision point in the hierarchy
+        max_goals: Number of backward searches kept for the next queries to the same goal
+    """
+    def __init__(self, road_graph, core, edge_tail, edge_head, edge_cost, edge_children, via_start, via, rank, max_goals=4096):
+        self.road_graph = road_graph
+        self.core = core
+        self.core_states = np.flatnonzero(core)
+        self.core_index = np.full(road_graph.num_states, -1, dtype=np.int32)
+        self.core_index[self.core_states] = np.arange(self.core_states.size, dtype=np.int32)
+        self.edge_tail = edge_tail
+        self.edge_head = edge_head
+        self.edge_cost = edge_cost
+        self.edge_children = edge_children
+        self.via_start = via_start
+        self.via = via
+        self.rank = rank
+        self._core_list = core.tolist()
+        self._core_state_list = self.core_states.tolist()
+        self._upward = None
+        self._downward = None
+        self._unpacking = None
+        # Backward search of every recent goal cell, the least recently used one is dropped first
+        self.goal_searches = OrderedDict()
+        self.max_goals = max_goals
+        # Decision points reached by the forward search of the last query, for the profiler
+        self.last_expansions = 0
+
+    @staticmethod
+    def decision_points(road_graph):
+        """
+        States where a route can split, merge or end: traffic lights, destinations, the states with an edge into a
+        destination and the states with an edge from or to another heading.
+        """
+        kinds = road_graph.kinds
+        states = np.arange(road_graph.num_states)
+        sources = np.repeat(states, np.diff(road_graph.indptr))
+        targets = road_graph.indices
+        core = np.isin(kinds[states >> 2], (TRAFFIC_LIGHT, DESTINATION))
+        turns = (sources & 3) != (targets & 3)
+        core[sources[turns]] = True
+        core[targets[turns]] = True
+        core[sources[kinds[targets >> 2] == DESTINATION]] = True
+        return core
+
+    @classmethod
+    def from_graph(cls, road_graph):
+        """Contracts a road graph: one search from every decision point through its road run, then the hierarchy."""
+        core = cls.decision_points(road_graph)
+        core_index = np.full(road_graph.num_states, -1, dtype=np.int64)
+        core_states = np.flatnonzero(core)
+        core_index[core_states] = np.arange(core_states.size)
+        core_list = core.tolist()
+        successors = road_graph.successors
+
+        tails, heads, costs, via_start, via = [], [], [], [0], []
+        for number, state in enumerate(core_states.tolist()):
+            for target, (cost, path) in sorted(run_search(successors, core_list, state).items()):
+                tails.append(number)
+                heads.append(int(core_index[target]))
+                costs.append(cost)
+                via.extend(path)
+                via_start.append(len(via))
+
+        rank, shortcuts = contract(core_states.size, tails, heads, costs)
+        children = [(-1, -1)] * len(tails)
+        for tail, head, cost, first, second in shortcuts:
+            tails.append(tail)
+            heads.append(head)
+            costs.append(cost)
+            children.append((first, second))
+        return cls(road_graph, core, np.array(tails, dtype=np.int32), np.array(heads, dtype=np.int32),
+                   np.array(costs, dtype=np.float64), np.array(children, dtype=np.int32).reshape(-1, 2),
+                   np.array(via_start, dtype=np.int64), np.array(via, dtype=np.int64), np.array(rank, dtype=np.int32))
+
+    @property
+    def num_core_states(self):
+        return self.core_states.size
+
+    @property
+    def num_shortcuts(self):
+        return int((self.edge_children[:, 0] >= 0).sum())
+
+    @property
+    def nbytes(self):
+        return (self.core.nbytes + self.core_states.nbytes + self.core_index.nbytes + self.edge_tail.nbytes
+                + self.edge_head.nbytes + self.edge_cost.nbytes + self.edge_children.nbytes + self.via_start.nbytes
+                + self.via.nbytes + self.rank.nbytes)
+
+    def _adjacency(self):
+        """
+        The (next decision point, cost, edge) edges going up in rank from every decision point, and the
+        (previous decision point, cost, edge) edges coming down in rank into every decision point, built on first use.
+        """
+        if self._upward is None:
+            count = self.num_core_states
+            upward = [[] for _ in range(count)]
+            downward = [[] for _ in range(count)]
+            rank = self.rank.tolist()
+            for edge, (tail, head, cost) in enumerate(zip(self.edge_tail.tolist(), self.edge_head.tolist(), self.edge_cost.tolist())):
+                if rank[head] > rank[tail]:
+                    upward[tail].append((head, cost, edge))
+                else:
+                    downward[head].append((tail, cost, edge))
+            self._upward = [tuple(edges) for edges in upward]
+            self._downward = [tuple(edges) for edges in downward]
+            # Edge arrays as Python lists, faster than the arrays for expanding routes edge by edge
+            self._unpacking = (self.edge_tail.tolist(), self.edge_head.tolist(), self.edge_children.tolist(),
+                               self.via_start.tolist(), self.via.tolist())
+        return self._upward, self._downward
+
+    @staticmethod
+    def _search_up(edges, stall_edges, sources, bound=None):
+        """
+        Dijkstra going up in rank from the sources ({decision point: distance}), with stall-on-demand: a decision point
+        that a higher ranked one reaches faster is not expanded. Returns the distances, the edge each decision point
+        was reached by and the best meeting point, None without bound. With bound ({decision point: distance} of the
+        other direction), the search stops once no meeting point can improve.
+        """
+        distance = dict(sources)
+        parent = {}
+        open_heap = [(cost, node) for node, cost in sources.items()]
+        open_heap.sort()
+        best, meeting = math.inf, None
+        while open_heap:
+            current_distance, current = heappop(open_heap)
+            if current_distance > distance[current]:
+                continue
+            if bound is not None:
+                if current_distance >= best:
+                    break
+                other = bound.get(current)
+                if other is not None and current_distance + other < best:
+                    best, meeting = current_distance + other, current
+            stalled = False
+            for higher, cost, _ in stall_edges[current]:
+                if distance.get(higher, math.inf) + cost < current_distance:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+            for neighbor, cost, edge in edges[current]:
+                new_distance = current_distance + cost
+                if new_distance < distance.get(neighbor, math.inf):
+                    distance[neighbor] = new_distance
+                    parent[neighbor] = edge
+                    heappush(open_heap, (new_distance, neighbor))
+        return distance, parent, meeting
+
+    def _goal_search(self, goal_cell):
+        """Backward search from the decision points of a goal cell, kept for the next queries to the same goal."""
+        search = self.goal_searches.get(goal_cell)
+        if search is None:
+            upward, downward = self._adjacency()
+            goals = {core: 0.0 for core in self.core_index[goal_cell * 4:goal_cell * 4 + 4].tolist() if core >= 0}
+            distance, parent, _ = self._search_up(downward, upward, goals)
+            search = (distance, parent)
+            self.goal_searches[goal_cell] = search
+            if len(self.goal_searches) > self.max_goals:
+                self.goal_searches.popitem(last=False)
+        else:
+            self.goal_searches.move_to_end(goal_cell)
+        return search
+
+    def path(self, start, direction, goal):
+        """
+        Shortest route from a position and heading to a goal position, like RoadGraph.a_star.
+        Returns the list of positions to visit (without the start), or an empty list if the goal is unreachable.
+        """
+        graph = self.road_graph
+        start_state = graph.state(start, direction)
+        if start_state >> 2 == graph.cell(goal):
+            return []
+        height = graph.height
+        return [divmod(state >> 2, height) for state in self.route_states({start_state: (0.0, [])}, goal)]
+
+    def route_states(self, starts, goal):
+        """
+        Shortest route to a goal position from the best of several start states, in one query.
+        Args:
+            starts: {state: (cost already paid to reach it, states visited to reach it, itself included)}
+            goal: Goal position
+        Returns the visited states of the best start followed by the states from there to the goal,
+        or an empty list if the goal is unreachable from every start.
+        """
+        graph = self.road_graph
+        goal_distance, goal_parent = self._goal_search(graph.cell(goal))
+        if not goal_distance:
+            return []
+
+        # Entries: the decision points reached along the run of every start, with the states visited to get there.
+        # A start on a decision point is its own entry
+        sources = {}
+        crossed = {}
+        for state, (paid, visited) in starts.items():
+            if self._core_list[state]:
+                reached = {state: (0.0, None)}
+            else:
+                reached = run_search(graph.successors, self._core_list, state)
+            for core_state, (cost, states) in reached.items():
+                entry = self.core_index.item(core_state)
+                if paid + cost < sources.get(entry, math.inf):
+                    sources[entry] = paid + cost
+                    crossed[entry] = visited if states is None else visited + states + [core_state]
+
+        upward, downward = self._adjacency()
+        distance, parent, meeting = self._search_up(upward, downward, sources, goal_distance)
+        self.last_expansions = len(distance)
+        if meeting is None:
+            return []
+
+        # Edges from the entry up to the meeting point, then down to the goal
+        tails, heads, children, via_start, via = self._unpacking
+        edges = []
+        node = meeting
+        while node in parent:
+            edge = parent[node]
+            edges.append(edge)
+            node = tails[edge]
+        edges.reverse()
+        states = list(crossed[node])
+        node = meeting
+        while node in goal_parent:
+            edge = goal_parent[node]
+            edges.append(edge)
+            node = heads[edge]
+
+        # Shortcuts stand for their two edges, run edges for the states they cross and their head
+        stack = edges[::-1]
+        while stack:
+            edge = stack.pop()
+            first, second = children[edge]
+            if first >= 0:
+                stack.append(second)
+                stack.append(first)
+            else:
+                states.extend(via[via_start[edge]:via_start[edge + 1]])
+                states.append(self._core_state_list[heads[edge]])
+        return states
+
+def contracted_cache_path(map_file, dictionary_file=DICTIONARY_FILE, cache_dir=CACHE_DIR):
+    name = os.path.splitext(os.path.basename(map_file))[0]
+    return os.path.join(cache_dir, f"{name}-{map_hash(map_file, dictionary_file)[:16]}-contracted-v{FORMAT_VERSION}.npz")
+
+def save_contracted(contracted, path):
+    """Writes the arrays of a contracted graph to an .npz file, atomically so concurrent runs never read half a file."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        np.savez(
+            file,
+            core=contracted.core,
+            edge_tail=contracted.edge_tail,
+            edge_head=contracted.edge_head,
+            edge_cost=contracted.edge_cost,
+            edge_children=contracted.edge_children,
+            via_start=contracted.via_start,
+            via=contracted.via,
+            rank=contracted.rank,
+        )
+    os.replace(temporary, path)
+
+def read_contracted(path, road_graph):
+    """Reads a contracted graph written by save_contracted, for the road graph it was built from."""
+    with np.load(path) as data:
+        return ContractedGraph(road_graph, data["core"], data["edge_tail"], data["edge_head"], data["edge_cost"],
+                               data["edge_children"], data["via_start"], data["via"], data["rank"])
+
+def load_contracted(map_file, road_graph, dictionary_file=DICTIONARY_FILE, cache_dir=CACHE_DIR):
+    """
+    Returns the contracted graph of a map, from the cache when it was already built.
+    Args:
+        map_file: Path of the map
+        road_graph: Road graph of the map
+        dictionary_file: Path of the map dictionary
+        cache_dir: Directory of the cache files, None to always build it
+    """
+    if cache_dir is None:
+        return ContractedGraph.from_graph(road_graph)
+
+    path = contracted_cache_path(map_file, dictionary_file, cache_dir)
+    if os.path.exists(path):
+        try:
+            return read_contracted(path, road_graph)
+        except (OSError, KeyError, ValueError):
+            pass  # Unreadable cache file, build it again
+
+    contracted = ContractedGraph.from_graph(road_graph)
+    save_contracted(contracted, path)
+    return contracted
+
+if __name__ == "__main__":
+    for map_file in sys.argv[1:]:
+        load_contracted(map_file, load_map(map_file).road_graph)
+        print(f"{map_file} -> {contracted_cache_path(map_file)}")
@@ -0,0 +1,303 @@
+"""
+Traffic light timing plans and their optimizer.
+
+The lights of a map toggle every "S" or "s" steps of mapDictionary.json, all
+on the same steps. A timing plan gives every light its own period (steps per
+color) and offset, and CityModel(..., light_plan=...) loads it. The optimizer
+searches the period and offset of every intersection, the lights of touching
+cells, which share them so the crossing roads alternate.
+
+Candidates are scored by short headless simulations on a process pool, and
+the evaluations are kept as few as possible:
+
+- Common random numbers: every candidate runs with the same seeds, so the
+  score differences come from the timings and not from the cars spawned.
+- Racing: every candidate runs the first seed, and after each seed only the
+  best 1/eta of them run the next one, so bad candidates stop early.
+- A run stops once no car has arrived for stall_steps steps, a gridlocked
+  city rarely recovers and the rest of the run would not change its score.
+- Runs are memoized, so the best candidates kept from one generation to the
+  next are not run again.
+
+The first generation holds the map's own timings, uniform periods and green
+waves along each heading; the next ones mutate the best candidates. Example:
+
+    python lightplan.py --map 2024 --cars 4 --spawn-every 2 --steps 300 --output plans/2024.json
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import time
+from mapcache import load_map, map_path
+from roadgraph import DIRECTIONS, DIRECTION_CODES, ROAD
+
+def read_light_plan(path):
+    """Reads a timing plan written by write_light_plan."""
+    with open(path) as planFile:
+        plan = json.load(planFile)
+    if "lights" not in plan:
+        raise ValueError(f"{path} is not a traffic light plan")
+    return plan
+
+def write_light_plan(plan, path):
+    """Writes a timing plan as JSON, atomically so a model never loads half a plan."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as planFile:
+        json.dump(plan, planFile, indent=2)
+    os.replace(temporary, path)
+
+def intersections(layer):
+    """Groups the traffic lights of a city layer by intersection: lights on touching cells, diagonals included."""
+    index_at = {position: index for index, position in enumerate(layer.light_positions)}
+    groups = []
+    seen = set()
+    for start in range(len(layer.light_positions)):
+        if start in seen:
+            continue
+        seen.add(start)
+        group = [start]
+        for index in group:
+            x, y = layer.light_positions[index]
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbor = index_at.get((x + dx, y + dy))
+                    if neighbor is not None and neighbor not in seen:
+                        seen.add(neighbor)
+                        group.append(neighbor)
+        groups.append(sorted(group))
+    return groups
+
+def light_axis(layer, index):
+    """Whether a traffic light stops the cars of a horizontal road ("horizontal") or of a vertical one ("vertical")."""
+    x, y = layer.light_positions[index]
+    for nx in (x - 1, x + 1):
+        if 0 <= nx < layer.width and layer.cell_type[nx, y] == ROAD and layer.direction_at((nx, y)) in (DIRECTION_CODES["Left"], DIRECTION_CODES["Right"]):
+            return "horizontal"
+    return "vertical"
+
+def baseline_candidate(layer):
+    """The map's own timings, as a candidate: one (period, offset) per light."""
+    return tuple((int(period), 0) for period in layer.light_time)
+
+def group_candidate(layer, groups, timings):
+    """Candidate giving the lights of every intersection its (period, offset) of timings, in the order of groups."""
+    lights = [None] * len(layer.light_positions)
+    for group, timing in zip(groups, timings):
+        for index in group:
+            lights[index] = timing
+    return tuple(lights)
+
+def green_wave(layer, groups, period, heading):
+    """
+    Candidate where a car driving towards a heading at one cell per step meets every light of its road green.
+    Args:
+        layer: City layer, with the light states of the map
+        groups: Intersections, see intersections()
+        period: Steps per color of every light
+        heading: "Up", "Down", "Left" or "Right"
+    """
+    axis = "horizontal" if heading in ("Left", "Right") else "vertical"
+    timings = []
+    for group in groups:
+        # Distance a car driving towards the heading has covered when it reaches the intersection
+        x = round(statistics.mean(layer.light_positions[index][0] for index in group))
+        y = round(statistics.mean(layer.light_positions[index][1] for index in group))
+        distance = {"Right": x, "Left": layer.width - 1 - x, "Up": y, "Down": layer.height - 1 - y}[heading]
+        # A light that starts red is green from its offset on, one that starts green from offset + period on
+        facing = [index for index in group if light_axis(layer, index) == axis] or group
+        starts_green = bool(layer.light_state[facing[0]])
+        timings.append((period, (distance - (period if starts_green else 0)) % (2 * period)))
+    return group_candidate(layer, groups, timings)
+
+def initial_candidates(layer, groups, periods):
+    """The first generation: the map's timings, every uniform period and the green waves along every heading."""
+    candidates = [baseline_candidate(layer)]
+    for period in periods:
+        candidates.append(group_candidate(layer, groups, [(period, 0)] * len(groups)))
+        for heading in DIRECTIONS:
+            candidates.append(green_wave(layer, groups, period, heading))
+    return list(dict.fromkeys(candidates))
+
+def mutate(candidate, groups, periods, rng, rate=0.3):
+    """Returns a copy of a candidate with the period or offset of some intersections changed, at least one."""
+    lights = list(candidate)
+    forced = rng.randrange(len(groups))
+    for number, group in enumerate(groups):
+        if number != forced and rng.random() >= rate:
+            continue
+        period, offset = lights[group[0]]
+        if rng.random() < 0.5:
+            # Another period, at the same point of the cycle
+            new_period = rng.choice(periods)
+            offset = round(offset * new_period / period) % (2 * new_period)
+            period = new_period
+        else:
+            shift = rng.randint(1, max(1, period // 2))
+            offset = (offset + rng.choice((-shift, shift))) % (2 * period)
+        for index in group:
+            lights[index] = (period, offset)
+    return tuple(lights)
+
+def plan_lights(layer, candidate):
+    """Lights of a timing plan, as set by CityLayer.set_light_plan."""
+    return [{"position": [int(x), int(y)], "period": period, "offset": offset}
+            for (x, y), (period, offset) in zip(layer.light_positions, candidate)]
+
+def run_candidate(task):
+    """
+    Runs one candidate with one seed and returns its results. Top-level so the process pool can pickle it.
+    Args:
+        task: Dictionary with map_file, N, spawn_every, steps, engine, stall_steps, delay_weight, seed and lights
+    """
+    from model import CityModel
+
+    model = CityModel(
+        task["N"],
+        compact=True,
+        engine=task["engine"],
+        map_file=task["map_file"],
+        spawn_every=task["spawn_every"],
+        light_plan={"lights": task["lights"]},
+        seed=task["seed"],
+    )
+    last_arrival = 0
+    reached = 0
+    steps = 0
+    while steps < task["steps"]:
+        model.step()
+        steps += 1
+        if model.cars_reached_destination > reached:
+            reached = model.cars_reached_destination
+            last_arrival = steps
+        elif steps - last_arrival >= task["stall_steps"] and model.get_car_count() > 0:
+            break
+
+    light_wait_mean = model.get_trip_stats()["light_wait"]["mean"]
+    return {
+        "score": reached - task["delay_weight"] * light_wait_mean,
+        "cars_reached": reached,
+        "light_wait_mean": light_wait_mean,
+        "steps": steps,
+    }
+
+def race(pool, candidates, seeds, settings, eta, runs, layer):
+    """
+    Scores candidates by successive halving over the seeds.
+    Returns [(mean score, candidate)] of the candidates that ran every seed, best first.
+    Args:
+        pool: Process pool running the simulations
+        candidates: Candidates to compare
+        seeds: Seeds every candidate runs with, in order
+        settings: Simulation settings of run_candidate
+        eta: After each seed, the best 1/eta of the candidates run the next one
+        runs: Results of the runs already done, keyed by (candidate, seed), updated in place
+        layer: City layer of the map, for the positions of the lights
+    """
+    survivors = list(dict.fromkeys(candidates))
+
+    def mean_score(candidate, count):
+        return statistics.mean(runs[candidate, seed]["score"] for seed in seeds[:count])
+
+    for count, seed in enumerate(seeds, start=1):
+        pending = [candidate for candidate in survivors if (candidate, seed) not in runs]
+        tasks = [dict(settings, seed=seed, lights=plan_lights(layer, candidate)) for candidate in pending]
+        for candidate, result in zip(pending, pool.map(run_candidate, tasks)):
+            runs[candidate, seed] = result
+        # Stable sort, ties keep the earlier candidate
+        survivors.sort(key=lambda candidate: -mean_score(candidate, count))
+        if count < len(seeds):
+            survivors = survivors[:max(2, math.ceil(len(survivors) / eta))]
+    return [(mean_score(candidate, len(seeds)), candidate) for candidate in survivors]
+
+def optimize(map_name="2024", N=4, spawn_every=4, steps=300, replicates=4, periods=(4, 6, 8, 10, 12, 15), generations=3,
+             population=16, elite=4, eta=2, stall_steps=100, delay_weight=1.0, engine="agents", seed=0, workers=None):
+    """
+    Searches the traffic light timings of a map and returns the best timing plan found.
+    Args:
+        map_name: Map year or map file path
+        N: Initial number of cars
+        spawn_every: Steps between two waves of spawned cars
+        steps: Steps of every simulation
+        replicates: Seeds every candidate that survives the racing runs with
+        periods: Periods (steps per color) to choose from
+        generations: Generations after the first one, which mutate the best candidates of the previous one
+        population: Candidates of every generation after the first one
+        elite: Best candidates kept from one generation to the next
+        eta: After each seed only the best 1/eta of the candidates run the next one
+        stall_steps: Stop a simulation when no car has arrived for this many steps
+        delay_weight: Score of a run is the number of cars that arrived minus delay_weight times their mean red light wait
+        engine: "agents" or "batch"
+        seed: Seed of the simulations (seed, seed + 1...) and of the mutations
+        workers: Number of processes (defaults to every core)
+    """
+    map_file = map_path(map_name)
+    layer = load_map(map_file).layer
+    groups = intersections(layer)
+    seeds = [seed + replicate for replicate in range(replicates)]
+    settings = {"map_file": map_file, "N": N, "spawn_every": spawn_every, "steps": steps, "engine": engine,
+                "stall_steps": stall_steps, "delay_weight": delay_weight}
+    rng = random.Random(seed)
+    runs = {}
+    baseline = baseline_candidate(layer)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        ranked = race(pool, [baseline] + initial_candidates(layer, groups, periods), seeds, settings, eta, runs, layer)
+        for _ in range(generations):
+            if not groups:
+                break
+            parents = [candidate for _, candidate in ranked[:elite]]
+            children = [mutate(rng.choice(parents), groups, periods, rng) for _ in range(population - len(parents))]
+            ranked = race(pool, parents + children, seeds, settings, eta, runs, layer)
+        # The baseline is run with every seed to report the improvement
+        race(pool, [baseline], seeds, settings, eta, runs, layer)
+
+    score, best = ranked[0]
+    best_runs = [runs[best, seed] for seed in seeds]
+    return {
+        "map": map_file,
+        "settings": dict(settings, seeds=seeds),
+        "score": score,
+        "baseline_score": statistics.mean(runs[baseline, seed]["score"] for seed in seeds),
+        "cars_reached_mean": statistics.mean(run["cars_reached"] for run in best_runs),
+        "light_wait_mean": statistics.mean(run["light_wait_mean"] for run in best_runs),
+        "evaluations": len(runs),
+        "seconds": time.perf_counter() - start,
+        "intersections": groups,
+        "lights": plan_lights(layer, best),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimize the traffic light timings of a city map.")
+    parser.add_argument("--map", default="2024", help="Map year or map file path")
+    parser.add_argument("--cars", type=int, default=4, help="Initial number of cars")
+    parser.add_argument("--spawn-every", type=int, default=4, help="Steps between spawn waves")
+    parser.add_argument("--steps", type=int, default=300, help="Steps of every simulation")
+    parser.add_argument("--replicates", type=int, default=4, help="Seeds of the candidates that survive the racing")
+    parser.add_argument("--periods", nargs="+", type=int, default=[4, 6, 8, 10, 12, 15], help="Steps per color to choose from")
+    parser.add_argument("--generations", type=int, default=3)
+    parser.add_argument("--population", type=int, default=16)
+    parser.add_argument("--elite", type=int, default=4)
+    parser.add_argument("--eta", type=float, default=2, help="Keep the best 1/eta of the candidates after each seed")
+    parser.add_argument("--stall-steps", type=int, default=100, help="Stop a run when no car arrived for this many steps")
+    parser.add_argument("--delay-weight", type=float, default=1.0, help="Score penalty per step of mean red light wait")
+    parser.add_argument("--engine", choices=["agents", "batch"], default="agents")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: all cores)")
+    parser.add_argument("--output", default="plans/plan.json")
+    args = parser.parse_args()
+
+    plan = optimize(args.map, args.cars, args.spawn_every, args.steps, args.replicates, args.periods, args.generations,
+                    args.population, args.elite, args.eta, args.stall_steps, args.delay_weight, args.engine, args.seed,
+                    args.workers)
+    write_light_plan(plan, args.output)
+    print(f"Score {plan['score']:.1f} (map timings {plan['baseline_score']:.1f}) after {plan['evaluations']} runs "
+          f"in {plan['seconds']:.1f}s, plan written to {args.output}")
+
+if __name__ == "__main__":
+    main()
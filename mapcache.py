@@ -0,0 +1,150 @@
+"""
+Compiled map cache.
+
+Parsing a map, compiling its road graph and building its route trees is done
+once per map content; the result is stored as an .npz file named after the
+hash of the map and of mapDictionary.json and the number of precomputed route
+trees, and later loads read that file.
+Run this module to compile maps ahead of time:
+
+    python mapcache.py city_files/2024_base.txt
+"""
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+from citylayer import CityLayer
+from roadgraph import RoadGraph
+from routes import RouteTrees
+
+DICTIONARY_FILE = "city_files/mapDictionary.json"
+CACHE_DIR = "city_files/.cache"
+
+# Bump when the layout of the cached arrays changes, so old files are ignored
+FORMAT_VERSION = 1
+
+class CompiledMap:
+    """
+    Everything a CityModel needs from a map file.
+    Attributes:
+        layer: Static city layer
+        road_graph: Road graph compiled from the layer
+        routes: Next-hop arrays of the precomputed route trees, keyed by destination position
+    """
+    def __init__(self, layer, road_graph, routes):
+        self.layer = layer
+        self.road_graph = road_graph
+        self.routes = routes
+
+    @property
+    def width(self):
+        return self.layer.width
+
+    @property
+    def height(self):
+        return self.layer.height
+
+def map_path(map_name):
+    """Accepts either a map year (2021-2024) or the path of a map file."""
+    if os.path.exists(map_name):
+        return map_name
+    return f"city_files/{map_name}_base.txt"
+
+def map_hash(map_file, dictionary_file=DICTIONARY_FILE):
+    """Hash of the contents of a map and of the dictionary used to read it."""
+    digest = hashlib.sha256(f"v{FORMAT_VERSION}".encode())
+    for path in (map_file, dictionary_file):
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def cache_path(map_file, dictionary_file=DICTIONARY_FILE, cache_dir=CACHE_DIR, max_routes=64):
+    """Path of the cache file of a map, one per number of precomputed route trees."""
+    name = os.path.splitext(os.path.basename(map_file))[0]
+    routes = "all" if max_routes is None else max_routes
+    return os.path.join(cache_dir, f"{name}-{map_hash(map_file, dictionary_file)[:16]}-routes{routes}.npz")
+
+def compile_map(map_file, dictionary_file=DICTIONARY_FILE, max_routes=64):
+    """Parses a map file and compiles its road graph and the route trees of its first max_routes destinations."""
+    with open(dictionary_file) as dictionaryFile:
+        dataDictionary = json.load(dictionaryFile)
+    with open(map_file) as baseFile:
+        lines = baseFile.readlines()
+
+    layer = CityLayer.from_lines(lines, dataDictionary)
+    road_graph = RoadGraph.from_layer(layer)
+    routes = RouteTrees(road_graph, max_trees=max_routes)
+    routes.precompute(layer.destinations)
+    return CompiledMap(layer, road_graph, dict(routes.trees))
+
+def save_map(compiled, path):
+    """Writes a compiled map to an .npz file, atomically so concurrent runs never read half a file."""
+    layer = compiled.layer
+    graph = compiled.road_graph
+    goals = list(compiled.routes)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        np.savez(
+            file,
+            cell_type=layer.cell_type,
+            road_direction=layer.road_direction,
+            light_index=layer.light_index,
+            light_state=layer.light_state,
+            light_time=layer.light_time,
+            light_positions=np.array(layer.light_positions, dtype=np.int32).reshape(-1, 2),
+            destinations=np.array(layer.destinations, dtype=np.int32).reshape(-1, 2),
+            graph_indptr=graph.indptr,
+            graph_indices=graph.indices,
+            graph_costs=graph.costs,
+            route_goals=np.array(goals, dtype=np.int32).reshape(-1, 2),
+            route_next_hop=np.stack([compiled.routes[goal] for goal in goals]) if goals else np.empty((0, graph.num_states), dtype=np.int32),
+        )
+    os.replace(temporary, path)
+
+def read_map(path):
+    """Reads a compiled map written by save_map."""
+    with np.load(path) as data:
+        layer = CityLayer(
+            data["cell_type"],
+            data["road_direction"],
+            data["light_index"],
+            data["light_state"],
+            data["light_time"],
+            [tuple(position) for position in data["light_positions"].tolist()],
+            [tuple(position) for position in data["destinations"].tolist()],
+        )
+        road_graph = RoadGraph(layer.width, layer.height, layer.cell_type.ravel(),
+                               data["graph_indptr"], data["graph_indices"], data["graph_costs"])
+        next_hop = data["route_next_hop"]
+        routes = {tuple(goal): next_hop[index] for index, goal in enumerate(data["route_goals"].tolist())}
+    return CompiledMap(layer, road_graph, routes)
+
+def load_map(map_file, dictionary_file=DICTIONARY_FILE, max_routes=64, cache_dir=CACHE_DIR):
+    """
+    Returns the compiled map of a map file, from the cache when its contents were already compiled.
+    Args:
+        map_file: Path of the map
+        dictionary_file: Path of the map dictionary
+        max_routes: Number of route trees to precompute when compiling
+        cache_dir: Directory of the cache files, None to always compile
+    """
+    if cache_dir is None:
+        return compile_map(map_file, dictionary_file, max_routes)
+
+    path = cache_path(map_file, dictionary_file, cache_dir, max_routes)
+    if os.path.exists(path):
+        try:
+            return read_map(path)
+        except (OSError, KeyError, ValueError):
+            pass  # Unreadable cache file, compile it again
+
+    compiled = compile_map(map_file, dictionary_file, max_routes)
+    save_map(compiled, path)
+    return compiled
+
+if __name__ == "__main__":
+    for map_file in sys.argv[1:]:
+        load_map(map_file)
+        print(f"{map_file} -> {cache_path(map_file)}")
@@ -0,0 +1,88 @@
+"""
+Procedural large maps built from the hand-drawn bases in city_files.
+
+A generated map tiles a base map `columns` x `rows` times. Every other tile is
+mirrored, left-right in odd columns and top-bottom in odd rows, with the road
+arrows flipped to match: the ring road around a base runs counter-clockwise,
+so side by side two copies would meet with opposite lanes, while a mirrored
+copy brings lanes going the same way next to each other. The joined lanes let
+cars change over to the neighbouring tile like on any multi-lane road, so the
+whole map is one connected city. Example:
+
+    python mapgen.py city_files/2024_base.txt --tiles 4 4 --output city_files/generated/2024_4x4.txt
+"""
+import argparse
+import os
+
+# Characters swapped when a tile is mirrored
+HORIZONTAL_SWAP = str.maketrans("<>", "><")
+VERTICAL_SWAP = str.maketrans("^v", "v^")
+
+def read_rows(map_file):
+    """Returns the rows of a map file, top row first, without line endings."""
+    with open(map_file) as baseFile:
+        return [line.rstrip("\n") for line in baseFile if line.strip()]
+
+def mirror_horizontal(rows):
+    """Mirrors a map left-right."""
+    return [row[::-1].translate(HORIZONTAL_SWAP) for row in rows]
+
+def mirror_vertical(rows):
+    """Mirrors a map top-bottom."""
+    return [row.translate(VERTICAL_SWAP) for row in reversed(rows)]
+
+def tile_map(rows, columns, tile_rows):
+    """
+    Tiles a map, mirroring the tiles in odd columns left-right and the tiles in odd rows top-bottom.
+    Args:
+        rows: Rows of the base map, top row first
+        columns: Number of tiles from left to right
+        tile_rows: Number of tiles from top to bottom
+    """
+    if columns < 1 or tile_rows < 1:
+        raise ValueError("A map needs at least one tile")
+    variants = {}
+    for flip_x in (False, True):
+        for flip_y in (False, True):
+            tile = mirror_horizontal(rows) if flip_x else list(rows)
+            variants[flip_x, flip_y] = mirror_vertical(tile) if flip_y else tile
+
+    output = []
+    for tile_y in range(tile_rows):
+        tiles = [variants[tile_x % 2 == 1, tile_y % 2 == 1] for tile_x in range(columns)]
+        for line in zip(*tiles):
+            output.append("".join(line))
+    return output
+
+def generated_path(base_file, columns, tile_rows, directory="city_files/generated"):
+    name = os.path.splitext(os.path.basename(base_file))[0].replace("_base", "")
+    return os.path.join(directory, f"{name}_{columns}x{tile_rows}.txt")
+
+def generate(base_file, columns, tile_rows, output=None):
+    """
+    Writes a tiled map and returns its path.
+    Args:
+        base_file: Map file to tile
+        columns: Number of tiles from left to right
+        tile_rows: Number of tiles from top to bottom
+        output: Path of the generated map, city_files/generated/<base>_<columns>x<rows>.txt by default
+    """
+    output = output or generated_path(base_file, columns, tile_rows)
+    rows = tile_map(read_rows(base_file), columns, tile_rows)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as mapFile:
+        mapFile.write("\n".join(rows) + "\n")
+    return output
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a large map by tiling a base map.")
+    parser.add_argument("base", help="Base map file, e.g. city_files/2024_base.txt")
+    parser.add_argument("--tiles", nargs=2, type=int, default=[2, 2], metavar=("COLUMNS", "ROWS"))
+    parser.add_argument("--output", default=None, help="Path of the generated map")
+    args = parser.parse_args()
+
+    path = generate(args.base, args.tiles[0], args.tiles[1], args.output)
+    print(f"Wrote {path}")
+
+if __name__ == "__main__":
+    main()
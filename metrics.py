@@ -0,0 +1,179 @@
+"""
+Bounded metrics of a CityModel.
+
+Mesa's DataCollector keeps every collected value in Python lists for the
+whole run. MetricsCollector keeps only the last `capacity` steps in a NumPy
+ring buffer and, when given a directory, spills the full time series to it
+in chunks of `chunk_size` steps, one .npz file per chunk with one array per
+column. TripStats aggregates the travel time and the time spent at red
+lights of every car that arrived, in constant memory.
+"""
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+
+class RunningStats:
+    """
+    Count, mean, variance, min, max and histogram of a stream of values, in constant memory.
+    Args:
+        bin_width: Width of the histogram bins
+        bins: Number of bins, the last one also counts every larger value
+    """
+    def __init__(self, bin_width=8, bins=64):
+        self.bin_width = bin_width
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    def add_many(self, values):
+        """Merges a batch of values (Chan et al. parallel variance update)."""
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        count = self.count + values.size
+        mean = float(values.mean())
+        delta = mean - self.mean
+        self.m2 += float(((values - mean) ** 2).sum()) + delta * delta * self.count * values.size / count
+        self.mean += delta * values.size / count
+        self.count = count
+        self.min = float(values.min()) if self.min is None else min(self.min, float(values.min()))
+        self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+        bins = np.minimum(values // self.bin_width, self.histogram.size - 1).astype(np.int64)
+        self.histogram += np.bincount(bins, minlength=self.histogram.size)
+
+    def add(self, value):
+        self.add_many([value])
+
+    @property
+    def std(self):
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std,
+            "min": self.min,
+            "max": self.max,
+            "bin_width": self.bin_width,
+            "histogram": self.histogram.tolist(),
+        }
+
+class TripStats:
+    """Travel time and red light wait time, in steps, of the cars that reached their destination."""
+    def __init__(self):
+        self.travel_time = RunningStats()
+        self.light_wait = RunningStats(bin_width=2)
+
+    def add(self, travel_time, light_wait):
+        """Records one finished trip."""
+        self.travel_time.add(travel_time)
+        self.light_wait.add(light_wait)
+
+    def add_many(self, travel_times, light_waits):
+        """Records a batch of finished trips, as arrays."""
+        self.travel_time.add_many(travel_times)
+        self.light_wait.add_many(light_waits)
+
+    def summary(self):
+        return {"travel_time": self.travel_time.summary(), "light_wait": self.light_wait.summary()}
+
+class MetricsCollector:
+    """
+    Collects model-level reporters once per step into a ring buffer, spilling the full series to disk.
+    Args:
+        model_reporters: Column name -> callable returning the value for the current step
+        capacity: Number of recent steps kept in memory
+        spill_dir: Directory of the on-disk chunks, None to only keep the recent steps. Must be empty or not exist
+            yet: the collector claims it with a columns.json file, so another run never overwrites its chunks
+        chunk_size: Steps per on-disk chunk
+    """
+    def __init__(self, model_reporters, capacity=1024, spill_dir=None, chunk_size=4096):
+        self.reporters = model_reporters
+        self.columns = ["Step"] + list(model_reporters)
+        self.ring = np.zeros((capacity, len(self.columns)), dtype=np.float64)
+        self.rows = 0
+
+        self.spill_dir = spill_dir
+        self.chunk = np.zeros((chunk_size, len(self.columns)), dtype=np.float64) if spill_dir is not None else None
+        self.chunk_rows = 0
+        self.chunks_written = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            if os.listdir(spill_dir):
+                raise FileExistsError(f"{spill_dir} is not empty, the metrics of every run need their own directory")
+            # Claim the directory right away, so a run started at the same time fails instead of sharing it
+            with open(os.path.join(spill_dir, "columns.json"), "x") as columnsFile:
+                json.dump(self.columns, columnsFile)
+
+    def collect(self, model):
+        """Records the reporters at the model's current step."""
+        row = [model.schedule.steps] + [reporter() for reporter in self.reporters.values()]
+        self.ring[self.rows % self.ring.shape[0]] = row
+        self.rows += 1
+        if self.chunk is not None:
+            self.chunk[self.chunk_rows] = row
+            self.chunk_rows += 1
+            if self.chunk_rows == self.chunk.shape[0]:
+                self.flush()
+
+    def flush(self):
+        """Writes the steps collected since the last chunk to a new chunk file."""
+        if self.chunk is None or self.chunk_rows == 0:
+            return
+        path = os.path.join(self.spill_dir, f"chunk-{self.chunks_written:06d}.npz")
+        np.savez(path, **{column: self.chunk[:self.chunk_rows, index] for index, column in enumerate(self.columns)})
+        self.chunks_written += 1
+        self.chunk_rows = 0
+
+    def _recent_rows(self):
+        capacity = self.ring.shape[0]
+        if self.rows <= capacity:
+            return self.ring[:self.rows]
+        start = self.rows % capacity
+        return np.concatenate([self.ring[start:], self.ring[:start]])
+
+    def _frame(self, rows):
+        frame = pd.DataFrame(rows[:, 1:], columns=self.columns[1:], index=rows[:, 0].astype(np.int64))
+        frame.index.name = "Step"
+        return frame
+
+    def recent(self):
+        """DataFrame of the steps still in the ring buffer, indexed by step."""
+        return self._frame(self._recent_rows())
+
+    def history(self):
+        """DataFrame of every collected step, read back from the chunk files. Requires a spill_dir."""
+        if self.spill_dir is None:
+            raise ValueError("The full history is only kept with a spill_dir")
+        self.flush()
+        return read_history(self.spill_dir, self.columns)
+
+    def get_model_vars_dataframe(self):
+        """Same as Mesa's DataCollector: the full history when it is spilled to disk, else the recent steps."""
+        return self.history() if self.spill_dir is not None else self.recent()
+
+    @property
+    def model_vars(self):
+        """Column -> list of the recent values, like DataCollector.model_vars (used by Mesa's chart modules)."""
+        rows = self._recent_rows()
+        return {column: rows[:, index].tolist() for index, column in enumerate(self.columns) if index > 0}
+
+def read_history(spill_dir, columns=None):
+    """Reads the chunk files written by a MetricsCollector into one DataFrame indexed by step."""
+    paths = sorted(glob.glob(os.path.join(spill_dir, "chunk-*.npz")))
+    parts = {}
+    for path in paths:
+        with np.load(path) as data:
+            for column in columns or data.files:
+                parts.setdefault(column, []).append(data[column])
+    if not parts:
+        return pd.DataFrame(columns=[column for column in (columns or []) if column != "Step"])
+    frame = pd.DataFrame({column: np.concatenate(values) for column, values in parts.items()})
+    frame["Step"] = frame["Step"].astype(np.int64)
+    return frame.set_index("Step")
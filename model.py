@@ -1,69 +1,187 @@
 from mesa import Model
-from mesa.time import RandomActivation
 from mesa.space import MultiGrid
-from mesa.datacollection import DataCollector  # Import DataCollector
 from agent import *
-from random import choice
-import json
+from roadgraph import DIRECTIONS, DIRECTION_CODES, ROAD, TRAFFIC_LIGHT, OBSTACLE
+from batchengine import BatchEngine
+from partition import PartitionedFleet
+from routes import RouteTrees
+from mapcache import load_map
+from carframes import CarChangeLog
+from scheduler import EventActivation
+from metrics import MetricsCollector, TripStats
+from profiling import Profiler
+from trajectory import TrajectoryWriter
+from lightplan import read_light_plan
+from contraction import load_contracted
+from planner import RoutePlanner
+import numpy as np
 
 class CityModel(Model):
     """ 
     Creates a model based on a city map.
     Args:
         N: Number of agents in the simulation
+        max_route_trees: Maximum number of per-destination route trees kept in memory
+        compact: Keep roads and obstacles only in the NumPy city layer instead of creating one agent per cell
+        compact_cars: Create CompactCar agents, with integer ids, packed paths and no instance __dict__, for large fleets with
+            the agents engine
+        engine: "agents" to step every Car agent, "batch" to move all cars at once with the BatchEngine, or "partitioned"
+            to move them in worker processes, one per tile of the map, with the PartitionedFleet (see partition.py)
+        workers: Number of worker processes of the partitioned engine, the number of CPUs by default
+        map_file: Path of the city map to load
+        spawn_every: Number of steps between two waves of cars spawned at the corners
+        light_timings: Overrides of the traffic light cycles of mapDictionary.json, e.g. {"S": 15, "s": 7}
+        contracted_routes: Answer the routes to the destinations without a route tree in memory on the road graph
+            contracted to its decision points (see contraction.py) instead of building their tree, for large maps.
+            The blocked cars going to them also repair their routes on it
+        light_plan: Cycle and offset of every traffic light, as written by lightplan.py, or the path of its JSON file.
+            Applied after light_timings
+        seed: Seed of the model's random number generator
+        metrics_capacity: Number of recent steps of metrics kept in memory
+        metrics_dir: Directory where the full metrics time series is spilled in chunks, None to keep only the recent steps
+        reroute_patience: Steps a car waits behind another car before looking for another route, None to never reroute
+        congestion_cost: Extra route cost of an occupied cell when rerouting
+        reroute_radius: Distance from a rerouting car within which congestion is taken into account
+        profile: Record the time of every phase of a step and the route searches in self.profiler
+        record_dir: Directory where the cars and light states of every step are recorded for replays, None to not record
+        route_workers: Worker processes planning the routes of the spawned cars that need a search, off the step
+            (see planner.py), with the agents engine. None searches them in the step
+        route_lag: Steps between the request of a planned route and the step the car starts following it
     """
-    def __init__(self, N):
-        # Load the map dictionary. The dictionary maps the characters in the map file to the corresponding agent.
-        dataDictionary = json.load(open("city_files/mapDictionary.json"))
+    def __init__(self, N, max_route_trees=64, compact=False, engine="agents", map_file="city_files/2024_base.txt",
+                 spawn_every=4, light_timings=None, seed=None, metrics_capacity=1024, metrics_dir=None,
+                 reroute_patience=3, congestion_cost=8.0, reroute_radius=3, profile=False, record_dir=None,
+                 compact_cars=False, light_plan=None, contracted_routes=False, workers=None, route_workers=None,
+                 route_lag=1):
+        super().__init__()
+
+        # Parameters that define the simulation besides its state, saved in snapshots (see snapshot.py)
+        self.settings = {
+            "max_route_trees": max_route_trees,
+            "compact": compact,
+            "compact_cars": compact_cars,
+            "engine": engine,
+            "workers": workers,
+            "map_file": map_file,
+            "spawn_every": spawn_every,
+            "light_timings": light_timings,
+            "light_plan": light_plan,
+            "contracted_routes": contracted_routes,
+            "route_workers": route_workers,
+            "route_lag": route_lag,
+            "metrics_capacity": metrics_capacity,
+            "reroute_patience": reroute_patience,
+            "congestion_cost": congestion_cost,
+            "reroute_radius": reroute_radius,
+        }
+
+        # Phase timers and route search statistics, see profiling.py
+        self.profiler = Profiler(enabled=profile)
 
         self.traffic_lights = []
         self.destinations = []
         self.cars_reached_destination = 0  # New counter for cars reaching their objective
+        self.cars_spawned = 0
+        self.trips = TripStats()  # Travel and red light wait times of the cars that arrived
+        self.compact = compact
+        self.car_class = CompactCar if compact_cars else Car
+
+        # Load the compiled map (layout, road graph and route trees) from the cache, compiling it the first time
+        self.map_file = map_file
+        compiled = load_map(map_file, max_routes=max_route_trees)
+        self.width = compiled.width
+        self.height = compiled.height
+
+        # Static layer of the city: cell types, road directions and traffic light states as arrays
+        self.city = compiled.layer
+        if light_timings:
+            self.city.set_light_timings(light_timings)
+        if light_plan is not None:
+            self.city.set_light_plan(read_light_plan(light_plan)["lights"] if isinstance(light_plan, str) else light_plan["lights"])
+
+        self.grid = MultiGrid(self.width, self.height, torus=False)
+        # Lights are activated when they change and cars while they can move, see scheduler.py
+        self.schedule = EventActivation(self)
+
+        # Creates the agents of the static cells, with the ids they get from their row and column in the map file
+        def map_index(x, y):
+            return (self.height - y - 1) * self.width + x
+
+        if not compact:
+            for (x, y) in self.city.cells_of(ROAD):
+                agent = Road(f"r_{map_index(x, y)}", self, DIRECTIONS[self.city.direction_at((x, y))])
+                self.grid.place_agent(agent, (x, y))
+
+            for (x, y) in self.city.cells_of(OBSTACLE):
+                agent = Obstacle(f"ob_{map_index(x, y)}", self)
+                self.grid.place_agent(agent, (x, y))
 
-        # Load the map file
-        with open('city_files/2024_base.txt') as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0])-1
-            self.height = len(lines)
-
-            self.grid = MultiGrid(self.width, self.height, torus=False)
-            self.schedule = RandomActivation(self)
-
-            # Goes through each character in the map file and creates the corresponding agent.
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row):
-                    if col in ["v", "^", ">", "<"]:
-                        agent = Road(f"r_{r*self.width+c}", self, dataDictionary[col])
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col in ["S", "s"]:
-                        agent = Traffic_Light(f"tl_{r*self.width+c}", self, False if col == "S" else True, int(dataDictionary[col]))
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-                        self.traffic_lights.append(agent)
-
-                    elif col == "#":
-                        agent = Obstacle(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col == "D":
-                        agent = Destination(f"d_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.destinations.append(agent)
+        for index, (x, y) in enumerate(self.city.light_positions):
+            offset = int(self.city.light_offset[index])
+            agent = Traffic_Light(f"tl_{map_index(x, y)}", self, bool(self.city.light_state[index]), int(self.city.light_time[index]), index=index, offset=offset)
+            self.grid.place_agent(agent, (x, y))
+            self.schedule.add_periodic(agent, int(self.city.light_time[index]), first=offset)
+            self.traffic_lights.append(agent)
+
+        for (x, y) in self.city.destinations:
+            agent = Destination(f"d_{map_index(x, y)}", self)
+            self.grid.place_agent(agent, (x, y))
+            self.destinations.append(agent)
+
+        # Directed graph of the static map, shared by every car's route search
+        self.road_graph = compiled.road_graph
+
+        # One reverse shortest-path tree per destination so cars only follow next-hop pointers
+        # Routes to the other destinations come from the contracted graph when contracted_routes is set
+        contracted = load_contracted(map_file, self.road_graph) if contracted_routes else None
+        self.routes = RouteTrees(self.road_graph, max_trees=max_route_trees, trees=compiled.routes, profiler=self.profiler,
+                                 contracted=contracted)
+        self.routes.precompute(destination.pos for destination in self.destinations)
+
+        # Congestion-aware rerouting of the cars that are blocked for a while
+        self.reroute_patience = reroute_patience
+        self.congestion_cost = congestion_cost
+        self.reroute_radius = reroute_radius
 
         self.num_agents = N
 
+        self._reachable_destinations = {}
+        self._destination_lists = {}
+
+        # Occupancy index: position -> Car on it, kept up to date by place_car, move_car and remove_car
+        self.occupancy = {}
+        self.cars_by_id = {}
+        self.next_car_id = 0
+
+        # Cars that spawned, moved or despawned in the last steps, for the delta frames of /get-cars
+        self.car_changes = CarChangeLog()
+
+        # In batch mode the cars live in the BatchEngine arrays instead of being agents, in partitioned mode
+        # in the arrays of worker processes
+        if engine not in ("agents", "batch", "partitioned"):
+            raise ValueError(f"Unknown engine: {engine}")
+        self.fleet = None
+        if engine == "batch":
+            self.fleet = BatchEngine(self)
+        elif engine == "partitioned":
+            self.fleet = PartitionedFleet(self, workers)
+            # Snapshots are restored with as many workers as they were taken with
+            self.settings["workers"] = self.fleet.workers
+
+        # The other engines read every route from tables built up front
+        self.planner = None
+        if route_workers and self.fleet is None:
+            self.planner = RoutePlanner(self, route_workers, route_lag)
+
         # Variables for spawning cars
+        self.spawn_every = spawn_every
         self.corners = [(0, 0), (0, self.grid.height - 1), (self.grid.width - 1, 0), (self.grid.width - 1, self.grid.height - 1)]  # Spawning locations
         self.i = 0  # Selected corner index
 
         # Add cars in the corners
         for (x, y) in self.corners:
-            if self.num_agents > 0:
-                road = next((agent for agent in self.grid.get_cell_list_contents((x, y)) if isinstance(agent, Road)), None)
-                agent = Car(f"car_{x}_{y}", self, direction=road.direction, objective=choice(self.destinations))
-                self.grid.place_agent(agent, (x, y))
-                self.schedule.add(agent)
+            if self.num_agents > 0 and self.city.is_road((x, y)):
+                self.add_car(f"car_{x}_{y}", (x, y))
                 self.num_agents -= 1
 
         self.running = True
@@ -71,43 +189,205 @@ class CityModel(Model):
         # Initialize the car counter
         self.car_count = 0
 
-        # DataCollector: Collect the number of cars in the model at each step
-        self.datacollector = DataCollector(
-            model_reporters={"Car Count": self.get_car_count, "Cars Reached": self.get_cars_reached_destination}
+        # Collect the number of cars in the model at each step, keeping only the recent steps in memory
+        self.datacollector = MetricsCollector(
+            {"Car Count": self.get_car_count, "Cars Reached": self.get_cars_reached_destination, "Cars Spawned": self.get_cars_spawned},
+            capacity=metrics_capacity,
+            spill_dir=metrics_dir,
+        )
+
+        # Trajectory log of every step, starting with the initial state, see trajectory.py
+        self.recorder = None
+        if record_dir is not None:
+            self.start_recording(record_dir)
+
+    def is_occupied(self, pos):
+        """Whether a car is on the given position."""
+        if self.fleet is not None:
+            return self.fleet.is_occupied(pos)
+        return pos in self.occupancy
+
+    def route_penalty(self, cell):
+        """Extra cost of entering a cell (by cell index) for a rerouting car: occupied cells and red lights."""
+        graph = self.road_graph
+        pos = graph.position(cell)
+        cost = self.congestion_cost if self.is_occupied(pos) else 0.0
+        if graph.kind_list[cell] == TRAFFIC_LIGHT:
+            cost += self.city.steps_until_green(pos, self.schedule.steps)
+        return cost
+
+    def reachable_destinations(self, pos, direction):
+        """
+        Returns the destinations that can be reached from a position and heading, cached per start.
+        Starts that reach the same destinations share one list.
+        """
+        key = (pos, direction)
+        destinations = self._reachable_destinations.get(key)
+        if destinations is None:
+            reachable = tuple(self.road_graph.reachable_destinations(pos, direction))
+            destinations = self._destination_lists.get(reachable)
+            if destinations is None:
+                positions = set(reachable)
+                destinations = self._destination_lists[reachable] = [
+                    destination for destination in self.destinations if destination.pos in positions
+                ]
+            self._reachable_destinations[key] = destinations
+        return destinations
+
+    def add_car(self, unique_id, pos):
+        """
+        Creates a car on a road heading in the road's direction, with a random destination it can reach.
+        No car is created when no destination can be reached from the road.
+        """
+        direction = DIRECTIONS[self.city.direction_at(pos)]
+        destinations = self.reachable_destinations(pos, direction)
+        if not destinations:
+            return
+        objective = self.random.choice(destinations)
+        self.cars_spawned += 1
+        if self.fleet is not None:
+            self.fleet.spawn(pos, direction, objective.pos)
+        else:
+            if self.car_class is CompactCar:
+                unique_id = self.next_car_id
+            self.place_car(self.car_class(unique_id, self, direction=direction, objective=objective, car_id=self.next_car_id), pos)
+            self.next_car_id += 1
+
+    def get_cars(self):
+        """Returns (id, (x, y), direction) for every car, whichever engine moves them."""
+        if self.fleet is not None:
+            return self.fleet.cars()
+        return [(car.unique_id, car.pos, car.direction) for car in self.occupancy.values()]
+
+    def get_car_arrays(self, car_ids=None):
+        """
+        Returns the integer ids, x, y and direction codes of the cars as arrays, whichever engine moves them.
+        Args:
+            car_ids: Only return these cars (the ones that no longer exist are skipped)
+        """
+        if self.fleet is not None:
+            return self.fleet.car_arrays(car_ids)
+        if car_ids is None:
+            cars = list(self.occupancy.values())
+        else:
+            cars = [self.cars_by_id[car_id] for car_id in car_ids if car_id in self.cars_by_id]
+        return (
+            np.array([car.car_id for car in cars], dtype=np.uint32),
+            np.array([car.pos[0] for car in cars], dtype=np.uint16),
+            np.array([car.pos[1] for car in cars], dtype=np.uint16),
+            np.array([DIRECTION_CODES[car.direction] for car in cars], dtype=np.uint8),
         )
 
+    def place_car(self, car, pos):
+        """Places a new car on the grid and the schedule."""
+        self.grid.place_agent(car, pos)
+        self.schedule.add(car)
+        self.occupancy[pos] = car
+        self.cars_by_id[car.car_id] = car
+        self.car_changes.changed(self.schedule.steps, [car.car_id])
+
+    def move_car(self, car, pos):
+        """Moves a car to a free position and wakes the cars waiting for the cell it left."""
+        previous = car.pos
+        del self.occupancy[previous]
+        self.grid.move_agent(car, pos)
+        self.occupancy[pos] = car
+        self.car_changes.changed(self.schedule.steps, [car.car_id])
+        self.schedule.notify(("free", previous))
+
+    def remove_car(self, car):
+        """Removes a car from the grid and the schedule and wakes the cars waiting for its cell."""
+        previous = car.pos
+        del self.occupancy[previous]
+        del self.cars_by_id[car.car_id]
+        self.grid.remove_agent(car)
+        self.schedule.remove(car)
+        car.remove()  # Drop mesa's reference to the agent, the model would keep every car ever spawned
+        self.car_changes.removed(self.schedule.steps, [car.car_id])
+        self.schedule.notify(("free", previous))
+
     def get_car_count(self):
         """Count the number of cars currently in the grid."""
-        return sum(1 for agent in self.schedule.agents if isinstance(agent, Car))
+        if self.fleet is not None:
+            return self.fleet.count
+        return len(self.occupancy)
 
     def get_cars_reached_destination(self):
         """Count the number of cars that have reached their destination."""
         return self.cars_reached_destination
 
+    def get_cars_spawned(self):
+        """Count the number of cars that have been created."""
+        return self.cars_spawned
+
+    def get_trip_stats(self):
+        """Summary of the travel times and red light wait times of the cars that reached their destination."""
+        return self.trips.summary()
+
     def spawnCars(self):
         # Get the current step
         current_step = self.schedule.time
 
-        # Spawn cars every 10 steps
-        if current_step > 0 and current_step % 4 == 0:
+        # Spawn cars every spawn_every steps
+        if current_step > 0 and current_step % self.spawn_every == 0:
             # Cycle through all corners and spawn cars at each one
             for i in range(len(self.corners)):
                 x, y = self.corners[i]
 
-                # Check if there's a road at the selected corner
-                road = next((agent for agent in self.grid.get_cell_list_contents((x, y)) if isinstance(agent, Road)), None)
-                if road:
+                # Check if there's a road at the selected corner and no car is still waiting on it
+                if self.city.is_road((x, y)) and not self.is_occupied((x, y)):
                     # Spawn a car at the selected corner
-                    agent = Car(f"car_{x}_{y}_{current_step}", self, direction=road.direction, objective=choice(self.destinations))
-                    self.grid.place_agent(agent, (x, y))
-                    self.schedule.add(agent)
+                    self.add_car(f"car_{x}_{y}_{current_step}", (x, y))
 
     def step(self):
         '''Advance the model by one step.'''
-        self.spawnCars()
-        self.datacollector.collect(self)  # Collect data at each step
-        self.schedule.step()
+        profiler = self.profiler
+        with profiler.phase("spawn"):
+            self.spawnCars()
+        with profiler.phase("collect"):
+            self.datacollector.collect(self)  # Collect data at each step
+        if self.fleet is not None:
+            # Move every car in one pass, then the schedule steps the traffic lights that change
+            with profiler.phase("fleet"):
+                self.cars_reached_destination += self.fleet.step()
+        if self.planner is not None:
+            # Wakes the cars whose planned route is due, before they are activated
+            self.planner.collect(self.schedule.steps)
+        with profiler.phase("schedule"):
+            self.schedule.step()
+        if self.recorder is not None:
+            with profiler.phase("record"):
+                self.recorder.record(self)
+        profiler.count("steps_total")
+
+    def start_recording(self, record_dir):
+        """Starts recording the cars and light states of every step, from the current one, into a trajectory log."""
+        self.stop_recording()
+        self.recorder = TrajectoryWriter(record_dir, self)
+        self.recorder.record(self)
+
+    def stop_recording(self):
+        """Writes the steps still in memory to the trajectory log and closes it."""
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def close(self):
+        """
+        Writes the metrics collected since the last chunk, then stops the recording and the worker processes of
+        the partitioned engine and of the route planner.
+        """
+        self.datacollector.flush()
+        self.stop_recording()
+        if self.fleet is not None:
+            self.fleet.close()
+        if self.planner is not None:
+            self.planner.close()
+
+    def get_profile(self):
+        '''Phase timers, counters and histograms recorded so far (empty unless the model was created with profile=True).'''
+        return self.profiler.snapshot()
 
     def get_collected_data(self):
-        """Retrieve the collected data (number of cars at each step)."""
+        """Retrieve the collected data (number of cars at each step), the full series when it is spilled to disk."""
         return self.datacollector.get_model_vars_dataframe()
\ No newline at end of file
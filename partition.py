@@ -0,0 +1,599 @@
+"""
+Partitioned engine: the cars of a CityModel moved by worker processes, one per tile of the map.
+
+The map is cut into a grid of tiles and the worker process of every tile moves
+its cars with NumPy, by the rules of the BatchEngine. The routing tables, the
+occupancy of every cell and the traffic light arrays live in shared memory:
+they are stored once for all the workers, the lights switched by the model are
+seen by every worker, and a worker reads the cells of its neighbours to reroute
+without any copy. The route rows are only filled for the destinations the cars
+are going to (see RouteRows), by the model when a car spawns, so they do not
+grow as destinations x cells on large maps. A step takes a few messages
+between the model and the workers, which all work in parallel:
+
+1. plan: every tile adds the cars spawned on it and picks the next cell of its
+   cars. The cars going to a cell of another tile are sent to that tile.
+2. resolve: every tile settles its contested cells between its own cars and
+   the incoming ones, and moves the cars whose next cell is free or is left by
+   a car that moves.
+3. accept: the cars that entered another tile free their cells, which can let
+   more cars move. Repeated until no more car crosses a border.
+4. commit: the tiles apply the moves, keep the cars that entered them and
+   report the cars that moved and arrived.
+
+The random priorities of contested cells are drawn per tile, so a run depends
+on the seed and on the number of workers.
+"""
+import ctypes
+import multiprocessing
+import os
+import tempfile
+import traceback
+import weakref
+import numpy as np
+from batchengine import BatchEngine, RouteRows
+from citylayer import CityLayer
+from roadgraph import DIRECTIONS, DESTINATION
+
+# Arrays of the city layer moved to shared memory, the model keeps using them in place
+LAYER_ARRAYS = ("cell_type", "road_direction", "light_index", "light_state", "light_time", "light_offset")
+
+# Arrays of a car handed over from a tile to another one
+CAR_FIELDS = ("state", "destination", "ids", "spawn_step", "light_wait", "blocked_for")
+
+# Commands the worker of a tile answers, see TileEngine
+COMMANDS = ("add", "plan", "resolve", "accept", "commit", "cars", "get_state", "set_state", "reseed", "attach_routes")
+
+# Directory of the files of the route tables, in memory where the system has one
+TABLE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+def share_array(context, array):
+    """Copies an array into shared memory. Returns (buffer, dtype, shape), from which the workers attach it."""
+    array = np.ascontiguousarray(array)
+    buffer = context.RawArray(ctypes.c_byte, max(array.nbytes, 1))
+    shared = attach_array((buffer, array.dtype.str, array.shape))
+    shared[...] = array
+    return buffer, array.dtype.str, array.shape
+
+def attach_array(spec):
+    """Array view of a buffer created by share_array."""
+    buffer, dtype, shape = spec
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def create_table(shape, dtype):
+    """
+    Creates an array in a file of TABLE_DIR, which grows in memory only as its pages are written.
+    Returns (path, dtype, shape), from which the workers attach it with attach_table, and the array.
+    """
+    dtype = np.dtype(dtype)
+    handle, path = tempfile.mkstemp(prefix="city-routes-", suffix=".bin", dir=TABLE_DIR)
+    os.ftruncate(handle, max(int(np.prod(shape)) * dtype.itemsize, 1))
+    os.close(handle)
+    spec = (path, dtype.str, shape)
+    return spec, attach_table(spec)
+
+def attach_table(spec):
+    """Array mapping the file created by create_table, the file can be removed once every process attached it."""
+    path, dtype, shape = spec
+    if int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r+", shape=shape).view(np.ndarray)
+
+def remove_tables(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def tile_grid(workers, width, height):
+    """Returns the (columns, rows) of tiles for a number of workers with the shortest borders between the tiles."""
+    grids = [(columns, workers // columns) for columns in range(1, workers + 1) if workers % columns == 0]
+    return min(grids, key=lambda grid: (grid[0] - 1) * height + (grid[1] - 1) * width)
+
+def tile_map(width, height, columns, rows):
+    """Tile of every cell (x * height + y), tiles numbered row by row from the bottom left one."""
+    xs = np.arange(width) * columns // width
+    ys = np.arange(height) * rows // height
+    return (ys[None, :] * columns + xs[:, None]).astype(np.int32).ravel()
+
+def split_by_tile(parts, workers):
+    """
+    Concatenates dictionaries of arrays with a "tile" entry and splits their rows by tile.
+    Returns one dictionary of arrays per tile.
+    """
+    merged = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = np.argsort(merged["tile"], kind="stable")
+    bounds = np.searchsorted(merged["tile"][order], np.arange(workers + 1))
+    return [{name: array[order[start:end]] for name, array in merged.items()} for start, end in zip(bounds[:-1], bounds[1:])]
+
+class TileEngine(BatchEngine):
+    """
+    Cars of one tile of the map, moved in the worker process of the tile. See the module docstring for a step.
+    Car slots are local to the tile, and the shared occupancy array holds them for the cells of the tile.
+    Args:
+        tile: Index of the tile
+        tables: Shared arrays (tile_of, occupied and for rerouting the successor table)
+        routes: Specs of the route tables filled by the model, see attach_routes
+        city: CityLayer whose arrays are the shared ones
+        patience: Steps a car waits behind another car before rerouting, None to never reroute
+        congestion_cost: Extra cost of an occupied cell when rerouting
+        seed: Seed of the priorities of the tile
+        capacity: Initial number of car slots, grown when needed
+    """
+    def __init__(self, tile, tables, routes, city, patience, congestion_cost, seed, capacity=256):
+        self.tile = tile
+        self.city = city
+        self.tile_of = tables["tile_of"]
+        self.occupied = tables["occupied"]
+        self.attach_routes(routes)
+        self.patience = patience
+        self.congestion_cost = congestion_cost
+        if patience is not None:
+            self.successor_states = tables["successor_states"]
+            self.successor_costs = tables["successor_costs"]
+        self.cell_type = city.cell_type.ravel()
+        self.light_index = city.light_index.ravel()
+
+        self.state = np.zeros(capacity, dtype=np.int32)
+        self.destination = np.zeros(capacity, dtype=np.int16)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.spawn_step = np.zeros(capacity, dtype=np.int32)
+        self.light_wait = np.zeros(capacity, dtype=np.int32)
+        self.blocked_for = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.count = 0
+        self.reseed(seed)
+
+    def attach_routes(self, routes):
+        """Maps the route tables of the RouteRows of the model, again when they were replaced by bigger ones."""
+        self.row_of = attach_table(routes["row_of"])
+        self.next_hop = attach_table(routes["next_hop"])
+        self.cost_to_go = attach_table(routes["cost_to_go"]) if "cost_to_go" in routes else None
+
+    def add(self, cars):
+        """Adds cars, given as a dictionary of their CAR_FIELDS, on their cells. Returns their slots."""
+        count = cars["state"].size
+        if count == 0:
+            return np.empty(0, dtype=np.int64)
+        slots = np.empty(count, dtype=np.int64)
+        for index in range(count):
+            if not self.free_slots:
+                self._grow()
+            slots[index] = self.free_slots.pop()
+        for name in CAR_FIELDS:
+            getattr(self, name)[slots] = cars[name]
+        self.alive[slots] = True
+        self.occupied[self.state[slots] >> 2] = slots
+        self.count += count
+        return slots
+
+    def plan(self, steps, spawned):
+        """
+        Adds the spawned cars and picks the next state of every car that can move.
+        Returns the cars going to another tile: the tile, their slot, next state and priority and their CAR_FIELDS.
+        """
+        self.add(spawned)
+        slots = np.flatnonzero(self.alive)
+        state = self.state[slots]
+        target_state = self.next_hop[self.row_of[self.destination[slots]], state]
+
+        # Cars on a red light or without a route stay where they are
+        light = self.light_index[state >> 2]
+        if self.city.light_state.size:
+            red = (light >= 0) & ~self.city.light_state[np.maximum(light, 0)]
+        else:
+            red = np.zeros(slots.size, dtype=bool)
+        self.light_wait[slots[red]] += 1
+        wants = (target_state >= 0) & ~red
+        candidates = slots[wants]
+        target_state = target_state[wants]
+        if self.patience is not None and candidates.size:
+            target_state = self._reroute(candidates, target_state, steps)
+        priority = self.rng.random(candidates.size)
+
+        self.wanting = candidates
+        leaving = self.tile_of[target_state >> 2] != self.tile
+        self.local = (candidates[~leaving], target_state[~leaving], priority[~leaving])
+        self.leaving = candidates[leaving]
+        self.moving = np.zeros(self.alive.size, dtype=bool)
+        outgoing = {
+            "tile": self.tile_of[target_state[leaving] >> 2],
+            "origin": np.full(self.leaving.size, self.tile, dtype=np.int32),
+            "slot": self.leaving,
+            "target": target_state[leaving],
+            "priority": priority[leaving],
+        }
+        outgoing.update({name: getattr(self, name)[self.leaving] for name in CAR_FIELDS})
+        return outgoing
+
+    def resolve(self, incoming):
+        """
+        Settles the contested cells of the tile between its cars and the incoming ones: the lowest priority wins.
+        Returns the incoming cars that moved, see _settle.
+        """
+        slots, target_state, priority = self.local
+        target_state = np.concatenate([target_state, incoming["target"]])
+        target_cell = target_state >> 2
+        order = np.lexsort((np.concatenate([priority, incoming["priority"]]), target_cell))
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = target_cell[order][1:] != target_cell[order][:-1]
+
+        # Winners numbered below slots.size are cars of the tile, the others incoming cars
+        self.incoming = incoming
+        self.winners = order[first]
+        self.winner_state = target_state[self.winners]
+        self.blocker = self.occupied[target_cell[self.winners]]
+        self.entered = np.zeros(self.winners.size, dtype=bool)
+        self.pending = np.arange(self.winners.size)
+        return self._settle()
+
+    def accept(self, slots):
+        """Marks cars of the tile that entered another tile as moving. Returns the incoming cars that could then move."""
+        self.moving[slots] = True
+        return self._settle()
+
+    def _settle(self):
+        """
+        Moves the pending winners whose next cell is free or left by a car that moves.
+        Returns the incoming cars among them as their origin "tile" and "slot".
+        """
+        local_slots = self.local[0]
+        entered = []
+        pending = self.pending
+        while pending.size:
+            blocker = self.blocker[pending]
+            free = (blocker < 0) | self.moving[np.maximum(blocker, 0)]
+            if not free.any():
+                break
+            moved = pending[free]
+            self.entered[moved] = True
+            winner = self.winners[moved]
+            own = winner < local_slots.size
+            self.moving[local_slots[winner[own]]] = True
+            entered.append(winner[~own] - local_slots.size)
+            pending = pending[~free]
+        self.pending = pending
+        entered = np.concatenate(entered) if entered else np.empty(0, dtype=np.int64)
+        return {"tile": self.incoming["origin"][entered], "slot": self.incoming["slot"][entered]}
+
+    def commit(self, steps):
+        """
+        Applies the moves of the step: the cars that entered another tile leave this one and the incoming cars
+        that moved join it. Returns the ids of the cars that moved and of the cars that arrived with their
+        destinations, travel times and red light waits.
+        """
+        local_slots = self.local[0]
+        winner = self.winners[self.entered]
+        own = winner < local_slots.size
+        movers = local_slots[winner[own]]
+        gone = self.leaving[self.moving[self.leaving]]
+        self.blocked_for[self.wanting] += 1
+        self.blocked_for[movers] = 0
+
+        # Free the cells that were left before filling the cells that were entered
+        self.occupied[self.state[movers] >> 2] = -1
+        self.occupied[self.state[gone] >> 2] = -1
+        self.alive[gone] = False
+        self.free_slots.extend(gone.tolist())
+        self.count -= gone.size
+        self.state[movers] = self.winner_state[self.entered][own]
+        self.occupied[self.state[movers] >> 2] = movers
+        arriving = winner[~own] - local_slots.size
+        cars = {name: self.incoming[name][arriving] for name in CAR_FIELDS}
+        cars["state"] = self.winner_state[self.entered][~own]
+        cars["blocked_for"] = np.zeros(arriving.size, dtype=np.int32)
+        movers = np.concatenate([movers, self.add(cars)])
+
+        # Cars that entered their destination leave the city
+        new_cell = self.state[movers] >> 2
+        arrived = self.cell_type[new_cell] == DESTINATION
+        self.occupied[new_cell[arrived]] = -1
+        finished = movers[arrived]
+        self.alive[finished] = False
+        self.free_slots.extend(finished.tolist())
+        self.count -= finished.size
+        self.local = self.incoming = None
+        return {
+            "moved": self.ids[movers[~arrived]],
+            "finished": self.ids[finished],
+            "destination": self.destination[finished],
+            "travel_time": steps - self.spawn_step[finished] + 1,
+            "light_wait": self.light_wait[finished],
+        }
+
+    def cars(self):
+        """Returns the ids and states of the cars of the tile."""
+        slots = np.flatnonzero(self.alive)
+        return self.ids[slots], self.state[slots]
+
+    def get_state(self):
+        """Returns the RNG state and the car arrays of the tile, free slots included."""
+        arrays = {name: getattr(self, name) for name in self.CAR_ARRAYS}
+        arrays["free_slots"] = np.array(self.free_slots, dtype=np.int64)
+        return self.rng.bit_generator.state, arrays
+
+    def set_state(self, rng_state, arrays):
+        """Restores the cars saved by get_state on their cells, which must be free in the occupancy array."""
+        for name in self.CAR_ARRAYS:
+            setattr(self, name, np.array(arrays[name], dtype=getattr(self, name).dtype))
+        self.free_slots = arrays["free_slots"].tolist()
+        slots = np.flatnonzero(self.alive)
+        self.occupied[self.state[slots] >> 2] = slots
+        self.count = slots.size
+        self.rng.bit_generator.state = rng_state
+
+def run_tile(connection, tile, shared, routes, light_positions, destinations, patience, congestion_cost, seed):
+    """Main loop of the worker process of a tile: answers the commands of the PartitionedFleet until "close"."""
+    tables = {name: attach_array(spec) for name, spec in shared.items()}
+    city = CityLayer(*(tables[name] for name in LAYER_ARRAYS[:5]), light_positions, destinations, tables["light_offset"])
+    engine = TileEngine(tile, tables, routes, city, patience, congestion_cost, seed)
+    while True:
+        command, args = connection.recv()
+        if command == "close":
+            break
+        try:
+            if command not in COMMANDS:
+                raise ValueError(f"Unknown command: {command}")
+            connection.send(("ok", getattr(engine, command)(*args)))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+    connection.close()
+
+def stop_workers(connections, processes, table_paths):
+    """Asks the workers to exit and waits for them, killing the ones that do not, then removes the route table files."""
+    for connection in connections:
+        try:
+            connection.send(("close", ()))
+        except (OSError, ValueError):
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    for connection in connections:
+        connection.close()
+    remove_tables(table_paths)
+
+class PartitionedFleet:
+    """
+    Moves the cars of a CityModel in worker processes, one per tile of the map, for maps thousands of cells across.
+    Has the interface of the BatchEngine, so the model steps, spawns and reads its cars the same way.
+    Args:
+        model: The CityModel whose cars are simulated
+        workers: Number of worker processes (and tiles), the number of CPUs by default
+    """
+    def __init__(self, model, workers=None):
+        self.model = model
+        city = model.city
+        self.height = city.height
+        self.workers = workers or os.cpu_count() or 1
+        self.columns, self.rows = tile_grid(self.workers, city.width, city.height)
+
+        tables = {
+            "tile_of": tile_map(city.width, city.height, self.columns, self.rows),
+            "occupied": np.full(city.width * city.height, -1, dtype=np.int32),
+        }
+        if model.reroute_patience is not None:
+            tables["successor_states"], tables["successor_costs"] = model.road_graph.successor_table()
+        # The arrays of the city are counted by the model's city layer
+        self.shared_bytes = sum(array.nbytes for array in tables.values())
+        tables.update({name: getattr(city, name) for name in LAYER_ARRAYS})
+
+        # Worker processes are spawned rather than forked, the server runs models in threads
+        context = multiprocessing.get_context("spawn")
+        self.shared = {name: share_array(context, array) for name, array in tables.items()}
+        del tables
+
+        # Route rows of the destinations in use, filled here when cars spawn and read by the workers. Their tables
+        # are files mapped by every process; when they grow, the workers map the new files before the next step
+        # and the old ones are removed
+        self.table_specs = {}
+        # Files not removed yet, and the ones among them that were replaced
+        self.table_paths = []
+        self.retired_paths = []
+        goals = [destination.pos for destination in model.destinations]
+        self.goal_index = {goal: index for index, goal in enumerate(goals)}
+        self.route_rows = RouteRows(model.routes, goals, model.settings["max_route_trees"],
+                                    model.reroute_patience is not None, allocate=self._create_table)
+        self.synced_generation = self.route_rows.generation
+        # The model's city uses the shared arrays from now on, so the workers see the lights it switches
+        for name in LAYER_ARRAYS:
+            setattr(city, name, attach_array(self.shared[name]))
+        self.tile_of = attach_array(self.shared["tile_of"])
+        self.occupied = attach_array(self.shared["occupied"])
+
+        seed = model.random.getrandbits(32)
+        self.connections = []
+        self.processes = []
+        for tile in range(self.workers):
+            connection, child = context.Pipe()
+            process = context.Process(
+                target=run_tile, daemon=True,
+                args=(child, tile, self.shared, self.table_specs, city.light_positions, city.destinations,
+                      model.reroute_patience, model.congestion_cost, [seed, tile]),
+            )
+            process.start()
+            child.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self._stop = weakref.finalize(self, stop_workers, self.connections, self.processes, self.table_paths)
+
+        # Cars spawned since the last step, added to their tiles with the next message
+        self.spawned = []
+        self.spawned_cells = set()
+        self.next_id = 0
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        """Memory of the shared arrays, of the route tables and of the car arrays of the workers."""
+        car_bytes = 4 + 2 + 8 + 4 + 4 + 4 + 1
+        return self.shared_bytes + self.route_rows.nbytes + self.count * car_bytes
+
+    def _create_table(self, name, shape, dtype):
+        """Allocates a route table of the RouteRows in a file, the one it replaces is removed after the next sync."""
+        spec, array = create_table(shape, dtype)
+        previous = self.table_specs.get(name)
+        if previous is not None:
+            self.retired_paths.append(previous[0])
+        self.table_specs[name] = spec
+        self.table_paths.append(spec[0])
+        return array
+
+    def _sync_routes(self):
+        """Has the workers map the route tables again if they grew since the last step."""
+        if self.route_rows.generation != self.synced_generation:
+            self._call("attach_routes", {tile: (self.table_specs,) for tile in range(self.workers)})
+            self.synced_generation = self.route_rows.generation
+            remove_tables(self.retired_paths)
+            for path in self.retired_paths:
+                self.table_paths.remove(path)
+            self.retired_paths.clear()
+
+    def close(self):
+        """Stops the worker processes."""
+        self._stop()
+
+    def _call(self, command, args):
+        """
+        Sends a command to the workers of the tiles in args ({tile: arguments}) and returns their results by tile.
+        They all work on it at the same time.
+        """
+        for tile, arguments in args.items():
+            self.connections[tile].send((command, arguments))
+        results = {}
+        for tile in args:
+            status, result = self.connections[tile].recv()
+            if status == "error":
+                raise RuntimeError(f"Worker of tile {tile} failed:\n{result}")
+            results[tile] = result
+        return results
+
+    def _take_spawned(self):
+        """Returns the cars spawned since the last message as one dictionary of CAR_FIELDS per tile."""
+        columns = list(zip(*self.spawned)) or [(), (), (), ()]
+        state, destination, ids, spawn_step = (
+            np.array(column, dtype=dtype) for column, dtype in zip(columns, (np.int32, np.int16, np.int64, np.int32))
+        )
+        zeros = np.zeros(state.size, dtype=np.int32)
+        cars = {"tile": self.tile_of[state >> 2], "state": state, "destination": destination, "ids": ids,
+                "spawn_step": spawn_step, "light_wait": zeros, "blocked_for": zeros}
+        self.spawned = []
+        self.spawned_cells.clear()
+        return split_by_tile([cars], self.workers)
+
+    def _flush(self):
+        """Adds the cars spawned since the last step to their tiles, before the cars are read."""
+        if self.spawned:
+            spawned = self._take_spawned()
+            self._call("add", {tile: (cars,) for tile, cars in enumerate(spawned) if cars["state"].size})
+
+    def is_occupied(self, pos):
+        x, y = pos
+        cell = x * self.height + y
+        return self.occupied[cell] >= 0 or cell in self.spawned_cells
+
+    def spawn(self, pos, direction, goal):
+        """Adds a car on a free position, heading in a direction and going to a goal position. Returns its id."""
+        x, y = pos
+        cell = x * self.height + y
+        car_id = self.next_id
+        goal_index = self.goal_index[goal]
+        self.route_rows.acquire(goal_index)
+        self.spawned.append((cell * 4 + DIRECTIONS.index(direction), goal_index, car_id, self.model.schedule.steps))
+        self.spawned_cells.add(cell)
+        self.model.car_changes.changed(self.model.schedule.steps, [car_id])
+        self.next_id += 1
+        self.count += 1
+        return car_id
+
+    def step(self):
+        """Advances every car by at most one cell. Returns the number of cars that reached their destination."""
+        steps = self.model.schedule.steps
+        self._sync_routes()
+        spawned = self._take_spawned()
+        tiles = range(self.workers)
+        outgoing = self._call("plan", {tile: (steps, spawned[tile]) for tile in tiles})
+
+        # Cars crossing a border go to the tile of their next cell, then the tiles report the ones that entered
+        # until no more car can move
+        incoming = split_by_tile([outgoing[tile] for tile in tiles], self.workers)
+        entered = self._call("resolve", {tile: (incoming[tile],) for tile in tiles})
+        while True:
+            by_origin = split_by_tile([entered[tile] for tile in entered], self.workers)
+            news = {tile: (cars["slot"],) for tile, cars in enumerate(by_origin) if cars["slot"].size}
+            if not news:
+                break
+            entered = self._call("accept", news)
+
+        committed = self._call("commit", {tile: (steps,) for tile in tiles})
+        results = [committed[tile] for tile in tiles]
+        finished = np.concatenate([result["finished"] for result in results])
+        self.route_rows.release(np.concatenate([result["destination"] for result in results]))
+        self.model.trips.add_many(np.concatenate([result["travel_time"] for result in results]),
+                                  np.concatenate([result["light_wait"] for result in results]))
+        self.model.car_changes.changed(steps, np.concatenate([result["moved"] for result in results]).tolist())
+        self.model.car_changes.removed(steps, finished.tolist())
+        self.count -= finished.size
+        return int(finished.size)
+
+    def _car_states(self):
+        """Ids and states of all the cars, concatenated in tile order."""
+        self._flush()
+        results = self._call("cars", {tile: () for tile in range(self.workers)})
+        return (np.concatenate([results[tile][0] for tile in results]),
+                np.concatenate([results[tile][1] for tile in results]))
+
+    def cars(self):
+        """Returns (id, (x, y), direction) for every car."""
+        ids, state = self._car_states()
+        cells, headings = np.divmod(state, 4)
+        xs, ys = np.divmod(cells, self.height)
+        return [
+            (car_id, (x, y), DIRECTIONS[heading])
+            for car_id, x, y, heading in zip(ids.tolist(), xs.tolist(), ys.tolist(), headings.tolist())
+        ]
+
+    def car_arrays(self, car_ids=None):
+        """Returns the ids, x, y and direction codes of every car, or of the given car ids that still exist."""
+        ids, state = self._car_states()
+        if car_ids is not None:
+            keep = np.isin(ids, np.fromiter(car_ids, dtype=np.int64))
+            ids, state = ids[keep], state[keep]
+        cells, headings = np.divmod(state, 4)
+        xs, ys = np.divmod(cells, self.height)
+        return ids.astype(np.uint32), xs.astype(np.uint16), ys.astype(np.uint16), headings.astype(np.uint8)
+
+    def get_state(self):
+        """
+        Returns (counters and RNG states of the tiles as plain data, arrays), for snapshots.
+        The arrays are the car arrays of every tile, named <array>_<tile>, so the cars keep their slots.
+        """
+        self._flush()
+        results = self._call("get_state", {tile: () for tile in range(self.workers)})
+        arrays = {f"{name}_{tile}": array for tile in results for name, array in results[tile][1].items()}
+        rngs = [results[tile][0] for tile in results]
+        return {"next_id": self.next_id, "count": self.count, "workers": self.workers, "rng": rngs}, arrays
+
+    def set_state(self, state, arrays):
+        """Restores the cars saved by get_state, which needs the same number of workers."""
+        if state["workers"] != self.workers:
+            raise ValueError(f"The snapshot was taken with {state['workers']} workers, not {self.workers}")
+        self.spawned = []
+        self.spawned_cells.clear()
+        self.occupied[:] = -1
+        names = TileEngine.CAR_ARRAYS + ("free_slots",)
+        self._call("set_state", {
+            tile: (state["rng"][tile], {name: arrays[f"{name}_{tile}"] for name in names}) for tile in range(self.workers)
+        })
+        self.next_id = state["next_id"]
+        self.count = state["count"]
+        self.route_rows.reset()
+        for tile in range(self.workers):
+            self.route_rows.acquire_many(arrays[f"destination_{tile}"][arrays[f"alive_{tile}"].astype(bool)])
+
+    def reseed(self, seed):
+        """Draws the priorities of the next steps of every tile from a new seed."""
+        self._call("reseed", {tile: ([seed, tile],) for tile in range(self.workers)})
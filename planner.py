@@ -0,0 +1,120 @@
+"""
+Route planning of the spawned cars in worker processes, off the step.
+
+A spawned car takes its route from the destination's route tree, which only
+follows next-hop pointers when the tree was built with the model. For the
+other destinations the route needs a search (building the tree, or a query on
+the contracted graph), and a wave of spawns can make a step last much longer
+than the others. With a RoutePlanner those cars ask the planner for their
+route and wait on their spawn cell instead:
+
+- Identical requests (same start, heading and destination) share one search,
+  and a route planned before is read right away.
+- The searches run in worker processes while the model keeps stepping.
+- A route requested on step s is used on step s + lag: the model collects it
+  before that step, waiting for the workers only if they are late, so a run
+  does not depend on how fast the workers are.
+
+Which cars wait only depends on their destination and on the routes planned
+before, not on the trees the model happens to hold at the time. Snapshots keep
+the planned routes, so a restored snapshot continues like the saved model.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from mapcache import load_map
+from routes import RouteTrees
+from contraction import load_contracted
+
+# Route trees of the worker process, set up by start_worker
+_worker_routes = None
+
+def start_worker(map_file, max_trees, contracted):
+    """Loads the road graph and route trees of the map in a worker process, from the map cache."""
+    global _worker_routes
+    compiled = load_map(map_file, max_routes=max_trees)
+    contracted_graph = load_contracted(map_file, compiled.road_graph) if contracted else None
+    _worker_routes = RouteTrees(compiled.road_graph, max_trees=max_trees, trees=compiled.routes, contracted=contracted_graph)
+
+def plan_route(start, direction, goal):
+    """Route from a start position and heading to a goal position, see RouteTrees.path. Runs in a worker."""
+    return _worker_routes.path(start, direction, goal)
+
+def worker_ready():
+    """Task that returns once a worker process has loaded the map."""
+    return True
+
+class RoutePlanner:
+    """
+    Plans the routes of the spawned cars that need a search in worker processes. See the module docstring.
+    Args:
+        model: CityModel whose cars are planned for, its RouteTrees receive the planned routes
+        workers: Number of worker processes
+        lag: Steps between the request of a route and the step it is used, at least 1
+    """
+    def __init__(self, model, workers=1, lag=1):
+        self.model = model
+        self.lag = max(1, lag)
+        self.workers = workers
+        # Destinations whose routes are read right away
+        self.immediate = frozenset(model.routes.trees)
+        # Request key -> (future, step on which its route is used), in request order
+        self.pending = {}
+        # Keys of the routes collected for the current step, which the cars read right away
+        self.ready = set()
+        # Spawned rather than forked, the server runs models in threads
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=start_worker,
+            initargs=(model.map_file, model.settings["max_route_trees"], model.routes.contracted is not None),
+        )
+        # Start loading the map in every worker while the model is built
+        for _ in range(workers):
+            self.pool.submit(worker_ready)
+
+    def request(self, start, direction, goal):
+        """
+        Returns None when the route can be read right away, otherwise the event key the car sleeps on until
+        its route is planned. Identical requests share the key and the search.
+        """
+        key = ("route", start, direction, goal)
+        if goal in self.immediate or key in self.ready or self.model.routes.is_planned(start, direction, goal):
+            return None
+        if key not in self.pending:
+            self.pending[key] = (self.pool.submit(plan_route, start, direction, goal), self.model.schedule.steps + self.lag)
+            self.model.profiler.count("route_searches_total", kind="planned")
+        return key
+
+    def collect(self, step=None):
+        """
+        Hands the routes used on a step to the route trees and wakes the cars waiting for them, waiting for
+        the workers if they are not done yet.
+        Args:
+            step: Step about to run, None to collect every pending route
+        """
+        profiler = self.model.profiler
+        self.ready = set()
+        while self.pending:
+            key = next(iter(self.pending))
+            future, due = self.pending[key]
+            if step is not None and due > step:
+                break
+            with profiler.phase("route_wait"):
+                path = future.result()
+            del self.pending[key]
+            _, start, direction, goal = key
+            self.model.routes.add_planned(start, direction, goal, path)
+            self.ready.add(key)
+            self.model.schedule.notify(key)
+
+    def get_state(self):
+        """Returns the pending requests as [key, step on which the route is used], for snapshots."""
+        return [[key, due] for key, (_, due) in self.pending.items()]
+
+    def set_state(self, requests):
+        """Requests again the routes of get_state, for the same steps."""
+        for key, due in requests:
+            _, start, direction, goal = key
+            self.pending[key] = (self.pool.submit(plan_route, start, direction, goal), due)
+
+    def close(self):
+        """Stops the worker processes, dropping the pending requests."""
+        self.pool.shutdown(wait=False, cancel_futures=True)
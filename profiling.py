@@ -0,0 +1,216 @@
+"""
+Lightweight instrumentation of the simulation.
+
+A Profiler records phase timers, counters and histograms, e.g. the time of
+every phase of CityModel.step, the number of route searches and the length
+of the routes. When it is disabled, phase() returns a shared no-op context
+manager and the callers skip their observe()/count() calls behind a check of
+`enabled`, so instrumented code pays one attribute read.
+
+The data is available as a dict (snapshot) for headless runs and in the
+Prometheus text format (render_prometheus) for the /metrics endpoint.
+"""
+from contextlib import nullcontext
+import bisect
+import time
+
+# Every metric: name -> (Prometheus type, help text, histogram buckets)
+METRICS = {
+    "phase_seconds": ("histogram", "Time spent in each phase of a step or request",
+                      (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)),
+    "path_length": ("histogram", "Number of cells of the routes given to cars",
+                    (5, 10, 20, 40, 80, 160, 320, 640)),
+    "search_expansions": ("histogram", "States expanded by each route search",
+                          (1, 4, 16, 64, 256, 1024, 4096, 16384)),
+    "route_searches_total": ("counter", "Route searches by kind", None),
+    "steps_total": ("counter", "Model steps run while profiling", None),
+}
+
+NO_PHASE = nullcontext()
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of the observed values."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, cumulative count) pairs, ending with +Inf."""
+        total = 0
+        pairs = []
+        for bound, count in zip(list(self.buckets) + [float("inf")], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+class _Phase:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class Profiler:
+    """
+    Timers, counters and histograms, each keyed by a metric of METRICS and its labels.
+    Args:
+        enabled: Whether anything is recorded
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+
+    def _histogram(self, metric, labels):
+        key = (metric, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(METRICS[metric][2])
+        return histogram
+
+    def phase(self, name, **labels):
+        """Context manager timing a phase into phase_seconds{phase=name}. A no-op when disabled."""
+        if not self.enabled:
+            return NO_PHASE
+        return _Phase(self._histogram("phase_seconds", dict(labels, phase=name)))
+
+    def observe(self, metric, value, **labels):
+        """Adds a value to a histogram metric."""
+        if self.enabled:
+            self._histogram(metric, labels).observe(value)
+
+    def count(self, metric, value=1, **labels):
+        """Increments a counter metric."""
+        if self.enabled:
+            key = (metric, tuple(sorted(labels.items())))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def copy(self):
+        """Independent copy of the recorded data, to read it while the original keeps recording."""
+        other = Profiler(self.enabled)
+        other.counters = dict(self.counters)
+        for key, histogram in list(self.histograms.items()):
+            clone = other.histograms[key] = Histogram(histogram.buckets)
+            clone.counts = list(histogram.counts)
+            clone.sum = histogram.sum
+            clone.count = histogram.count
+        return other
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+    def snapshot(self):
+        """
+        Everything recorded, as plain data: {"counters": [...], "histograms": [...]}, each entry with
+        its metric, labels and values (count, sum, mean and buckets for the histograms).
+        """
+        return {
+            "counters": [
+                {"metric": metric, "labels": dict(labels), "value": value}
+                for (metric, labels), value in sorted(self.counters.items())
+            ],
+            "histograms": [
+                {
+                    "metric": metric,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                    "buckets": [[bound, count] for bound, count in histogram.cumulative()],
+                }
+                for (metric, labels), histogram in sorted(self.histograms.items())
+            ],
+        }
+
+    def report(self):
+        """Short text summary of the phase timers, slowest total first."""
+        phases = [
+            (histogram.sum, dict(labels)["phase"], histogram.count)
+            for (metric, labels), histogram in self.histograms.items() if metric == "phase_seconds"
+        ]
+        lines = []
+        for total, name, count in sorted(phases, reverse=True):
+            lines.append(f"{name:<16} {count:>8} calls {total:10.4f}s {1e6 * total / count:10.1f}us/call")
+        return "\n".join(lines)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_prometheus(sources, gauges=(), prefix="city_"):
+    """
+    Renders profilers and gauges in the Prometheus text exposition format.
+    Args:
+        sources: (labels dict, Profiler) pairs, the labels are added to every sample of the profiler
+        gauges: (name, help, labels dict, value) of values read at scrape time
+        prefix: Prefix of every metric name
+    """
+    samples = {}
+    for extra, profiler in sources:
+        extra = tuple(sorted(extra.items()))
+        for (metric, labels), value in profiler.counters.items():
+            samples.setdefault(metric, []).append((extra + labels, value))
+        for (metric, labels), histogram in profiler.histograms.items():
+            samples.setdefault(metric, []).append((extra + labels, histogram))
+
+    lines = []
+    for metric, entries in sorted(samples.items()):
+        kind, help_text, _ = METRICS[metric]
+        name = prefix + metric
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(entries, key=lambda entry: entry[0]):
+            if kind == "histogram":
+                for bound, count in value.cumulative():
+                    lines.append(f"{name}_bucket{_label_text(labels + (('le', _number(bound)),))} {count}")
+                lines.append(f"{name}_sum{_label_text(labels)} {_number(value.sum)}")
+                lines.append(f"{name}_count{_label_text(labels)} {value.count}")
+            else:
+                lines.append(f"{name}{_label_text(labels)} {_number(value)}")
+
+    declared = set()
+    # Samples of a metric must be contiguous, so the gauges of every source are grouped by name
+    for name, help_text, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+        name = prefix + name
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{_label_text(tuple(sorted(labels.items())))} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+def model_gauges(model, labels=None):
+    """Gauges of a model that are always kept up to date, profiling or not."""
+    labels = labels or {}
+    schedule = model.schedule
+    gauges = [
+        ("step", "Current step of the model", labels, schedule.steps),
+        ("cars", "Cars in the city", labels, model.get_car_count()),
+        ("cars_reached", "Cars that reached their destination", labels, model.get_cars_reached_destination()),
+        ("cars_spawned", "Cars created", labels, model.get_cars_spawned()),
+    ]
+    if model.fleet is None:
+        gauges.append(("cars_awake", "Cars activated at the next step", labels, schedule.get_awake_count()))
+    return gauges
@@ -0,0 +1,339 @@
+from heapq import heappush, heappop
+import math
+import numpy as np
+
+# Headings a car can have. A heading is stored as its index in this tuple.
+DIRECTIONS = ("Up", "Down", "Left", "Right")
+DIRECTION_CODES = {name: code for code, name in enumerate(DIRECTIONS)}
+
+# Kinds of static cells in the city map
+EMPTY = 0
+ROAD = 1
+TRAFFIC_LIGHT = 2
+DESTINATION = 3
+OBSTACLE = 4
+
+# Moves a car can attempt for each heading: the cell straight ahead and the two
+# forward diagonals, each with the road directions that accept the car there.
+# Mirrors the rules that Car.possible_moves_f has always used.
+MOVE_RULES = {
+    "Left": [
+        ((-1, 0), ("Left", "Up", "Down")),
+        ((-1, 1), ("Left", "Up")),
+        ((-1, -1), ("Left", "Down")),
+    ],
+    "Right": [
+        ((1, 0), ("Right", "Up", "Down")),
+        ((1, 1), ("Right", "Up")),
+        ((1, -1), ("Right", "Down")),
+    ],
+    "Up": [
+        ((0, 1), ("Up", "Left", "Right")),
+        ((1, 1), ("Up", "Right")),
+        ((-1, 1), ("Up", "Left")),
+    ],
+    "Down": [
+        ((0, -1), ("Down", "Left", "Right")),
+        ((1, -1), ("Down", "Right")),
+        ((-1, -1), ("Down", "Left")),
+    ],
+}
+
+class RoadGraph:
+    """
+    Directed graph of the static city map, compiled once per model.
+    A node (state) is a cell together with the heading of the car on it, encoded
+    as cell * 4 + heading with cell = x * height + y. Road cells only have the
+    state that matches their direction, traffic lights keep the heading the car
+    arrived with and destinations are terminal.
+    The edges are stored in compressed sparse row form: the edges leaving state s
+    are indices[indptr[s]:indptr[s + 1]] with the matching costs.
+    Args:
+        width: Width of the map
+        height: Height of the map
+        kinds: Cell kind (EMPTY, ROAD, ...) for every cell index
+        indptr: Offset of the first edge of every state, plus the total number of edges
+        indices: Next state of every edge
+        costs: Length of every edge
+    """
+    def __init__(self, width, height, kinds, indptr, indices, costs):
+        self.width = width
+        self.height = height
+        self.kinds = np.asarray(kinds, dtype=np.uint8)
+        self.indptr = indptr
+        self.indices = indices
+        self.costs = costs
+        self._kind_list = None
+        self._successors = None
+        self._predecessors = None
+        self._reach = None
+        # States expanded by the last a_star search, for the profiler
+        self.last_expansions = 0
+
+    @classmethod
+    def from_layer(cls, layer):
+        """Builds the graph from the NumPy arrays of a CityLayer."""
+        return cls.compile(layer.width, layer.height, layer.cell_type.ravel(), layer.road_direction.ravel())
+
+    @classmethod
+    def compile(cls, width, height, kinds, directions):
+        """
+        Compiles the edges of every state from the cell kinds and road directions, one array operation per move rule.
+        Args:
+            kinds: Cell kind of every cell index
+            directions: Heading code of every road cell (-1 elsewhere)
+        """
+        kinds = np.asarray(kinds, dtype=np.uint8)
+        directions = np.asarray(directions, dtype=np.int8)
+        num_states = width * height * 4
+        xs, ys = np.divmod(np.arange(width * height), height)
+
+        sources, targets, costs, rules = [], [], [], []
+        for heading, name in enumerate(DIRECTIONS):
+            # Road cells only carry their own heading, traffic lights carry any heading
+            active = np.flatnonzero(((kinds == ROAD) & (directions == heading)) | (kinds == TRAFFIC_LIGHT))
+            for idx, ((dx, dy), valid_directions) in enumerate(MOVE_RULES[name]):
+                nx, ny = xs[active] + dx, ys[active] + dy
+                inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+                source = active[inside]
+                target = nx[inside] * height + ny[inside]
+                target_kind = kinds[target]
+                target_direction = directions[target]
+
+                valid_codes = [DIRECTION_CODES[direction] for direction in valid_directions]
+                to_road = (target_kind == ROAD) & np.isin(target_direction, valid_codes)
+                # Destinations are only usable when they are the car's objective, which the searches check
+                to_destination = target_kind == DESTINATION
+                # Traffic lights can only be entered straight ahead
+                to_light = (target_kind == TRAFFIC_LIGHT) & (idx == 0)
+                keep = to_road | to_destination | to_light
+
+                next_heading = np.where(to_road, target_direction, heading)
+                sources.append(source[keep] * 4 + heading)
+                targets.append(target[keep] * 4 + next_heading[keep])
+                costs.append(np.full(int(keep.sum()), math.sqrt(dx * dx + dy * dy)))
+                rules.append(np.full(int(keep.sum()), idx))
+
+        sources = np.concatenate(sources)
+        targets = np.concatenate(targets)
+        costs = np.concatenate(costs)
+        # Keep the edges of each state in move rule order: straight ahead first, then the diagonals
+        order = np.lexsort((np.concatenate(rules), sources))
+        indptr = np.zeros(num_states + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_states), out=indptr[1:])
+        return cls(width, height, kinds, indptr, targets[order].astype(np.int64), costs[order])
+
+    @property
+    def num_states(self):
+        return self.width * self.height * 4
+
+    @property
+    def successors(self):
+        """The (next state, cost) edges leaving every state as Python tuples, built on first use."""
+        if self._successors is None:
+            indptr = self.indptr.tolist()
+            indices = self.indices.tolist()
+            costs = self.costs.tolist()
+            self._successors = [
+                tuple(zip(indices[begin:end], costs[begin:end])) for begin, end in zip(indptr, indptr[1:])
+            ]
+        return self._successors
+
+    def predecessors(self):
+        """Returns the reversed edges (previous state, cost) entering every state, built on first use."""
+        if self._predecessors is None:
+            predecessors = [[] for _ in range(self.num_states)]
+            sources = np.repeat(np.arange(self.num_states), np.diff(self.indptr)).tolist()
+            for state, next_state, cost in zip(sources, self.indices.tolist(), self.costs.tolist()):
+                predecessors[next_state].append((state, cost))
+            self._predecessors = predecessors
+        return self._predecessors
+
+    def successor_table(self):
+        """
+        Returns the edges as dense (num_states, max out-degree) arrays of next states and costs,
+        padded with -1 and inf, for vectorized lookups of every move a car can make.
+        """
+        degree = np.diff(self.indptr)
+        width = int(degree.max()) if degree.size else 0
+        next_states = np.full((self.num_states, width), -1, dtype=np.int32)
+        costs = np.full((self.num_states, width), np.inf)
+        sources = np.repeat(np.arange(self.num_states), degree)
+        slots = np.arange(self.indices.size) - self.indptr[sources]
+        next_states[sources, slots] = self.indices
+        costs[sources, slots] = self.costs
+        return next_states, costs
+
+    def components(self):
+        """
+        Labels every state with its strongly connected component (iterative Tarjan).
+        Components are numbered in reverse topological order: every edge leaving a
+        component goes to a component with a smaller number.
+        """
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        count = self.num_states
+        index = [-1] * count
+        low = [0] * count
+        on_stack = [False] * count
+        labels = [-1] * count
+        stack = []
+        counter = 0
+        component = 0
+        for root in range(count):
+            if index[root] != -1:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, indptr[root])]
+            while work:
+                state, edge = work[-1]
+                if edge < indptr[state + 1]:
+                    work[-1] = (state, edge + 1)
+                    next_state = indices[edge]
+                    if index[next_state] == -1:
+                        index[next_state] = low[next_state] = counter
+                        counter += 1
+                        stack.append(next_state)
+                        on_stack[next_state] = True
+                        work.append((next_state, indptr[next_state]))
+                    elif on_stack[next_state] and index[next_state] < low[state]:
+                        low[state] = index[next_state]
+                    continue
+                work.pop()
+                if work and low[state] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[state]
+                if low[state] == index[state]:
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        labels[member] = component
+                        if member == state:
+                            break
+                    component += 1
+        return np.array(labels, dtype=np.int32)
+
+    def _destination_reach(self):
+        """
+        Returns (component labels, bitmask of the destinations reachable from every component, destination cells),
+        where bit i stands for destination_cells[i]. Built once, in one pass over the condensed graph.
+        """
+        if self._reach is None:
+            labels = self.components()
+            destination_cells = np.flatnonzero(self.kinds == DESTINATION).tolist()
+            masks = [0] * (int(labels.max()) + 1 if labels.size else 0)
+            for bit, cell in enumerate(destination_cells):
+                for heading in range(4):
+                    masks[labels[cell * 4 + heading]] |= 1 << bit
+
+            # Components in increasing number, so the components an edge leads to are already complete
+            order = np.argsort(labels, kind="stable").tolist()
+            label_list = labels.tolist()
+            indptr = self.indptr.tolist()
+            indices = self.indices.tolist()
+            for state in order:
+                label = label_list[state]
+                mask = masks[label]
+                for edge in range(indptr[state], indptr[state + 1]):
+                    mask |= masks[label_list[indices[edge]]]
+                masks[label] = mask
+            self._reach = (label_list, masks, destination_cells)
+        return self._reach
+
+    def reachable_destinations(self, position, direction):
+        """Returns the positions of every destination that can be reached from a position and heading."""
+        labels, masks, destination_cells = self._destination_reach()
+        mask = masks[labels[self.state(position, direction)]]
+        reachable = []
+        while mask:
+            bit = mask & -mask
+            reachable.append(self.position(destination_cells[bit.bit_length() - 1]))
+            mask ^= bit
+        return reachable
+
+    @property
+    def kind_list(self):
+        """Cell kinds as a Python list, faster than the array for the searches' per-node checks."""
+        if self._kind_list is None:
+            self._kind_list = self.kinds.tolist()
+        return self._kind_list
+
+    def cell(self, position):
+        x, y = position
+        return x * self.height + y
+
+    def position(self, cell):
+        return divmod(cell, self.height)
+
+    def state(self, position, direction):
+        return self.cell(position) * 4 + DIRECTION_CODES[direction]
+
+    def moves(self, position, direction, objective=None):
+        """
+        Returns the positions reachable in one move from a position and heading.
+        Destinations are only included when they are the objective.
+        """
+        goal_cell = self.cell(objective) if objective is not None else -1
+        kinds = self.kind_list
+        moves = []
+        for next_state, _ in self.successors[self.state(position, direction)]:
+            next_cell = next_state >> 2
+            if kinds[next_cell] == DESTINATION and next_cell != goal_cell:
+                continue
+            moves.append(self.position(next_cell))
+        return moves
+
+    def a_star(self, start, direction, goal):
+        """
+        A* search from a position and heading to a goal position.
+        Returns the list of positions to visit (without the start), or an empty list if the goal is unreachable.
+        """
+        goal_cell = self.cell(goal)
+        gx, gy = goal
+        height = self.height
+        kinds = self.kind_list
+        successors = self.successors
+
+        def heuristic(cell):
+            x, y = divmod(cell, height)
+            return math.sqrt((x - gx) ** 2 + (y - gy) ** 2)
+
+        start_state = self.state(start, direction)
+        g_cost = {start_state: 0.0}
+        came_from = {}
+        closed = set()
+        # The counter keeps ties in insertion order, like the old list based search
+        counter = 0
+        open_heap = [(heuristic(start_state >> 2), counter, start_state)]
+
+        while open_heap:
+            _, _, current = heappop(open_heap)
+            if current in closed:
+                continue
+            if current >> 2 == goal_cell:
+                path = []
+                while current in came_from:
+                    path.append(divmod(current >> 2, height))
+                    current = came_from[current]
+                path.reverse()
+                self.last_expansions = len(closed)
+                return path
+            closed.add(current)
+
+            current_g = g_cost[current]
+            for neighbor, cost in successors[current]:
+                if neighbor in closed:
+                    continue
+                neighbor_cell = neighbor >> 2
+                if kinds[neighbor_cell] == DESTINATION and neighbor_cell != goal_cell:
+                    continue
+                tentative_g_cost = current_g + cost
+                if tentative_g_cost < g_cost.get(neighbor, float('inf')):
+                    came_from[neighbor] = current
+                    g_cost[neighbor] = tentative_g_cost
+                    counter += 1
+                    heappush(open_heap, (tentative_g_cost + heuristic(neighbor_cell), counter, neighbor))
+        self.last_expansions = len(closed)
+        return []  # Return an empty list if no path is found
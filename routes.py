@@ -0,0 +1,314 @@
+from collections import OrderedDict
+from heapq import heappush, heappop
+import numpy as np
+from profiling import Profiler
+
+INFINITY = float('inf')
+
+# Moves between neighbouring cells, packed paths store the index of each move in one byte
+MOVE_OFFSETS = ((0, 1), (0, -1), (-1, 0), (1, 0), (-1, 1), (1, 1), (-1, -1), (1, -1))
+MOVE_CODES = {offset: code for code, offset in enumerate(MOVE_OFFSETS)}
+
+def pack_moves(start, path):
+    """Packs a path (positions without the start) into one byte per move."""
+    moves = bytearray(len(path))
+    x, y = start
+    for index, (nx, ny) in enumerate(path):
+        moves[index] = MOVE_CODES[nx - x, ny - y]
+        x, y = nx, ny
+    return bytes(moves)
+
+def unpack_moves(start, moves):
+    """The positions visited by packed moves from a start position, the inverse of pack_moves."""
+    path = []
+    x, y = start
+    for code in moves:
+        dx, dy = MOVE_OFFSETS[code]
+        x, y = x + dx, y + dy
+        path.append((x, y))
+    return path
+
+class RouteTrees:
+    """
+    Reverse shortest-path trees, one per destination, over a RoadGraph.
+    Each tree stores, for every state, the next state on the shortest route to
+    its destination (-1 when the destination cannot be reached), so a route is
+    read by following next-hop pointers instead of running a search. The cost
+    to go of every state is kept alongside (on demand) so blocked cars can
+    repair their route around congestion with a small local search. The goals
+    answered by the contracted graph are repaired on it, without a cost to go.
+    Args:
+        road_graph: Compiled graph of the static map
+        max_trees: Maximum number of trees kept in memory, the least recently used one is dropped first (None keeps all)
+        trees: Already built next-hop arrays keyed by goal position, e.g. loaded from the map cache
+        profiler: Profiler timing the tree builds and counting the repair expansions
+        max_packed: Number of packed paths kept to be shared by the compact cars, and of routes planned by a
+            RoutePlanner (see planner.py)
+        contracted: ContractedGraph of the road graph (see contraction.py) answering the routes to the goals without a
+            tree in memory, instead of building their tree. None builds every tree
+    """
+    def __init__(self, road_graph, max_trees=None, trees=None, profiler=None, max_packed=4096, contracted=None):
+        self.road_graph = road_graph
+        self.max_trees = max_trees
+        self.trees = OrderedDict(trees or {})
+        # Keep the most recent of the seeded trees within the cap
+        while max_trees is not None and len(self.trees) > max_trees:
+            self.trees.popitem(last=False)
+        self.profiler = profiler or Profiler()
+        # States expanded by the last repair search
+        self.last_expansions = 0
+        # Cost to go of every state per goal, built on the first repair towards the goal
+        self.distances = OrderedDict()
+        # Packed path per (start state, goal), the cars that spawn on the same cell for the same goal share one
+        self.packed = OrderedDict()
+        self.max_packed = max_packed
+        self.contracted = contracted
+        # Routes planned in worker processes per (start state, goal), read by path() instead of searching
+        self.planned = OrderedDict()
+
+    def precompute(self, goals):
+        """Builds the trees for the given goal positions, up to max_trees."""
+        for goal in goals:
+            if self.max_trees is not None and len(self.trees) >= self.max_trees:
+                break
+            self.tree(goal)
+
+    def tree(self, goal):
+        """Returns the next-hop array of a goal position, building it if needed."""
+        next_hop = self.trees.get(goal)
+        if next_hop is None:
+            next_hop, _ = self._build(goal)
+            self._store(self.trees, goal, next_hop)
+        else:
+            self.trees.move_to_end(goal)
+        return next_hop
+
+    def cost_to_go(self, goal):
+        """
+        Returns the length of the shortest route to a goal position from every state (inf when unreachable),
+        as an array. Built with the tree, or by rebuilding it when the tree came from the map cache.
+        """
+        distance = self.distances.get(goal)
+        if distance is None:
+            next_hop, distance = self._build(goal)
+            self._store(self.distances, goal, distance)
+            if goal not in self.trees:
+                self._store(self.trees, goal, next_hop)
+        else:
+            self.distances.move_to_end(goal)
+        return distance
+
+    def _store(self, cache, goal, value):
+        cache[goal] = value
+        if self.max_trees is not None and len(cache) > self.max_trees:
+            cache.popitem(last=False)
+
+    def _build(self, goal):
+        """Dijkstra on the reversed graph starting from every state on the goal cell. Returns next hops and distances."""
+        with self.profiler.phase("route_tree_build"):
+            next_hop, distances = self._dijkstra(goal)
+        self.profiler.count("route_searches_total", kind="tree_build")
+        return next_hop, distances
+
+    def _dijkstra(self, goal):
+        graph = self.road_graph
+        predecessors = graph.predecessors()
+        goal_cell = graph.cell(goal)
+
+        next_hop = np.full(graph.num_states, -1, dtype=np.int32)
+        distance = {}
+        open_heap = []
+        for heading in range(4):
+            state = goal_cell * 4 + heading
+            distance[state] = 0.0
+            open_heap.append((0.0, state))
+
+        while open_heap:
+            current_distance, current = heappop(open_heap)
+            if current_distance > distance[current]:
+                continue
+            for previous, cost in predecessors[current]:
+                new_distance = current_distance + cost
+                if new_distance < distance.get(previous, float('inf')):
+                    distance[previous] = new_distance
+                    next_hop[previous] = current
+                    heappush(open_heap, (new_distance, previous))
+
+        distances = np.full(graph.num_states, np.inf)
+        distances[list(distance)] = list(distance.values())
+        return next_hop, distances
+
+    def reachable(self, start, direction, goal):
+        """Whether the goal can be reached from a start position and heading, without building the goal's tree."""
+        return start == goal or goal in self.road_graph.reachable_destinations(start, direction)
+
+    def add_planned(self, start, direction, goal, path):
+        """Keeps a route planned elsewhere, which path() then returns for the same start, heading and goal."""
+        self.planned[(self.road_graph.state(start, direction), goal)] = path
+        if len(self.planned) > self.max_packed:
+            self.planned.popitem(last=False)
+
+    def is_planned(self, start, direction, goal):
+        """Whether path() returns a route planned elsewhere for a start position, heading and goal."""
+        return (self.road_graph.state(start, direction), goal) in self.planned
+
+    def path(self, start, direction, goal):
+        """
+        Returns the positions from a start position and heading to the goal (without the start),
+        or an empty list if the goal cannot be reached.
+        """
+        planned = self.planned.get((self.road_graph.state(start, direction), goal))
+        if planned is not None:
+            return list(planned)
+        if self.contracted is not None and goal not in self.trees:
+            with self.profiler.phase("contracted_route"):
+                path = self.contracted.path(start, direction, goal)
+            if self.profiler.enabled:
+                self.profiler.count("route_searches_total", kind="contracted")
+                self.profiler.observe("search_expansions", self.contracted.last_expansions, kind="contracted")
+            return path
+        graph = self.road_graph
+        return self._follow(graph.state(start, direction), goal)
+
+    def packed_path(self, start, direction, goal):
+        """Same as path() with the moves packed by pack_moves. The result is shared, it must not be changed."""
+        key = (self.road_graph.state(start, direction), goal)
+        moves = self.packed.get(key)
+        if moves is None:
+            moves = pack_moves(start, self.path(start, direction, goal))
+            self.packed[key] = moves
+            if len(self.packed) > self.max_packed:
+                self.packed.popitem(last=False)
+        else:
+            self.packed.move_to_end(key)
+        return moves
+
+    def _follow(self, state, goal):
+        """Positions visited from a state to the goal along the goal's tree, or an empty list if there is no route."""
+        graph = self.road_graph
+        next_hop = self.tree(goal)
+        goal_cell = graph.cell(goal)
+        height = graph.height
+        path = []
+        while state >> 2 != goal_cell:
+            state = next_hop.item(state)
+            if state < 0:
+                return []
+            path.append(divmod(state >> 2, height))
+        return path
+
+    def repair(self, start, direction, goal, penalty, radius=3):
+        """
+        Route from a start position and heading to the goal that avoids congestion near the start.
+        Runs A* with extra costs on the cells within `radius` of the start and the cost to go of the
+        goal's tree as heuristic, which is exact beyond the radius: the search stops at the first
+        state it takes out of the radius and follows the tree from there, so only the congested
+        neighbourhood is expanded again.
+        Args:
+            start: Position of the car
+            direction: Heading of the car
+            goal: Destination position
+            penalty: Callable returning the extra cost of entering a cell (by cell index) near the start
+            radius: Chebyshev distance from the start within which the extra costs apply
+        Returns the positions to visit (without the start), or an empty list if the goal cannot be reached.
+        Goals answered by the contracted graph are repaired on it instead, see _contracted_repair.
+        """
+        if self.contracted is not None and goal not in self.trees:
+            return self._contracted_repair(start, direction, goal, penalty, radius)
+        graph = self.road_graph
+        successors = graph.successors
+        distance = self.cost_to_go(goal)
+        goal_cell = graph.cell(goal)
+        height = graph.height
+        sx, sy = start
+
+        start_state = graph.state(start, direction)
+        if distance.item(start_state) == INFINITY:
+            return []
+        g_cost = {start_state: 0.0}
+        came_from = {}
+        closed = set()
+        counter = 0
+        open_heap = [(distance.item(start_state), counter, start_state)]
+
+        while open_heap:
+            _, _, current = heappop(open_heap)
+            if current in closed:
+                continue
+            cell = current >> 2
+            x, y = divmod(cell, height)
+            if cell == goal_cell or max(abs(x - sx), abs(y - sy)) > radius:
+                tail = self._follow(current, goal)
+                path = []
+                while current in came_from:
+                    path.append(divmod(current >> 2, height))
+                    current = came_from[current]
+                path.reverse()
+                self.last_expansions = len(closed)
+                return path + tail
+            closed.add(current)
+
+            current_g = g_cost[current]
+            for neighbor, cost in successors[current]:
+                # Also skips other destinations, whose cost to go is infinite
+                remaining = distance.item(neighbor)
+                if neighbor in closed or remaining == INFINITY:
+                    continue
+                tentative_g_cost = current_g + cost + penalty(neighbor >> 2)
+                if tentative_g_cost < g_cost.get(neighbor, float('inf')):
+                    came_from[neighbor] = current
+                    g_cost[neighbor] = tentative_g_cost
+                    counter += 1
+                    heappush(open_heap, (tentative_g_cost + remaining, counter, neighbor))
+        self.last_expansions = len(closed)
+        return []
+
+    def _contracted_repair(self, start, direction, goal, penalty, radius):
+        """
+        Same as repair() for a goal without a tree, without building its cost to go over the whole map: Dijkstra
+        with the extra costs stops at every state it takes out of the radius (or onto the goal cell), and one query
+        on the contracted graph from all of them at once, each with the cost paid to reach it, picks the way on.
+        """
+        graph = self.road_graph
+        successors = graph.successors
+        goal_cell = graph.cell(goal)
+        height = graph.height
+        sx, sy = start
+
+        start_state = graph.state(start, direction)
+        if start_state >> 2 == goal_cell:
+            return []
+        g_cost = {start_state: 0.0}
+        came_from = {}
+        closed = set()
+        exits = {}
+        open_heap = [(0.0, start_state)]
+
+        while open_heap:
+            current_g, current = heappop(open_heap)
+            if current in closed:
+                continue
+            closed.add(current)
+            cell = current >> 2
+            x, y = divmod(cell, height)
+            if cell == goal_cell or max(abs(x - sx), abs(y - sy)) > radius:
+                visited = []
+                state = current
+                while state in came_from:
+                    visited.append(state)
+                    state = came_from[state]
+                visited.reverse()
+                exits[current] = (current_g, visited)
+                continue
+            for neighbor, cost in successors[current]:
+                if neighbor in closed:
+                    continue
+                tentative_g_cost = current_g + cost + penalty(neighbor >> 2)
+                if tentative_g_cost < g_cost.get(neighbor, INFINITY):
+                    came_from[neighbor] = current
+                    g_cost[neighbor] = tentative_g_cost
+                    heappush(open_heap, (tentative_g_cost, neighbor))
+
+        states = self.contracted.route_states(exits, goal) if exits else []
+        self.last_expansions = len(closed) + (self.contracted.last_expansions if exits else 0)
+        return [divmod(state >> 2, height) for state in states]
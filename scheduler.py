@@ -0,0 +1,195 @@
+"""
+Event-driven activation of the city agents.
+
+RandomActivation steps every agent on every tick, although a traffic light
+only changes every few steps and most cars are stopped at a red light or
+behind another car. EventActivation only steps the agents that can act:
+
+- Periodic agents (the traffic lights) sit in a heap keyed by the step of
+  their next change and are stepped only on that step.
+- Cars that cannot move go to sleep on a key, e.g. ("free", cell) or
+  ("green", light position), and are woken when the model notifies that key,
+  or after a timeout if they asked for one.
+  A car woken during a step is activated later in the same step, so a queue
+  can advance as a whole like it did when its cars happened to be activated
+  front to back.
+
+The cost of a step scales with the number of due lights and awake cars.
+"""
+from mesa.time import BaseScheduler
+import heapq
+
+def event_key(value):
+    """Turns an event key read back from JSON, e.g. ["free", [3, 4]], into the tuple it was."""
+    if isinstance(value, list):
+        return tuple(event_key(item) for item in value)
+    return value
+
+class EventActivation(BaseScheduler):
+    """
+    Scheduler that activates the due periodic agents, then the awake agents in random order.
+    Attributes:
+        awake: Agents activated at every step until they go to sleep, in insertion order
+        sleeping: Agent -> key it waits on
+        waiting: Key -> agents waiting on it
+        timers: Heap of (step, sequence, agent, period, key) of the periodic agents (key None) and of the
+            sleep timeouts (period None)
+        timeouts: Sleeping agent -> sequence of the timer of its current sleep, the timers of earlier sleeps are ignored
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.awake = {}
+        self.sleeping = {}
+        self.waiting = {}
+        self.timers = []
+        self.timeouts = {}
+        self._sequence = 0
+        # Queue and activated agents of the step in progress, None between steps
+        self._queue = None
+        self._activated = None
+
+    def add(self, agent):
+        """Adds an agent that is activated at every step until it goes to sleep."""
+        super().add(agent)
+        self.awake[agent] = None
+
+    def add_periodic(self, agent, period, first=0):
+        """
+        Adds an agent that is only activated every `period` steps.
+        Args:
+            agent: The agent, its step() is called on every due step
+            period: Steps between two activations
+            first: Step of the first activation
+        """
+        super().add(agent)
+        self._push_timer(first, agent, period)
+
+    def _push_timer(self, step, agent, period, key=None):
+        heapq.heappush(self.timers, (step, self._sequence, agent, period, key))
+        self._sequence += 1
+
+    def remove(self, agent):
+        super().remove(agent)
+        self.awake.pop(agent, None)
+        self.timeouts.pop(agent, None)
+        if agent in self.sleeping:
+            self._unlink(agent)
+
+    def _unlink(self, agent):
+        """Takes a sleeping agent out of the waiting list of its key."""
+        key = self.sleeping.pop(agent)
+        waiting = self.waiting[key]
+        waiting.remove(agent)
+        if not waiting:
+            del self.waiting[key]
+
+    def sleep(self, agent, key, timeout=None):
+        """
+        Stops activating an agent until `key` is notified.
+        Args:
+            agent: The agent, which must not be sleeping already
+            key: Event the agent waits for
+            timeout: Wake the agent anyway after this many steps, None to wait for the event only
+        """
+        self.awake.pop(agent, None)
+        self.sleeping[agent] = key
+        self.waiting.setdefault(key, []).append(agent)
+        if timeout is not None:
+            self.timeouts[agent] = self._sequence
+            self._push_timer(self.steps + timeout, agent, None, key)
+
+    def notify(self, key):
+        """Wakes every agent waiting on a key, in random order."""
+        agents = self.waiting.pop(key, None)
+        if agents is None:
+            return
+        if len(agents) > 1:
+            self.model.random.shuffle(agents)
+        for agent in agents:
+            del self.sleeping[agent]
+            self.timeouts.pop(agent, None)
+            self._wake(agent)
+
+    def _wake(self, agent):
+        self.awake[agent] = None
+        if self._queue is not None and agent not in self._activated:
+            self._queue.append(agent)
+
+    def _timeout(self, agent, sequence):
+        """Wakes an agent whose sleep timed out, unless it woke since (maybe to sleep again) the timer was set."""
+        if self.timeouts.get(agent) != sequence:
+            return
+        del self.timeouts[agent]
+        self._unlink(agent)
+        self._wake(agent)
+
+    def get_awake_count(self):
+        """Returns the number of agents that will be activated at the next step, without the periodic ones."""
+        return len(self.awake)
+
+    def get_state(self, name_of):
+        """
+        Returns the step counters, awake agents, waiting lists and timers as plain data, for snapshots.
+        Timers of agents that already left the schedule are dropped, they would never fire.
+        Args:
+            name_of: Callable returning a name that identifies an agent, e.g. its unique_id
+        """
+        return {
+            "steps": self.steps,
+            "time": self.time,
+            "sequence": self._sequence,
+            "awake": [name_of(agent) for agent in self.awake],
+            "waiting": [[key, [name_of(agent) for agent in agents]] for key, agents in self.waiting.items()],
+            "timers": [[step, sequence, name_of(agent), period, key]
+                       for step, sequence, agent, period, key in self.timers if agent in self._agents],
+            "timeouts": [[name_of(agent), sequence] for agent, sequence in self.timeouts.items()],
+        }
+
+    def set_state(self, state, agent_of):
+        """
+        Restores the state returned by get_state. Every agent must have been added already.
+        Args:
+            state: Result of get_state
+            agent_of: Callable returning the agent of a name
+        """
+        self.steps = state["steps"]
+        self.time = state["time"]
+        self._sequence = state["sequence"]
+        self.awake = {agent_of(name): None for name in state["awake"]}
+        self.waiting = {}
+        self.sleeping = {}
+        for key, names in state["waiting"]:
+            key = event_key(key)
+            self.waiting[key] = [agent_of(name) for name in names]
+            for agent in self.waiting[key]:
+                self.sleeping[agent] = key
+        # The timers are kept in their heap order
+        self.timers = [(step, sequence, agent_of(name), period, event_key(key))
+                       for step, sequence, name, period, key in state["timers"]]
+        self.timeouts = {agent_of(name): sequence for name, sequence in state["timeouts"]}
+
+    def step(self):
+        """Activates the periodic agents due at this step, then every awake agent once, in random order."""
+        while self.timers and self.timers[0][0] <= self.steps:
+            _, sequence, agent, period, key = heapq.heappop(self.timers)
+            if period is None:
+                self._timeout(agent, sequence)
+            elif agent in self._agents:
+                agent.step()
+                self._push_timer(self.steps + period, agent, period)
+
+        self._queue = list(self.awake)
+        self.model.random.shuffle(self._queue)
+        self._activated = set()
+        index = 0
+        # Agents woken by the ones activated before them are appended to the queue
+        while index < len(self._queue):
+            agent = self._queue[index]
+            index += 1
+            if agent in self.awake and agent not in self._activated:
+                self._activated.add(agent)
+                agent.step()
+        self._queue = self._activated = None
+
+        self.steps += 1
+        self.time += 1
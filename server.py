@@ -1,62 +1,19 @@
-from agent import *
 from model import CityModel
-from mesa.visualization import CanvasGrid, TextElement
+from mapcache import load_map
+from cityviz import CityMapElement
+from mesa.visualization import TextElement
 from mesa.visualization import ModularServer
 
-# Function to define the agent portrayal
-def agent_portrayal(agent):
-    if agent is None: return
-    portrayal = {"Shape": "rect", "Filled": "true", "Layer": 1, "w": 1, "h": 1}
-
-    if isinstance(agent, Road):
-        portrayal["Color"] = "gray"
-        portrayal["Layer"] = 0
-
-    if isinstance(agent, Destination):
-        portrayal["Color"] = "lightgreen"
-        portrayal["Layer"] = 0
-
-    if isinstance(agent, Traffic_Light):
-        portrayal["Color"] = "red" if not agent.state else "green"
-        portrayal["Layer"] = 0
-        portrayal["w"] = 1
-        portrayal["h"] = 1
-
-    if isinstance(agent, Obstacle):
-        portrayal["Color"] = "cadetblue"
-        portrayal["Layer"] = 0
-        portrayal["w"] = 1
-        portrayal["h"] = 1
-        
-    if isinstance(agent, Car):
-        portrayal["Color"] = "blue"   
-        if agent.direction == "Up":
-            portrayal["Shape"] = "Images/up.png"
-        elif agent.direction == "Down":
-            portrayal["Shape"] = "Images/down.png"
-            portrayal["w"] = 1
-            portrayal["h"] = 1
-        elif agent.direction == "Left":
-            portrayal["Shape"] = "Images/left.png"
-        elif agent.direction == "Right":
-            portrayal["Shape"] = "Images/right.png"
-
-    return portrayal
-
-# Read the map dimensions from the city map file
-width = 0
-height = 0
-
-with open('city_files/2024_base.txt') as baseFile:
-    lines = baseFile.readlines()
-    width = len(lines[0]) - 1
-    height = len(lines)
+# Read the map dimensions from the compiled map cache
+city_map = load_map('city_files/2024_base.txt')
+width = city_map.width
+height = city_map.height
 
 # Set model parameters
-model_params = {"N": 4}  # 4 Cars, 1 per corner
+model_params = {"N": 4, "compact": True}  # 4 Cars, 1 per corner. Roads and obstacles only live in the city layer
 
-# Create the CanvasGrid for the model visualization
-grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
+# Create the city canvas: the static city is sent once, then only the cars and lights that changed
+grid = CityMapElement(500, round(500 * height / width))
 
 # Custom TextElement to display the car count as text
 class CarCountTextElement(TextElement):
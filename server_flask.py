@@ -1,141 +1,541 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS, cross_origin
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+import gzip, hashlib, json, os, re, threading, uuid
 from model import CityModel, Obstacle, Road, Destination, Traffic_Light, Car
+from roadgraph import ROAD, TRAFFIC_LIGHT, DESTINATION, OBSTACLE
+from carframes import car_frame, encode_binary, frame_lists
+from streaming import SimulationLoop, sse_events
+from sessions import SessionRegistry
+from mapcache import map_path
+from profiling import Profiler, render_prometheus, model_gauges
+from trajectory import TrajectoryReader
+from snapshot import save_snapshot, load_snapshot
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 app = Flask("")
 cors = CORS(app, origins=['http://localhost'])
 
-cityModel = None
+# Every client owns a session with its own model and lock. Clients send the id of their session in the
+# X-Session-Id header or the session query parameter; clients that send none share the "default" session.
+# The replay reader of a closed session's recording is closed with it, see forgetReplayReader.
+sessions = SessionRegistry(max_sessions=32, ttl=1800, max_bytes=2 * 1024 ** 3, on_close=lambda session: forgetReplayReader(session.session_id))
+DEFAULT_SESSION = "default"
+
+def sessionId():
+    return request.headers.get("X-Session-Id") or request.args.get("session") or DEFAULT_SESSION
+
+def currentSession():
+    """Returns the session of the request, or None if it was never initiated or was evicted."""
+    return sessions.get(sessionId())
+
+def unknownSession():
+    return jsonify({"message":f"Unknown session {sessionId()}, POST /init first"}), 404
+
+# Profiling of the models and of the request serialization, enabled with the CITY_PROFILE environment variable.
+# A session can also turn the profiling of its model on or off with the "profile" parameter of /init.
+PROFILE_DEFAULT = os.environ.get("CITY_PROFILE", "") not in ("", "0")
+requestProfiler = Profiler(enabled=PROFILE_DEFAULT)
+
+# Recordings of the sessions initiated with "record": true, one directory per session id, served by the /replay routes
+REPLAY_DIR = os.environ.get("CITY_REPLAY_DIR", "replays")
+# Open readers by recording name, least recently used first. The evicted ones are closed to release their memory maps
+MAX_REPLAY_READERS = 16
+replayReaders = OrderedDict()
+replayLock = threading.Lock()
+# Recordings and snapshots are files named after session ids or client names, restricted to these characters
+SAFE_NAME = re.compile(r"[A-Za-z0-9_-]+")
+
+# Snapshots of the models (see snapshot.py): saved with /snapshot, or every checkpoint_every steps as <session id>.npz,
+# and restored with the "snapshot" parameter of /init, e.g. to resume the sessions of a server that crashed
+SNAPSHOT_DIR = os.environ.get("CITY_SNAPSHOT_DIR", "snapshots")
+
+def snapshotPath(name):
+    return os.path.join(SNAPSHOT_DIR, f"{name}.npz")
+
+def checkpointSession(session, previousStep):
+    """Saves the snapshot of a session whose model went past a multiple of its checkpoint_every steps. Call with the session lock held."""
+    every = session.checkpoint_every
+    if every and session.model.schedule.steps // every > previousStep // every:
+        save_snapshot(session.model, snapshotPath(session.session_id))
+
+# Traffic light timing plans written by lightplan.py, loaded with the "light_plan" parameter of /init
+PLAN_DIR = os.environ.get("CITY_PLAN_DIR", "plans")
+
+def planPath(name):
+    return os.path.join(PLAN_DIR, f"{name}.json")
+
+def replayReader(name):
+    """
+    Returns the reader of a recording, refreshed to its last written step, or None if there is no such recording.
+    Raises FileNotFoundError when the recording is being restarted. Call with replayLock held.
+    """
+    if not SAFE_NAME.fullmatch(name):
+        return None
+    directory = os.path.join(REPLAY_DIR, name)
+    reader = replayReaders.get(name)
+    try:
+        if reader is None:
+            if not os.path.exists(os.path.join(directory, "steps.bin")):
+                return None
+            reader = TrajectoryReader(directory)
+        else:
+            reader.refresh()
+    except FileNotFoundError:
+        # The files were replaced while they were mapped, the next request opens the new recording
+        if replayReaders.pop(name, None) is not None:
+            reader.close()
+        raise
+    replayReaders[name] = reader
+    replayReaders.move_to_end(name)
+    while len(replayReaders) > MAX_REPLAY_READERS:
+        _, evicted = replayReaders.popitem(last=False)
+        evicted.close()
+    return reader
+
+def forgetReplayReader(name):
+    """Closes the reader of a recording, if it is open, e.g. when the session that recorded it is closed."""
+    with replayLock:
+        reader = replayReaders.pop(name, None)
+    if reader is not None:
+        reader.close()
+
+def recordingRestarted(name):
+    return jsonify({"message":f"Recording {name} is being restarted, try again"}), 409
+
+# Serialized static layout of each model, see staticCityPayload
+staticCityCache = WeakKeyDictionary()
 
 # This route will be used to send the parameters of the simulation to the server.
 # The servers expects a POST request with the parameters in a.json.
+# Parameters: N, map (year or path), engine, workers, compact, compact_cars, contracted_routes, route_workers, spawn_every,
+# seed, profile, record, light_plan, all optional.
+# "engine": "partitioned" moves the cars in "workers" processes, one per tile of the map.
+# "light_plan": <name> loads the traffic light timings of plans/<name>.json, written by lightplan.py.
+# "record": true records every step of the session for the /replay routes.
+# "snapshot": <name> starts from a saved snapshot instead, with the map and settings it was saved with, and "reseed": <seed>
+# makes it diverge from the saved run. "checkpoint_every": <steps> saves the session as snapshot <session id> every that many steps.
+# "new": true creates a session with a random id, "reset": true replaces the model of an existing session.
 @app.route('/init', methods=['POST'])
 @cross_origin()
 def initModel():
-    global cityModel
     if request.method == 'POST':
-        # try:
-        # Create the model using the parameters sent by the application
-        if cityModel is None:
-            cityModel = CityModel()
+        try:
+            params = request.get_json(silent=True) or {}
+            requestedId = uuid.uuid4().hex if params.get("new") else sessionId()
+            session = sessions.get(requestedId)
+            if session is not None and not params.get("reset"):
+                return jsonify({
+                    "message":"Model already initiated",
+                    "session": session.session_id,
+                    "width": session.model.width,
+                    "height": session.model.height
+                })
+
+            if (params.get("record") or params.get("checkpoint_every")) and not SAFE_NAME.fullmatch(requestedId):
+                return jsonify({"message":"Recorded or checkpointed sessions need an id of letters, digits, _ and -"}), 400
+            snapshotName = params.get("snapshot")
+            if snapshotName is not None and not (SAFE_NAME.fullmatch(str(snapshotName)) and os.path.exists(snapshotPath(snapshotName))):
+                return jsonify({"message":f"Unknown snapshot {snapshotName}"}), 404
+            planName = params.get("light_plan")
+            if planName is not None and not (SAFE_NAME.fullmatch(str(planName)) and os.path.exists(planPath(planName))):
+                return jsonify({"message":f"Unknown light plan {planName}"}), 404
+
+            # Create the model using the parameters sent by the application
+            def createModel():
+                if snapshotName is not None:
+                    return load_snapshot(
+                        snapshotPath(snapshotName),
+                        reseed=params.get("reseed"),
+                        profile=bool(params.get("profile", PROFILE_DEFAULT)),
+                        record_dir=os.path.join(REPLAY_DIR, requestedId) if params.get("record") else None,
+                    )
+                return CityModel(
+                    int(params.get("N", 4)),
+                    compact=bool(params.get("compact", True)),
+                    compact_cars=bool(params.get("compact_cars", False)),
+                    contracted_routes=bool(params.get("contracted_routes", False)),
+                    route_workers=int(params["route_workers"]) if params.get("route_workers") else None,
+                    engine=params.get("engine", "agents"),
+                    workers=int(params["workers"]) if params.get("workers") else None,
+                    map_file=map_path(str(params.get("map", "2024"))),
+                    spawn_every=int(params.get("spawn_every", 4)),
+                    seed=params.get("seed"),
+                    profile=bool(params.get("profile", PROFILE_DEFAULT)),
+                    record_dir=os.path.join(REPLAY_DIR, requestedId) if params.get("record") else None,
+                    light_plan=planPath(planName) if planName is not None else None,
+                )
+
+            session = sessions.create(createModel, requestedId)
+            session.checkpoint_every = int(params["checkpoint_every"]) if params.get("checkpoint_every") else None
             # Return a message to saying that the model was created successfully
             return jsonify({
                 "message":"Parameters recieved, model initiated.",
-                "width": cityModel.width,
-                "height": cityModel.height
-            })
-        else:
-            return jsonify({
-                "message":"Model already initiated",
-                "width": cityModel.width,
-                "height": cityModel.height
+                "session": session.session_id,
+                "step": session.model.schedule.steps,
+                "width": session.model.width,
+                "height": session.model.height
             })
 
-        # except Exception as e:
-        #     print(e)
-        #     return jsonify({"message":"Erorr initializing the model"}), 500
+        except Exception as e:
+            print(e)
+            return jsonify({"message":"Erorr initializing the model"}), 500
+
+# This route deletes a session and its model
+@app.route('/close', methods=['POST'])
+@cross_origin()
+def closeSession():
+    if request.method == 'POST':
+        if not sessions.remove(sessionId()):
+            return unknownSession()
+        return jsonify({"message":"Session closed"})
+
+# This route saves the model of the session as a snapshot, named after the session unless a name is given in the JSON body
+@app.route('/snapshot', methods=['POST'])
+@cross_origin()
+def snapshotModel():
+    if request.method == 'POST':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
+        name = str((request.get_json(silent=True) or {}).get("name", session.session_id))
+        if not SAFE_NAME.fullmatch(name):
+            return jsonify({"message":"Snapshot names are made of letters, digits, _ and -"}), 400
+        try:
+            with session.lock:
+                save_snapshot(session.model, snapshotPath(name))
+                step = session.model.schedule.steps
+            return jsonify({"message":"Snapshot saved", "snapshot": name, "step": step})
+
+        except Exception as e:
+            print(e)
+            return jsonify({"message":"Error saving the snapshot"}), 500
+
+# Largest number of steps a single /update request may advance
+MAX_STEPS_PER_UPDATE = 10000
 
 # This route will be used to update the model
+# Optional query parameters:
+#   k=<steps>               Advance several steps at once (fast-forward), without serializing the intermediate ones
+#   include=cars,lights     Also return the resulting state, saving the /get-cars round trip. Cars come as a car frame
+#                           (see carframes.py) and lights as 1 (green) / 0 (red) in the order of /get-lights
+#   since=<step>            With include=cars, the cars that changed since that step (default: since the step before this update)
+#   format=json|msgpack     Encoding of the combined response
 @app.route('/update', methods=['GET'])
 @cross_origin()
 def updateModel():
-    global cityModel
     if request.method == 'GET':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
+        cityModel = session.model
         try:
+            steps = request.args.get("k", default=1, type=int)
+            if steps < 1 or steps > MAX_STEPS_PER_UPDATE:
+                return jsonify({"message":f"k must be between 1 and {MAX_STEPS_PER_UPDATE}"}), 400
+            include = set(filter(None, request.args.get("include", "").split(",")))
+            since = request.args.get("since", type=int)
+
             # Update the model and return a message to WebGL saying that the model was updated successfully
-            cityModel.step()
-            return jsonify({
-                'message': f'Model updated to step <replace to step>'
-            })
+            with session.lock:
+                previousStep = cityModel.schedule.steps
+                # Read under the lock, the stream loop may have stepped the model since the request arrived
+                if since is None:
+                    since = previousStep
+                for _ in range(steps):
+                    cityModel.step()
+                session.measure()
+                checkpointSession(session, previousStep)
+
+                response = {
+                    'message': f'Model updated to step {cityModel.schedule.steps}',
+                    'step': cityModel.schedule.steps
+                }
+                if "cars" in include:
+                    response["cars"] = frame_lists(car_frame(cityModel, since))
+                if "lights" in include:
+                    response["lights"] = cityModel.city.light_state.astype(int).tolist()
+
+            if request.args.get("format") == "msgpack":
+                if msgpack is None:
+                    return jsonify({"message":"msgpack is not installed on the server"}), 400
+                with requestProfiler.phase("serialize", endpoint="update"):
+                    return Response(msgpack.packb(response), mimetype="application/msgpack")
+            with requestProfiler.phase("serialize", endpoint="update"):
+                return jsonify(response)
         except Exception as e:
             print(e)
             return jsonify({"message":"Error during step."}), 500
 
+def carFrameResponse(frame, frameFormat):
+    """Encodes a car frame as raw little-endian binary, msgpack or JSON struct-of-arrays."""
+    if frameFormat == "msgpack" and msgpack is None:
+        return jsonify({"message":"msgpack is not installed on the server"}), 400
+    with requestProfiler.phase("serialize", endpoint="get-cars"):
+        if frameFormat == "binary":
+            return Response(encode_binary(frame), mimetype="application/octet-stream")
+        if frameFormat == "msgpack":
+            return Response(msgpack.packb(frame_lists(frame)), mimetype="application/msgpack")
+        return jsonify(frame_lists(frame))
+
 # This route will be used to get the positions of the cars
+# Optional query parameters:
+#   format=json|binary|msgpack  Struct-of-arrays frame with integer ids and direction codes (see carframes.py)
+#   since=<step>                Only the cars that spawned, moved or despawned since that step
 @app.route('/get-cars', methods=['GET'])
 @cross_origin()
 def getCars():
-    global cityModel
     if request.method == 'GET':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
+        cityModel = session.model
         try:
+            frameFormat = request.args.get("format")
+            since = request.args.get("since", type=int)
+            if frameFormat is not None or since is not None:
+                with session.lock:
+                    frame = car_frame(cityModel, since)
+                return carFrameResponse(frame, frameFormat)
+
             # Get the positions of the cars and return them to WebGL in JSON.json.
             # The positions are sent as a list of dictionaries, where each dictionary has the id and position of a car.
-            carPositions = []
-            for agent in cityModel.schedule.agents:
-                if isinstance(agent, Car):
+            with session.lock:
+                cars = cityModel.get_cars()
+            with requestProfiler.phase("serialize", endpoint="get-cars"):
+                carPositions = []
+                for unique_id, (x, z), direction in cars:
                     carPositions.append({
-                        "id": str(agent.unique_id), 
-                        "x": agent.pos[0],
+                        "id": str(unique_id), 
+                        "x": x,
                         "y": 0,
-                        "dir": agent.direction,
-                        "z": agent.pos[1]
+                        "dir": direction,
+                        "z": z
                     })
                     
 
-            return jsonify({
-                "cars": carPositions
-            })
+                return jsonify({
+                    "cars": carPositions
+                })
 
         except Exception as e:
             print(e)
             return jsonify({"message":"Error with car positions"}), 500
 
+def staticCityPayload(model):
+    """
+    Serializes the static layout of a model once: the JSON body, its gzip version and its ETag.
+    The layout never changes after /init, so every later /get-city request reuses them.
+    """
+    payload = staticCityCache.get(model)
+    if payload is None:
+        city = model.city
+
+        def cellPositions(kind, prefix):
+            return [{
+                "id": f"{prefix}_{(city.height - z - 1) * city.width + x}",
+                "x": x,
+                "y": 1,
+                "z": z
+            } for x, z in city.cells_of(kind)]
+
+        # The positions are read from the model's static city layer, so it also works when roads and obstacles are not agents.
+        body = json.dumps({
+            "buildings": cellPositions(OBSTACLE, "ob"),
+            "roads": cellPositions(ROAD, "r"),
+            "destinations": cellPositions(DESTINATION, "d"),
+            "trafficLights": cellPositions(TRAFFIC_LIGHT, "tl")
+        }, separators=(",", ":")).encode()
+        payload = {
+            "body": body,
+            "gzip": gzip.compress(body),
+            "etag": hashlib.sha1(body).hexdigest()
+        }
+        staticCityCache[model] = payload
+    return payload
+
 # This route will be used to get the positions of all the city objects
 @app.route('/get-city', methods=['GET'])
 @cross_origin()
 def getCity():
-    global cityModel
     if request.method == 'GET':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
         try:
             # Get the positions of the objects and return them to WebGL in JSON.json.t.
             # Same as before, the positions are sent as a list of dictionaries, where each dictionary has the id and position of an object.
-            buildingPositions = []
-            roadsPositions = []
-            destinationsPositions = []
-            trafficLightPositions = []
-            for agents, (x, z) in cityModel.grid.coord_iter():
-                for agent in agents:
-                    if isinstance(agent, Obstacle):
-                        buildingPositions.append({
-                            "id": str(agent.unique_id),
-                            "x": x,
-                            "y":1,
-                            "z":z
-                        })
-                    elif isinstance(agent, Road):
-                        roadsPositions.append({
-                            "id": str(agent.unique_id), 
-                            "x": x, 
-                            "y":1, 
-                            "z":z
-                        })
-                    elif isinstance(agent, Destination):
-                        destinationsPositions.append({
-                            "id": str(agent.unique_id), 
-                            "x": x, 
-                            "y":1, 
-                            "z":z
-                        })
-                    elif isinstance(agent, Traffic_Light):
-                        trafficLightPositions.append({
-                            "id": str(agent.unique_id), 
-                            "x": x, 
-                            "y":1, 
-                            "z":z
-                        })
+            # The layout is serialized once per model and clients that already have it get a 304.
+            payload = staticCityPayload(session.model)
+            if request.if_none_match.contains(payload["etag"]):
+                response = Response(status=304)
+            elif request.accept_encodings["gzip"]:
+                response = Response(payload["gzip"], mimetype="application/json")
+                response.headers["Content-Encoding"] = "gzip"
+            else:
+                response = Response(payload["body"], mimetype="application/json")
 
-            return jsonify({
-                "buildings": buildingPositions,
-                "roads": roadsPositions,
-                "destinations": destinationsPositions,
-                "trafficLights": trafficLightPositions
-            })
+            response.set_etag(payload["etag"])
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Accept-Encoding")
+            return response
 
         except Exception as e:
             print(e)
             return jsonify({"message":"Error with city objects positions"}), 500
 
+# This route will be used to get the state of the traffic lights, the only part of the city that changes
+@app.route('/get-lights', methods=['GET'])
+@cross_origin()
+def getLights():
+    if request.method == 'GET':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
+        cityModel = session.model
+        try:
+            with session.lock:
+                city = cityModel.city
+                return jsonify({
+                    "step": cityModel.schedule.steps,
+                    "lights": [{
+                        "id": light.unique_id,
+                        "state": bool(city.light_state[light.index])
+                    } for light in cityModel.traffic_lights]
+                })
+
+        except Exception as e:
+            print(e)
+            return jsonify({"message":"Error with traffic light states"}), 500
+
+# This route starts advancing the model on the server at a fixed rate, for the viewers of /stream
+@app.route('/stream/start', methods=['POST'])
+@cross_origin()
+def startStream():
+    if request.method == 'POST':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
+        tickRate = request.args.get("tick_rate", default=10.0, type=float)
+        if tickRate <= 0:
+            return jsonify({"message":"tick_rate must be positive"}), 400
+        if session.loop is None:
+            session.loop = SimulationLoop(session.model, tick_rate=tickRate, lock=session.lock, on_step=session.measure)
+        session.loop.tick_rate = tickRate
+        session.loop.start()
+        return jsonify({"message":"Simulation loop running", "tick_rate": tickRate})
+
+@app.route('/stream/stop', methods=['POST'])
+@cross_origin()
+def stopStream():
+    if request.method == 'POST':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
+        if session.loop is not None:
+            session.loop.stop()
+        return jsonify({"message":"Simulation loop stopped"})
+
+# This route pushes a frame (car frame and light states) to the viewer at every tick, as Server-Sent Events
+@app.route('/stream', methods=['GET'])
+@cross_origin()
+def streamFrames():
+    if request.method == 'GET':
+        session = currentSession()
+        if session is None:
+            return unknownSession()
+        if not session.streaming:
+            return jsonify({"message":"Simulation loop not running, POST /stream/start first"}), 409
+
+        loop = session.loop
+        subscription = loop.subscribe()
+
+        def events():
+            try:
+                yield from sse_events(subscription)
+            finally:
+                loop.unsubscribe(subscription)
+
+        return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# This route describes a recording: number of steps, map size and the ids of the traffic lights in the order of their states
+@app.route('/replay/<name>', methods=['GET'])
+@cross_origin()
+def replayInfo(name):
+    if request.method == 'GET':
+        with replayLock:
+            try:
+                reader = replayReader(name)
+            except FileNotFoundError:
+                return recordingRestarted(name)
+            if reader is None:
+                return jsonify({"message":f"Unknown recording {name}"}), 404
+            meta = reader.meta
+            return jsonify({
+                "first_step": reader.first_step,
+                "steps": reader.steps,
+                "width": meta["width"],
+                "height": meta["height"],
+                "map": meta["map"],
+                "lights": meta["lights"]
+            })
+
+# This route serves a recorded frame, at any step and without running the simulation
+# Query parameters:
+#   step=<step>                 Recorded step, from first_step (0, the initial state, unless restored from a snapshot)
+#   since=<step>                Only the cars that changed since that recorded step (any step, also a later one)
+#   format=json|binary|msgpack  Car frame as in /get-cars. In binary the light states follow the frame, one byte per light
+@app.route('/replay/<name>/frame', methods=['GET'])
+@cross_origin()
+def replayFrame(name):
+    if request.method == 'GET':
+        step = request.args.get("step", type=int)
+        since = request.args.get("since", type=int)
+        frameFormat = request.args.get("format")
+        if step is None:
+            return jsonify({"message":"step is required"}), 400
+        with replayLock:
+            try:
+                reader = replayReader(name)
+            except FileNotFoundError:
+                return recordingRestarted(name)
+            if reader is None:
+                return jsonify({"message":f"Unknown recording {name}"}), 404
+            try:
+                frame = reader.frame(step, since)
+            except IndexError as e:
+                return jsonify({"message":str(e)}), 404
+
+        lights = frame.pop("lights")
+        if frameFormat == "binary":
+            return Response(encode_binary(frame) + lights.tobytes(), mimetype="application/octet-stream")
+        if frameFormat == "msgpack" and msgpack is None:
+            return jsonify({"message":"msgpack is not installed on the server"}), 400
+        response = dict(frame_lists(frame), lights=lights.tolist())
+        if frameFormat == "msgpack":
+            return Response(msgpack.packb(response), mimetype="application/msgpack")
+        return jsonify(response)
+
+# This route exposes the profiling data and the gauges of every session in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    sources = [({}, requestProfiler.copy())]
+    gauges = []
+    for session in sessions.live():
+        labels = {"session": session.session_id}
+        # Copied under the lock of the session, so the model can keep stepping while the text is rendered
+        with session.lock:
+            sources.append((labels, session.model.profiler.copy()))
+            gauges.extend(model_gauges(session.model, labels))
+    body = render_prometheus(sources, gauges)
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
 if __name__=='__main__':
     # Run the flask server in port 8585
-    app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file
+    app.run(host="localhost", port=8585, debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""
+Registry of independent simulations for the Flask server.
+
+Every session owns one CityModel and the lock that serializes the requests
+touching it, so sessions never block each other. Sessions that were not used
+for `ttl` seconds are evicted, and the least recently used ones are evicted
+when there are too many of them or their estimated memory goes over a cap.
+"""
+from collections import OrderedDict
+import threading
+import time
+import uuid
+
+# Rough size of one Car agent with its path, used to estimate the memory of a session
+CAR_AGENT_BYTES = 2048
+
+def estimate_model_bytes(model):
+    """Estimated memory of a model: static arrays, road graph, route trees and cars."""
+    graph = model.road_graph
+    total = model.city.nbytes + graph.indptr.nbytes + graph.indices.nbytes + graph.costs.nbytes
+    total += sum(tree.nbytes for tree in model.routes.trees.values())
+    total += sum(distance.nbytes for distance in model.routes.distances.values())
+    if model.routes.contracted is not None:
+        total += model.routes.contracted.nbytes
+    if model.fleet is not None:
+        total += model.fleet.nbytes
+    else:
+        total += len(model.occupancy) * CAR_AGENT_BYTES
+    return total
+
+class Session:
+    """
+    One simulation owned by a client.
+    Attributes:
+        session_id: Key of the session in the registry
+        model: The CityModel of the session
+        lock: Held while the model is stepped or read
+        loop: SimulationLoop streaming the model, if one was started
+        checkpoint_every: Steps between two automatic snapshots of the model, None for none
+        last_used: time.monotonic() of the last request
+        estimated_bytes: estimate_model_bytes of the model after its last step, read by the registry without the
+            session lock
+    """
+    def __init__(self, session_id, model):
+        self.session_id = session_id
+        self.model = model
+        self.lock = threading.Lock()
+        self.loop = None
+        self.checkpoint_every = None
+        self.last_used = time.monotonic()
+        self.estimated_bytes = estimate_model_bytes(model)
+
+    def measure(self):
+        """Updates estimated_bytes after the model stepped. Call with the session lock held."""
+        self.estimated_bytes = estimate_model_bytes(self.model)
+
+    @property
+    def streaming(self):
+        return self.loop is not None and self.loop.running
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.stop()
+        with self.lock:
+            self.model.close()
+
+class SessionRegistry:
+    """
+    Session id -> Session, in least recently used order.
+    Args:
+        max_sessions: Maximum number of live sessions
+        ttl: Seconds without requests after which a session is evicted (streaming sessions are kept)
+        max_bytes: Cap on the estimated memory of all the models, None for no cap
+        on_close: Callable called with every session after it is closed, evicted or removed, None for nothing
+    """
+    def __init__(self, max_sessions=32, ttl=1800.0, max_bytes=None, on_close=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.on_close = on_close
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id):
+        """Returns a session and marks it as used, or None if it does not exist (anymore)."""
+        with self.lock:
+            evicted = self._evict_idle()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self.sessions.move_to_end(session_id)
+        for old in evicted:
+            self._close(old)
+        return session
+
+    def live(self):
+        """Returns the live sessions, least recently used first, without marking them as used."""
+        with self.lock:
+            return list(self.sessions.values())
+
+    def create(self, model_factory, session_id=None):
+        """
+        Creates a session with a new model, replacing the session with the same id if any.
+        The model is built outside the registry lock so other sessions keep being served.
+        Args:
+            model_factory: Callable returning the CityModel of the session
+            session_id: Id of the session, a random one by default
+        """
+        session = Session(session_id or uuid.uuid4().hex, model_factory())
+        with self.lock:
+            previous = self.sessions.pop(session.session_id, None)
+            self.sessions[session.session_id] = session
+            evicted = self._evict_idle() + self._evict_over_capacity()
+        for old in ([previous] if previous is not None else []) + evicted:
+            self._close(old)
+        return session
+
+    def remove(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self._close(session)
+        return session is not None
+
+    def _close(self, session):
+        """Closes a session that left the registry. Must be called without the registry lock."""
+        session.close()
+        if self.on_close is not None:
+            self.on_close(session)
+
+    def _evict_idle(self):
+        """Drops the sessions unused for longer than the ttl. Must be called with the registry lock held."""
+        now = time.monotonic()
+        expired = [
+            session for session in self.sessions.values()
+            if now - session.last_used > self.ttl and not session.streaming
+        ]
+        for session in expired:
+            del self.sessions[session.session_id]
+        return expired
+
+    def _evict_over_capacity(self):
+        """Drops the least recently used sessions while over the caps, never the newest one."""
+        evicted = []
+        while len(self.sessions) > 1 and (len(self.sessions) > self.max_sessions or self._over_memory()):
+            _, session = self.sessions.popitem(last=False)
+            evicted.append(session)
+        return evicted
+
+    def _over_memory(self):
+        if self.max_bytes is None:
+            return False
+        # The models may be stepping under their own locks, only their last estimates are read
+        return sum(session.estimated_bytes for session in self.sessions.values()) > self.max_bytes
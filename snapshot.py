@@ -0,0 +1,210 @@
+"""
+Snapshots of the full state of a CityModel.
+
+A snapshot holds everything that changes while a model runs: the cars with
+their paths and path cursors (or the BatchEngine arrays), the traffic light
+states and timers, the sleeping cars with their timeouts and pending route
+requests, the routes planned for them, the counters, the trip statistics, the recent metrics, the random number generators and the
+step counter. The static city comes from the map cache again, so restoring is
+about as fast as creating a model, and the restored model steps exactly like
+the saved one would have. Example:
+
+    save_snapshot(model, "warm.npz")
+    runs = [load_snapshot("warm.npz", reseed=seed) for seed in range(8)]
+
+A snapshot is an .npz file of arrays plus a JSON "meta" entry, loaded without
+pickle. The trajectory recording, the metrics spilled to disk and the profiler
+are not part of it.
+"""
+import json
+import os
+import numpy as np
+from roadgraph import DIRECTIONS, DIRECTION_CODES
+from scheduler import event_key
+from model import CityModel
+
+# Bump when the layout of the snapshot changes, so old files are refused
+SNAPSHOT_VERSION = 3
+
+def _stats_state(stats):
+    return {"count": stats.count, "mean": stats.mean, "m2": stats.m2, "min": stats.min, "max": stats.max}
+
+def _set_stats_state(stats, state, histogram):
+    for name, value in state.items():
+        setattr(stats, name, value)
+    stats.histogram = np.array(histogram, dtype=np.int64)
+
+def snapshot_state(model):
+    """Returns (meta, arrays) of a model: the plain data and the arrays of its state."""
+    version, random_state, gauss = model.random.getstate()
+    schedule = model.schedule
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "settings": model.settings,
+        "random": {"version": version, "gauss": gauss},
+        "counters": {
+            "num_agents": model.num_agents,
+            "cars_reached_destination": model.cars_reached_destination,
+            "cars_spawned": model.cars_spawned,
+            "next_car_id": model.next_car_id,
+            "car_count": model.car_count,
+            "corner": model.i,
+            "running": model.running,
+        },
+        "trips": {"travel_time": _stats_state(model.trips.travel_time), "light_wait": _stats_state(model.trips.light_wait)},
+        "metrics_rows": model.datacollector.rows,
+        "schedule": schedule.get_state(lambda agent: agent.unique_id),
+        "route_requests": model.planner.get_state() if model.planner is not None else [],
+    }
+    arrays = {
+        "random_state": np.array(random_state, dtype=np.uint32),
+        "light_state": model.city.light_state,
+        "light_time": model.city.light_time,
+        "light_offset": model.city.light_offset,
+        "travel_time_histogram": model.trips.travel_time.histogram,
+        "light_wait_histogram": model.trips.light_wait.histogram,
+        "metrics_ring": model.datacollector.ring,
+    }
+    # Routes planned off the step in the order they were kept, the cars asking for them again do not wait
+    planned = model.routes.planned
+    arrays.update({
+        "planned_key": np.array([[state, *goal] for state, goal in planned], dtype=np.int64).reshape(-1, 3),
+        "planned_start": np.cumsum([0] + [len(path) for path in planned.values()], dtype=np.int64),
+        "planned_cells": np.array([cell for path in planned.values() for cell in path], dtype=np.int32).reshape(-1, 2),
+    })
+
+    if model.fleet is not None:
+        meta["fleet"], fleet_arrays = model.fleet.get_state()
+        arrays.update({f"fleet_{name}": array for name, array in fleet_arrays.items()})
+        return meta, arrays
+
+    # One row per car, with the rest of its path flattened into path_cells and delimited by path_start
+    cars = list(model.occupancy.values())
+    destination_index = {destination: index for index, destination in enumerate(model.destinations)}
+    paths = [car.remaining_path() for car in cars]
+    meta["car_names"] = [car.unique_id for car in cars]
+    arrays.update({
+        "car_id": np.array([car.car_id for car in cars], dtype=np.int64),
+        "car_pos": np.array([car.pos for car in cars], dtype=np.int32).reshape(-1, 2),
+        "car_direction": np.array([DIRECTION_CODES[car.direction] for car in cars], dtype=np.int8),
+        "car_objective": np.array([destination_index[car.objective] for car in cars], dtype=np.int32),
+        "car_path_found": np.array([car.path_Found for car in cars], dtype=bool),
+        "car_spawn_step": np.array([car.spawn_step for car in cars], dtype=np.int64),
+        "car_light_wait": np.array([car.light_wait for car in cars], dtype=np.int64),
+        # -1 stands for None
+        "car_red_since": np.array([-1 if car.red_since is None else car.red_since for car in cars], dtype=np.int64),
+        "car_blocked_since": np.array([-1 if car.blocked_since is None else car.blocked_since for car in cars], dtype=np.int64),
+        "path_start": np.cumsum([0] + [len(path) for path in paths], dtype=np.int64),
+        "path_cells": np.array([cell for path in paths for cell in path], dtype=np.int32).reshape(-1, 2),
+    })
+    return meta, arrays
+
+def save_snapshot(model, path):
+    """Writes the snapshot of a model to an .npz file, atomically so a crash never leaves half a snapshot."""
+    meta, arrays = snapshot_state(model)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        np.savez_compressed(file, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(temporary, path)
+
+def read_snapshot(path):
+    """Reads the (meta, arrays) of a snapshot file written by save_snapshot."""
+    with np.load(path) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {meta['version']}")
+        arrays = {name: data[name] for name in data.files if name != "meta"}
+    return meta, arrays
+
+def restore_model(meta, arrays, reseed=None, **options):
+    """
+    Creates a model in the state of a snapshot.
+    Args:
+        meta: Plain data of the snapshot
+        arrays: Arrays of the snapshot
+        reseed: Seed the random number generators again after restoring, so runs forked from one snapshot differ.
+            None continues exactly like the saved model
+        options: Other CityModel arguments, e.g. metrics_dir, profile or record_dir
+    """
+    # Recording starts once the model is in the state of the snapshot
+    record_dir = options.pop("record_dir", None)
+    model = CityModel(0, **meta["settings"], **options)
+    counters = meta["counters"]
+    model.num_agents = counters["num_agents"]
+    model.cars_reached_destination = counters["cars_reached_destination"]
+    model.cars_spawned = counters["cars_spawned"]
+    model.next_car_id = counters["next_car_id"]
+    model.car_count = counters["car_count"]
+    model.i = counters["corner"]
+    model.running = counters["running"]
+
+    model.city.light_state[:] = arrays["light_state"]
+    model.city.light_time[:] = arrays["light_time"]
+    if "light_offset" in arrays:
+        model.city.light_offset[:] = arrays["light_offset"]
+    for light in model.traffic_lights:
+        light.timeToChange = int(model.city.light_time[light.index])
+        light.offset = int(model.city.light_offset[light.index])
+
+    _set_stats_state(model.trips.travel_time, meta["trips"]["travel_time"], arrays["travel_time_histogram"])
+    _set_stats_state(model.trips.light_wait, meta["trips"]["light_wait"], arrays["light_wait_histogram"])
+    ring = arrays["metrics_ring"]
+    # The ring keeps its capacity, only the last steps are restored when it was saved with a larger one
+    capacity = model.datacollector.ring.shape[0]
+    rows = meta["metrics_rows"]
+    for row in range(max(0, rows - min(capacity, ring.shape[0])), rows):
+        model.datacollector.ring[row % capacity] = ring[row % ring.shape[0]]
+    model.datacollector.rows = rows
+
+    if "planned_key" in arrays:
+        planned_start = arrays["planned_start"]
+        planned_cells = [tuple(cell) for cell in arrays["planned_cells"].tolist()]
+        for row, (state, x, y) in enumerate(arrays["planned_key"].tolist()):
+            model.routes.planned[(state, (x, y))] = planned_cells[planned_start[row]:planned_start[row + 1]]
+
+    agents = {agent.unique_id: agent for agent in model.traffic_lights}
+    if model.fleet is not None:
+        prefix = "fleet_"
+        model.fleet.set_state(meta["fleet"], {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)})
+    else:
+        path_start = arrays["path_start"]
+        path_cells = [tuple(cell) for cell in arrays["path_cells"].tolist()]
+        for row, name in enumerate(meta["car_names"]):
+            car = model.car_class(name, model, DIRECTIONS[int(arrays["car_direction"][row])],
+                      model.destinations[int(arrays["car_objective"][row])], int(arrays["car_id"][row]))
+            car.spawn_step = int(arrays["car_spawn_step"][row])
+            car.light_wait = int(arrays["car_light_wait"][row])
+            red_since = int(arrays["car_red_since"][row])
+            car.red_since = None if red_since < 0 else red_since
+            blocked_since = int(arrays["car_blocked_since"][row])
+            car.blocked_since = None if blocked_since < 0 else blocked_since
+            car.path_Found = bool(arrays["car_path_found"][row])
+            model.place_car(car, tuple(arrays["car_pos"][row].tolist()))
+            car.follow(path_cells[path_start[row]:path_start[row + 1]])
+            agents[name] = car
+
+    model.schedule.set_state(meta["schedule"], agents.__getitem__)
+    # Cars waiting for a planned route ask for it again, or search it themselves without a planner
+    requests = [(event_key(key), due) for key, due in meta.get("route_requests", [])]
+    if model.planner is not None:
+        model.planner.set_state(requests)
+    else:
+        for key, _ in requests:
+            model.schedule.notify(key)
+    model.random.setstate((meta["random"]["version"], tuple(arrays["random_state"].tolist()), meta["random"]["gauss"]))
+    # Clients asking for deltas from before the snapshot get a full frame
+    model.car_changes.clear(model.schedule.steps)
+
+    if reseed is not None:
+        model.random.seed(reseed)
+        if model.fleet is not None:
+            model.fleet.reseed(model.random.getrandbits(32))
+    if record_dir is not None:
+        model.start_recording(record_dir)
+    return model
+
+def load_snapshot(path, reseed=None, **options):
+    """Creates a model in the state saved in a snapshot file. See restore_model for the arguments."""
+    meta, arrays = read_snapshot(path)
+    return restore_model(meta, arrays, reseed, **options)
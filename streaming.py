@@ -0,0 +1,158 @@
+"""
+Push-based streaming of simulation frames.
+
+A SimulationLoop advances one CityModel on a background thread at a fixed tick
+rate and hands every frame to its subscribers, so many viewers share one
+simulation instead of each of them driving step(). Frames are delta car frames
+encoded once per tick. Each subscriber has a small bounded queue: when a viewer
+falls behind, its queued deltas are dropped and replaced by one full frame, so
+the loop never waits for anybody.
+"""
+from collections import deque
+import json
+import threading
+import time
+from carframes import car_frame, frame_lists
+
+class Subscription:
+    """
+    Frames waiting to be sent to one viewer.
+    Args:
+        max_frames: Frames kept before the oldest ones are dropped
+    """
+    def __init__(self, max_frames=8):
+        self.frames = deque(maxlen=max_frames)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        # The first frame, and the frame after the viewer lagged behind, must carry every car
+        self.needs_full = True
+        self.closed = False
+
+    @property
+    def lagging(self):
+        """Whether the viewer has not read its queued frames fast enough."""
+        return len(self.frames) == self.frames.maxlen
+
+    def offer(self, frame, full=False):
+        """
+        Queues a frame without ever blocking. A full frame replaces every frame still queued,
+        since the viewer does not need the older deltas anymore.
+        """
+        with self.condition:
+            if full:
+                self.dropped += len(self.frames)
+                self.frames.clear()
+                self.needs_full = False
+            self.frames.append(frame)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Returns the next frame, or None when none arrived before the timeout or the subscription was closed."""
+        with self.condition:
+            if not self.frames and not self.closed:
+                self.condition.wait(timeout)
+            return self.frames.popleft() if self.frames else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class SimulationLoop:
+    """
+    Steps a model on a background thread and pushes the resulting frames to subscribers.
+    Args:
+        model: The CityModel to advance
+        tick_rate: Steps per second, can be changed while the loop runs
+        lock: Lock held while the model is stepped or read, shared with the request handlers
+        max_frames: Queue length of every subscriber
+        on_step: Callable called after every step with the lock held, None for nothing
+    """
+    def __init__(self, model, tick_rate=10.0, lock=None, max_frames=8, on_step=None):
+        self.model = model
+        self.on_step = on_step
+        self.tick_rate = tick_rate
+        self.lock = lock or threading.Lock()
+        self.max_frames = max_frames
+        self.subscribers = set()
+        self.subscribers_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # Step of the last frame sent, deltas cover everything that changed after it
+        self.last_step = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="simulation-loop", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self.subscribers_lock:
+            for subscription in self.subscribers:
+                subscription.close()
+
+    def subscribe(self):
+        subscription = Subscription(self.max_frames)
+        with self.subscribers_lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.subscribers_lock:
+            self.subscribers.discard(subscription)
+        subscription.close()
+
+    def _frame(self, since):
+        """Serializes the state of the model once, as a delta since a step or as a full frame."""
+        frame = {
+            "step": self.model.schedule.steps,
+            "cars": frame_lists(car_frame(self.model, since)),
+            "lights": self.model.city.light_state.astype(int).tolist(),
+        }
+        return json.dumps(frame, separators=(",", ":"))
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            with self.lock:
+                self.model.step()
+                if self.on_step is not None:
+                    self.on_step()
+                with self.subscribers_lock:
+                    subscribers = list(self.subscribers)
+                delta = full = None
+                for subscription in subscribers:
+                    if subscription.needs_full or subscription.lagging or self.last_step is None:
+                        full = full or self._frame(None)
+                        subscription.offer(full, full=True)
+                    else:
+                        delta = delta or self._frame(self.last_step)
+                        subscription.offer(delta)
+                self.last_step = self.model.schedule.steps
+
+            # Read on every tick, /stream/start changes the rate of a running loop
+            next_tick += 1.0 / self.tick_rate
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                # Running late: do not try to catch up with the missed ticks
+                next_tick = time.monotonic()
+
+def sse_events(subscription, keepalive=15.0):
+    """Generator of Server-Sent Events for a subscription, with comment lines as keepalives."""
+    while not subscription.closed:
+        frame = subscription.get(timeout=keepalive)
+        if frame is None:
+            yield ": keepalive\n\n"
+        else:
+            yield f"event: frame\ndata: {frame}\n\n"
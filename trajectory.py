@@ -0,0 +1,177 @@
+"""
+Trajectory recording and replay.
+
+A recording is a directory holding append-only binary files with fixed-width
+records, so a past run can be replayed by reading frames instead of stepping
+the model again:
+
+    meta.json   width, height, map, light ids and the record layouts
+    cars.bin    one CAR_RECORD per car and step: id, x, z, direction code, sorted by id within a step
+    steps.bin   one STEP_RECORD per step: index of the step's first car record and its number of cars
+    lights.bin  one byte per traffic light and step, 1 for green, in the order of model.traffic_lights
+
+Step k holds the state after k calls to step(), so step 0 is the initial
+state; a recording that started later, e.g. from a snapshot, starts at its
+first_step. A TrajectoryReader memory-maps the files: reading a frame costs
+a lookup in steps.bin and a slice of cars.bin, whatever the step. The writer
+writes the three files in that order and steps.bin last, so a reader never
+sees a step whose cars or lights are not written yet.
+"""
+import json
+import os
+import numpy as np
+
+CAR_RECORD = np.dtype([("id", "<u4"), ("x", "<u2"), ("z", "<u2"), ("dir", "u1")])
+STEP_RECORD = np.dtype([("offset", "<u8"), ("count", "<u4")])
+FORMAT_VERSION = 1
+
+class TrajectoryWriter:
+    """
+    Appends the cars and light states of every step of a model to a recording directory.
+    An existing recording in the directory is replaced.
+    Args:
+        directory: Directory of the recording
+        model: The recorded CityModel
+        flush_every: Steps kept in memory before they are written to the files
+    """
+    def __init__(self, directory, model, flush_every=32):
+        self.directory = directory
+        self.flush_every = flush_every
+        self.records = 0
+        self.first_step = model.schedule.steps
+        self.next_step = model.schedule.steps
+        self.pending = []
+        os.makedirs(directory, exist_ok=True)
+        # The old files are unlinked rather than truncated, readers that still map them keep their data
+        for name in ("meta.json", "cars.bin", "lights.bin", "steps.bin"):
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        with open(os.path.join(directory, "meta.json"), "w") as metaFile:
+            json.dump({
+                "version": FORMAT_VERSION,
+                "width": model.width,
+                "height": model.height,
+                "map": model.map_file,
+                "first_step": self.first_step,
+                "lights": [light.unique_id for light in model.traffic_lights],
+                "car_record": CAR_RECORD.descr,
+                "step_record": STEP_RECORD.descr,
+            }, metaFile)
+        # Unbuffered, flush() writes every file in one call and in a fixed order
+        self.files = {name: open(os.path.join(directory, f"{name}.bin"), "wb", buffering=0)
+                      for name in ("cars", "lights", "steps")}
+
+    def record(self, model):
+        """Records the cars and light states of the model at its current step."""
+        if model.schedule.steps != self.next_step:
+            raise ValueError(f"Expected step {self.next_step}, the model is at step {model.schedule.steps}")
+        ids, x, z, directions = model.get_car_arrays()
+        order = np.argsort(ids, kind="stable")
+        cars = np.empty(ids.size, dtype=CAR_RECORD)
+        cars["id"] = ids[order]
+        cars["x"] = x[order]
+        cars["z"] = z[order]
+        cars["dir"] = directions[order]
+        lights = model.city.light_state.astype(np.uint8)
+        self.pending.append((cars, lights, np.array([(self.records, cars.size)], dtype=STEP_RECORD)))
+        self.records += cars.size
+        self.next_step += 1
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending steps to the files."""
+        if not self.pending or self.files is None:
+            return
+        for index, name in enumerate(("cars", "lights", "steps")):
+            self.files[name].write(b"".join(step[index].tobytes() for step in self.pending))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.files is not None:
+            for recordFile in self.files.values():
+                recordFile.close()
+            self.files = None
+
+class TrajectoryReader:
+    """
+    Random access to the frames of a recording, through memory maps of its files.
+    Call refresh() to see the steps appended since the reader was opened.
+    Args:
+        directory: Directory of the recording
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.steps = 0
+        self._version = None
+        self.refresh()
+
+    def _load_meta(self):
+        with open(os.path.join(self.directory, "meta.json")) as metaFile:
+            self.meta = json.load(metaFile)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported recording version {self.meta['version']}")
+        self.light_count = len(self.meta["lights"])
+        self.first_step = self.meta["first_step"]
+
+    def _map(self, name, dtype, count):
+        if count == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, f"{name}.bin"), dtype=dtype, mode="r", shape=(count,))
+
+    def refresh(self):
+        """Maps the steps written so far, or the new recording if the directory was recorded again. Returns the number of steps."""
+        status = os.stat(os.path.join(self.directory, "steps.bin"))
+        version = (status.st_ino, status.st_size)
+        if self._version is None or version[0] != self._version[0]:
+            self._load_meta()
+        if version != self._version:
+            self._version = version
+            steps = status.st_size // STEP_RECORD.itemsize
+            self.index = self._map("steps", STEP_RECORD, steps)
+            records = int(self.index["offset"][-1] + self.index["count"][-1]) if steps else 0
+            self.cars = self._map("cars", CAR_RECORD, records)
+            self.lights = self._map("lights", np.uint8, steps * self.light_count).reshape(steps, self.light_count)
+            self.steps = steps
+        return self.steps
+
+    @property
+    def last_step(self):
+        return self.first_step + self.steps - 1
+
+    def _cars_at(self, step):
+        if not self.first_step <= step <= self.last_step:
+            raise IndexError(f"Step {step} is not in the recording ({self.first_step} to {self.last_step})")
+        offset, count = self.index[step - self.first_step]
+        return self.cars[int(offset):int(offset) + int(count)]
+
+    def frame(self, step, since=None):
+        """
+        Returns the car frame of a step, in the format of carframes.car_frame, plus its light states.
+        Args:
+            step: Recorded step
+            since: Only return the cars that spawned, moved or turned since this recorded step, and the removed ones
+        """
+        cars = self._cars_at(step)
+        removed = np.empty(0, dtype=np.uint32)
+        if since is not None:
+            before = self._cars_at(since)
+            if before.size:
+                # Records are sorted by id, so each car is matched with its record of the earlier step by a binary search
+                positions = np.minimum(np.searchsorted(before["id"], cars["id"]), before.size - 1)
+                removed = np.setdiff1d(before["id"], cars["id"], assume_unique=True).astype(np.uint32)
+                cars = cars[before[positions] != cars]
+        return {
+            "step": step,
+            "full": since is None,
+            "ids": np.array(cars["id"], dtype=np.uint32),
+            "x": np.array(cars["x"], dtype=np.uint16),
+            "z": np.array(cars["z"], dtype=np.uint16),
+            "dir": np.array(cars["dir"], dtype=np.uint8),
+            "removed": removed,
+            "lights": np.array(self.lights[step - self.first_step]),
+        }
+
+    def close(self):
+        self.index = self.cars = self.lights = None
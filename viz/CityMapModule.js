@@ -0,0 +1,136 @@
+/* CityMapModule.js
+ Client of cityviz.CityMapElement. Three stacked canvases: the static city, drawn once
+ from the "full" frame, the traffic lights and the cars. A "delta" frame only redraws
+ the lights that switched and the cells of the cars that spawned, moved or left.
+*/
+const CityMapModule = function (canvas_width, canvas_height) {
+  const CAR_COLOR = "blue";
+
+  const parent = document.createElement("div");
+  parent.className = "world-grid-parent";
+  parent.style.height = `${canvas_height}px`;
+  parent.style.position = "relative";
+  const createCanvas = () => {
+    const canvas = document.createElement("canvas");
+    canvas.width = canvas_width;
+    canvas.height = canvas_height;
+    canvas.className = "world-grid";
+    canvas.style.position = "absolute";
+    canvas.style.left = "0";
+    canvas.style.top = "0";
+    parent.appendChild(canvas);
+    return canvas.getContext("2d");
+  };
+  const background = createCanvas();
+  const lightLayer = createCanvas();
+  const carLayer = createCanvas();
+  document.getElementById("elements").appendChild(parent);
+
+  let width = 0;
+  let height = 0;
+  let cellWidth = 1;
+  let cellHeight = 1;
+  let lightPositions = [];
+  let lightStates = [];
+  // Car id -> [x, y, direction code]
+  let cars = new Map();
+
+  // Grid y grows upwards like in Mesa, the canvas y downwards
+  const cellRect = (x, y) => [x * cellWidth, (height - y - 1) * cellHeight, cellWidth, cellHeight];
+
+  // Colors of the static cells by cell kind, sent with the full frame
+  const drawStatic = (cells, colors) => {
+    background.clearRect(0, 0, canvas_width, canvas_height);
+    // Cells come as base64 bytes, one per cell in x-major order
+    const kinds = atob(cells);
+    for (let x = 0; x < width; x++) {
+      for (let y = 0; y < height; y++) {
+        const color = colors[kinds.charCodeAt(x * height + y)];
+        if (color !== undefined) {
+          background.fillStyle = color;
+          background.fillRect(...cellRect(x, y));
+        }
+      }
+    }
+  };
+
+  const drawLight = (index) => {
+    const [x, y] = lightPositions[index];
+    lightLayer.fillStyle = lightStates[index] ? "green" : "red";
+    lightLayer.fillRect(...cellRect(x, y));
+  };
+
+  // Cars are triangles pointing in their heading: Up, Down, Left, Right
+  const TIPS = [[0.5, 0.1], [0.5, 0.9], [0.1, 0.5], [0.9, 0.5]];
+  const BASES = [
+    [[0.15, 0.9], [0.85, 0.9]],
+    [[0.15, 0.1], [0.85, 0.1]],
+    [[0.9, 0.15], [0.9, 0.85]],
+    [[0.1, 0.15], [0.1, 0.85]],
+  ];
+  const drawCar = (x, y, direction) => {
+    const [left, top] = cellRect(x, y);
+    const point = ([u, v]) => [left + u * cellWidth, top + v * cellHeight];
+    carLayer.beginPath();
+    carLayer.moveTo(...point(TIPS[direction]));
+    carLayer.lineTo(...point(BASES[direction][0]));
+    carLayer.lineTo(...point(BASES[direction][1]));
+    carLayer.closePath();
+    carLayer.fill();
+  };
+  const clearCar = (car) => carLayer.clearRect(...cellRect(car[0], car[1]));
+
+  const applyCars = (frame) => {
+    carLayer.fillStyle = CAR_COLOR;
+    if (frame.full) {
+      carLayer.clearRect(0, 0, canvas_width, canvas_height);
+      cars = new Map();
+    }
+    for (const id of frame.removed) {
+      const car = cars.get(id);
+      if (car !== undefined) {
+        clearCar(car);
+        cars.delete(id);
+      }
+    }
+    // Clear every old cell first: a car may move into the cell another car just left
+    for (const id of frame.ids) {
+      const car = cars.get(id);
+      if (car !== undefined) clearCar(car);
+    }
+    for (let i = 0; i < frame.ids.length; i++) {
+      cars.set(frame.ids[i], [frame.x[i], frame.z[i], frame.dir[i]]);
+    }
+    for (const id of frame.ids) {
+      const car = cars.get(id);
+      drawCar(car[0], car[1], car[2]);
+    }
+  };
+
+  this.render = (data) => {
+    if (data.type === "full") {
+      width = data.width;
+      height = data.height;
+      cellWidth = canvas_width / width;
+      cellHeight = canvas_height / height;
+      lightPositions = data.light_positions;
+      lightStates = data.lights;
+      drawStatic(data.cells, data.colors);
+      lightLayer.clearRect(0, 0, canvas_width, canvas_height);
+      lightStates.forEach((_, index) => drawLight(index));
+    } else {
+      data.switched.forEach((index) => {
+        lightStates[index] = !lightStates[index];
+        drawLight(index);
+      });
+    }
+    applyCars(data.cars);
+  };
+
+  this.reset = () => {
+    background.clearRect(0, 0, canvas_width, canvas_height);
+    lightLayer.clearRect(0, 0, canvas_width, canvas_height);
+    carLayer.clearRect(0, 0, canvas_width, canvas_height);
+    cars = new Map();
+  };
+};